@@ -0,0 +1,178 @@
+"""Heading backlash and nonlinearity compensation, built from a calibration sweep.
+
+Sweeps the heading a full turn up and then a full turn down in fixed steps, recording where the magnet actually ends
+up for every commanded heading. The difference, per direction of travel, is stored as an interpolated table that
+ODriveController applies to heading commands and heading telemetry. Run this file directly to calibrate the simulated
+heading (which has belt backlash), or with --hardware to calibrate the real rig (the heading WILL move).
+
+The heading encoder sits on the motor, before the belt, so it can't see the belt's backlash. Pass `measure` a function
+returning the magnet heading from an output side reference (e.g. the camera) to calibrate it; with the encoder alone
+the table only holds the servo's static error.
+"""
+import argparse
+import os
+import time
+import numpy as np
+from odrive.enums import *
+from misc_functions import shortest_angle_delta
+
+
+class HeadingCompensation:
+    """Lookup table of the heading error (measured minus commanded, degrees) against heading and direction of travel.
+
+    The table has `n` evenly spaced headings from 0° per direction, so a lookup is an index computation and one linear
+    interpolation, and works on scalars and NumPy arrays alike.
+
+    Attributes:
+        errors (np.ndarray): 2 x n errors [deg], row 0 while the heading increases, row 1 while it decreases
+        heading_gr, initial_heading: the controller settings the table was measured with. A table is only valid
+            with the same ones, see `load`.
+    """
+
+    def __init__(self, errors, heading_gr, initial_heading):
+        self.errors = np.asarray(errors, dtype=float)
+        self.heading_gr = heading_gr
+        self.initial_heading = initial_heading
+        self.step = 360 / self.errors.shape[1]
+        self.table = np.concatenate([self.errors, self.errors[:, :1]], axis=1)  # wrapped, index + 1 stays in range
+
+    @property
+    def backlash(self):
+        """Mean lost motion between the two directions [deg]."""
+        return float(np.mean(self.errors[1] - self.errors[0]))
+
+    def error(self, heading, direction):
+        """Expected error at `heading` [deg] when arriving with the heading increasing (direction >= 0) or decreasing."""
+        row = self.table[0 if direction >= 0 else 1]
+        x = np.remainder(heading, 360) / self.step
+        i = np.minimum(np.floor(x).astype(int), self.errors.shape[1] - 1)
+        frac = x - i
+        return row[i] + frac * (row[i + 1] - row[i])
+
+    def command(self, heading, direction):
+        """Heading to command so the magnet lands on `heading`."""
+        return heading - self.error(heading, direction)
+
+    def save(self, filename):
+        np.savez(filename, errors=self.errors, heading_gr=self.heading_gr, initial_heading=self.initial_heading)
+        print(f"Saved heading compensation to {filename} (backlash {self.backlash:.2f}°)")
+
+    @classmethod
+    def load(cls, filename, heading_gr, initial_heading):
+        """Load a saved table. Returns None if there is none, or if it was measured with other gear settings."""
+        if not os.path.exists(filename):
+            return None
+        data = np.load(filename)
+        if not np.isclose(data['heading_gr'], heading_gr) or not np.isclose(data['initial_heading'], initial_heading):
+            print(f"{filename} was measured with other heading gear settings, recalibrate. Not compensating.")
+            return None
+        return cls(data['errors'], heading_gr, initial_heading)
+
+
+class BacklashSweep:
+    """Steps a position controlled heading axis through a full turn in both directions and records the error.
+
+    The axis must already be in closed loop position control.
+
+    Attributes:
+        axis: the heading odrive axis, or a sim_odrive.SimAxis
+        heading_to_turns: converts an unwrapped heading [deg] to motor turns, ODriveController.heading_to_turns
+        measure: returns the heading the magnet is at [deg]
+        points (int): table entries, every 360 / points degrees
+        settle_time (float): wait after every step before measuring [s]
+        approach (float): every sweep starts this far [deg] before its first point, to take up the slack
+        sleep: wait function, time.sleep on hardware or a non-realtime sim's `advance`
+    """
+
+    def __init__(self, axis, heading_to_turns, measure, points=36, settle_time=2.0, approach=20.0, sleep=time.sleep):
+        self.axis = axis
+        self.heading_to_turns = heading_to_turns
+        self.measure = measure
+        self.points = points
+        self.settle_time = settle_time
+        self.approach = approach
+        self.sleep = sleep
+
+    def go(self, heading):
+        """Command an unwrapped heading and wait for it to settle. Returns the error there [deg]."""
+        self.axis.controller.input_pos = self.heading_to_turns(heading)
+        self.sleep(self.settle_time)
+        return shortest_angle_delta(heading, self.measure())
+
+    def run(self, center, heading_gr, initial_heading):
+        """Sweep the turn around the unwrapped heading `center` up, then down.
+
+        Returns:
+            the HeadingCompensation table
+        """
+        step = 360 / self.points
+        first = np.ceil((center - 180) / step) * step
+        headings = first + step * np.arange(self.points)
+        errors = np.zeros((2, self.points))
+        for row, direction, order in ((0, 1, headings), (1, -1, headings[::-1])):
+            self.go(order[0] - direction * self.approach)
+            for heading in order:
+                index = int(round(heading / step)) % self.points
+                errors[row, index] = self.go(heading)
+        return HeadingCompensation(errors, heading_gr, initial_heading)
+
+    def landing_errors(self, targets, compensation=None):
+        """Command the unwrapped `targets` in turn and measure where the magnet lands, optionally compensated.
+
+        Returns:
+            np.ndarray of landing errors [deg]
+        """
+        errors = []
+        previous = targets[0]
+        for target in targets:
+            direction = 1 if target >= previous else -1
+            command = target if compensation is None else compensation.command(target, direction)
+            self.axis.controller.input_pos = self.heading_to_turns(command)
+            self.sleep(self.settle_time)
+            errors.append(shortest_angle_delta(target, self.measure()))
+            previous = target
+        return np.array(errors)
+
+
+if __name__ == '__main__':
+    from threads.ODriveController import ODriveController
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hardware', action='store_true', help='calibrate the real rig instead of the simulation')
+    parser.add_argument('--points', type=int, default=36, help='table entries per direction')
+    args = parser.parse_args()
+
+    ctrl = ODriveController(simulate=not args.hardware)
+    if args.hardware:
+        import odrive
+        axis = odrive.find_any(serial_number=ctrl.drv1_serial).axis0
+        position = lambda: axis.encoder.pos_estimate  # no output side reference here, see the module docstring
+        sweep_args = {}
+    else:
+        import sim_odrive
+        axis = sim_odrive.find_any(serial_number=ctrl.drv1_serial, realtime=False).axis0
+        axis.backlash = ctrl.sim_heading_backlash
+        position = lambda: axis.load_pos
+        sweep_args = {'sleep': axis.advance}
+
+    config = axis.controller.config
+    config.control_mode = CONTROL_MODE_POSITION_CONTROL
+    config.input_mode = INPUT_MODE_POS_FILTER
+    config.input_filter_bandwidth = ctrl.heading_filter_bandwidth
+    config.vel_limit = ctrl.heading_vel_limit
+    axis.controller.input_pos = ctrl.heading_to_turns(ctrl.initial_heading)
+    axis.requested_state = AXIS_STATE_CLOSED_LOOP_CONTROL
+
+    measure = lambda: (ctrl.initial_heading - position() * ctrl.heading_gr * 360) % 360
+    sweep = BacklashSweep(axis, ctrl.heading_to_turns, measure, points=args.points, **sweep_args)
+    compensation = sweep.run(ctrl.initial_heading, ctrl.heading_gr, ctrl.initial_heading)
+    print(f"Heading error up {compensation.errors[0].mean():+.2f}°, down {compensation.errors[1].mean():+.2f}°, "
+          f"backlash {compensation.backlash:.2f}°")
+
+    # Switchback, ±35° around the start, with and without the table
+    targets = ctrl.initial_heading + 35 * np.array([0, -1, 1, -1, 1, -1, 1, 0])
+    before = np.abs(sweep.landing_errors(targets)).mean()
+    after = np.abs(sweep.landing_errors(targets, compensation)).mean()
+    print(f"Switchback landing error {before:.2f}° uncompensated, {after:.2f}° compensated")
+    compensation.save(ctrl.heading_compensation_file())
+    axis.requested_state = AXIS_STATE_IDLE
@@ -0,0 +1,79 @@
+from collections import deque
+import numpy as np
+
+
+class BandwidthScheduler:
+    """Picks the heading input filter bandwidth from the rate and size of recent heading commands.
+
+    Every heading command is recorded with `command`, which returns a new bandwidth when one should be applied before
+    the command is sent. Over the last `window` seconds of commands:
+
+    * median step of at least `small_step` degrees (switchback turns, preset jumps): the bandwidth rises from `base`
+      towards `max_bw` as the median step grows to `large_step`, so the heading keeps up with the steps
+    * smaller steps arriving at `smooth_rate` per second or faster (joystick steering): `min_bw`, for heavy smoothing
+    * anything else: `base`, the bandwidth set in the Parameter Tree
+
+    A higher bandwidth is applied right away. A change to a lower one waits until `hold_time` has passed since the
+    last change, and changes of less than `hysteresis` (relative) are skipped, so the USB link isn't kept busy with
+    small adjustments. Every change is printed and appended to `decisions`.
+
+    Attributes:
+        enabled (bool): when False, commands are still recorded but the bandwidth is left alone
+        base (float): bandwidth when there is no reason to deviate from it
+        current (float): the bandwidth last applied
+        decisions (list): (time, bandwidth, reason, commands/s, median step) per change
+    """
+
+    def __init__(self, base, min_bw=2.0, max_bw=20.0, window=1.0, small_step=5.0, large_step=30.0, smooth_rate=4.0,
+                 hysteresis=0.2, hold_time=0.5):
+        self.enabled = False
+        self.base = base
+        self.current = base
+        self.min_bw = min_bw
+        self.max_bw = max_bw
+        self.window = window
+        self.small_step = small_step
+        self.large_step = large_step
+        self.smooth_rate = smooth_rate
+        self.hysteresis = hysteresis
+        self.hold_time = hold_time
+
+        self.commands = deque()  # (time, |step| in degrees)
+        self.last_change = -np.inf
+        self.decisions = []
+
+    def target(self):
+        """Bandwidth for the recent commands, with the reason and the command rate and median step it is based on."""
+        rate = len(self.commands) / self.window
+        step = float(np.median([step for t, step in self.commands])) if self.commands else 0.0
+        if step >= self.small_step:
+            fraction = min(1.0, (step - self.small_step) / (self.large_step - self.small_step))
+            return self.base + fraction * (self.max_bw - self.base), 'large steps', rate, step
+        if rate >= self.smooth_rate:
+            return self.min_bw, 'steering', rate, step
+        return self.base, 'nominal', rate, step
+
+    def command(self, t, step):
+        """Record a heading command of `step` degrees at time t [s].
+
+        Returns:
+            the bandwidth to apply before sending the command, or None to keep the current one
+        """
+        self.commands.append((t, abs(step)))
+        while self.commands[0][0] < t - self.window:
+            self.commands.popleft()
+        if not self.enabled:
+            return None
+
+        bandwidth, reason, rate, step = self.target()
+        if abs(bandwidth - self.current) < self.hysteresis * self.current:
+            return None
+        if bandwidth < self.current and t - self.last_change < self.hold_time:
+            return None
+
+        print(f"Heading filter bandwidth {self.current:.1f} -> {bandwidth:.1f} ({reason}: {rate:.1f} commands/s, "
+              f"median step {step:.1f}°)")
+        self.decisions.append((t, bandwidth, reason, rate, step))
+        self.current = bandwidth
+        self.last_change = t
+        return bandwidth
@@ -0,0 +1,303 @@
+"""Oscilloscope style triggered capture of the telemetry.
+
+Instead of logging everything, TriggeredCapture keeps the last few seconds of every telemetry channel in a ring and,
+when a trigger fires, saves them together with the few seconds that follow into one compressed .npz file. Triggers
+are conditions on the samples (a heading command jump, the spinner deviating from its setpoint, a level crossing) or
+events fired by the GUI (motors engaged or released, a swarm pattern starting). Files are written by a CaptureWriter
+thread, so telemetry is never held up by the disk.
+
+Load a capture with `np.load(filename)`: `data` is the channels x samples block (rows named in `channels`, as in
+telemetry.CHANNELS), `trigger` is the index of the triggering sample and `reason` says what fired.
+"""
+import os
+import queue
+import re
+import time
+import numpy as np
+from pyqtgraph.Qt import QtCore
+from telemetry import CHANNELS
+
+
+class LevelTrigger:
+    """Fires on the sample where a channel crosses `level`, on the 'rising' or 'falling' edge, or 'either'."""
+
+    def __init__(self, row, level, edge='rising', name=None):
+        self.row = row
+        self.level = level
+        self.edge = edge
+        self.name = name or f"{CHANNELS[row]} {edge} through {level:g}"
+        self.last = np.nan
+
+    def check(self, data):
+        """Index of the first sample of the channels x n block `data` that fires, or None."""
+        x = data[self.row]
+        previous = np.concatenate(([self.last], x[:-1]))
+        self.last = x[-1]
+        rising = (previous < self.level) & (x >= self.level)
+        falling = (previous > self.level) & (x <= self.level)
+        hits = {'rising': rising, 'falling': falling, 'either': rising | falling}[self.edge]
+        return first(hits)
+
+
+class StepTrigger:
+    """Fires on a change of at least `step` between consecutive samples, e.g. a jump of the heading command.
+
+    With `angular`, the channel is in degrees and the change is taken the short way around.
+    """
+
+    def __init__(self, row, step, angular=False, name=None):
+        self.row = row
+        self.step = step
+        self.angular = angular
+        self.name = name or f"{CHANNELS[row]} step"
+        self.last = np.nan
+
+    def check(self, data):
+        x = data[self.row]
+        delta = np.diff(x, prepend=self.last)
+        self.last = x[-1]
+        if self.angular:
+            delta = (delta + 180) % 360 - 180
+        return first(np.abs(delta) >= self.step)
+
+
+class DeviationTrigger:
+    """Fires when a channel has been more than `tolerance` away from its reference (e.g. the spinner from its setpoint)
+    for `hold` consecutive samples. It fires once per excursion.
+    """
+
+    def __init__(self, row, reference_row, tolerance, hold=1, name=None):
+        self.row = row
+        self.reference_row = reference_row
+        self.tolerance = tolerance
+        self.hold = max(1, hold)
+        self.name = name or f"{CHANNELS[row]} off {CHANNELS[reference_row]}"
+        self.run = 0  # consecutive deviating samples up to the end of the last block
+
+    def check(self, data):
+        deviating = np.abs(data[self.row] - data[self.reference_row]) > self.tolerance
+        index = np.arange(deviating.size)
+        last_ok = np.maximum.accumulate(np.where(deviating, -1, index))  # latest sample within tolerance
+        run = np.where(last_ok >= 0, index - last_ok, index + 1 + self.run)
+        self.run = int(run[-1])
+        return first(run == self.hold)
+
+
+def first(hits):
+    """Index of the first True in `hits`, or None."""
+    index = np.flatnonzero(hits)
+    return int(index[0]) if index.size else None
+
+
+class TriggeredCapture:
+    """Pre and post trigger recording of the telemetry, like a single shot oscilloscope.
+
+    Every sample goes into a preallocated channels x `pre` samples ring. When a trigger fires, the ring is copied into
+    the capture in time order, the next `post` samples (starting with the triggering one) are added after it, and the
+    capture is handed to the CaptureWriter. Triggers are ignored while a capture is being filled and for `holdoff`
+    seconds after it ends.
+
+    Windows are given in seconds and sized in samples at the nominal telemetry `period`, so they cover more time while
+    the telemetry is backed off.
+
+    Attributes:
+        triggers (list): conditions checked on every block, each with `check(data)` and a `name`
+        enabled (bool): clearing it stops checking triggers (the ring keeps filling)
+        writer (CaptureWriter): saves the captures, start it before the first one
+        captures (int): captures handed to the writer
+        samples (int): samples seen, for comparing the stored amount with continuous logging
+    """
+
+    def __init__(self, period, pre=3.0, post=3.0, triggers=(), holdoff=1.0, directory='captures', prefix='capture'):
+        self.pre = max(1, int(np.ceil(pre / period)))
+        self.post = max(1, int(np.ceil(post / period)))
+        self.triggers = list(triggers)
+        self.holdoff = holdoff  # [s]
+        self.enabled = True
+
+        self.ring = np.full((len(CHANNELS), self.pre), np.nan)
+        self.index = 0  # where the next sample goes
+        self.capture = None  # being filled, channels x (pre + post)
+        self.filled = 0
+        self.reason = None
+        self.pending = None  # reason of an event fired from outside, taken on the next block
+        self.ready_time = 0.0  # end of the holdoff, perf_counter seconds
+
+        self.writer = CaptureWriter(directory, prefix)
+        self.captures = 0
+        self.samples = 0
+
+    def fire(self, reason):
+        """Trigger on the next telemetry sample, e.g. fire('Engage Motors on'). Call from any thread."""
+        self.pending = reason
+
+    def update(self, data):
+        """Add a channels x n block of telemetry samples, e.g. frame.data[:, :frame.n]."""
+        self.samples += data.shape[1]
+        hits = self.check(data)
+        offset = 0
+        while offset < data.shape[1]:
+            if self.capture is not None:
+                offset += self.fill(data[:, offset:])
+                continue
+            hit = next(((index, reason) for index, reason in hits
+                        if index >= offset and data[0, index] >= self.ready_time), None)
+            if hit is None:
+                self.push(data[:, offset:])
+                return
+            self.push(data[:, offset:hit[0]])
+            self.start(hit[1])
+            offset = hit[0]
+
+    def check(self, data):
+        """The samples of the block that trigger, as a sorted list of (index, what triggered)."""
+        hits = [(trigger.check(data), trigger.name) for trigger in self.triggers]  # keeps every trigger's state current
+        if self.pending is not None:
+            hits.insert(0, (0, self.pending))  # named after the event rather than the jump it caused
+            self.pending = None
+        if not self.enabled:
+            return []
+        return sorted((hit for hit in hits if hit[0] is not None), key=lambda hit: hit[0])
+
+    def push(self, data):
+        """Write samples into the ring."""
+        n = min(data.shape[1], self.pre)
+        data = data[:, data.shape[1] - n:]
+        end = min(n, self.pre - self.index)  # the part up to the end of the ring, then the part that wraps
+        self.ring[:, self.index:self.index + end] = data[:, :end]
+        self.ring[:, :n - end] = data[:, end:]
+        self.index = (self.index + n) % self.pre
+
+    def start(self, reason):
+        self.capture = np.empty((len(CHANNELS), self.pre + self.post))
+        self.capture[:, :self.pre - self.index] = self.ring[:, self.index:]
+        self.capture[:, self.pre - self.index:self.pre] = self.ring[:, :self.index]
+        self.filled = self.pre
+        self.reason = reason
+
+    def fill(self, data):
+        """Add samples to the capture being filled. Returns how many it took."""
+        n = min(data.shape[1], self.capture.shape[1] - self.filled)
+        self.capture[:, self.filled:self.filled + n] = data[:, :n]
+        self.push(data[:, :n])
+        self.filled += n
+        if self.filled == self.capture.shape[1]:
+            self.finish()
+        return n
+
+    def finish(self):
+        """Hand the capture to the writer, cut short if it isn't full yet."""
+        capture = self.capture[:, :self.filled]
+        capture = capture[:, ~np.isnan(capture[0])]  # ring slots that were never written
+        trigger = int(np.count_nonzero(~np.isnan(self.capture[0, :self.pre])))
+        self.writer.put(capture, trigger, self.reason)
+        self.ready_time = capture[0, -1] + self.holdoff
+        self.captures += 1
+        self.capture = None
+
+    def stop(self):
+        """Save a capture that is still being filled and let the writer finish."""
+        self.enabled = False
+        if self.capture is not None:
+            self.finish()
+        self.writer.stop()
+
+    def summary(self):
+        stored = self.captures * (self.pre + self.post)
+        share = f", {stored / self.samples:.1%} of the samples" if self.samples else ''
+        return (f"{self.captures} captures, {self.writer.written / 1024:.0f} kB written{share} "
+                f"({self.writer.saved} files)")
+
+
+class CaptureWriter(QtCore.QThread):
+    """Saves captures to compressed .npz files from a queue, away from the telemetry and GUI threads.
+
+    Attributes:
+        directory (str): where captures are saved, created on the first one
+        prefix (str): start of the file names, e.g. the rig name
+        saved (int): files written
+        written (int): bytes written
+    """
+    captureSaved = QtCore.pyqtSignal(str, str)  # filename, reason
+
+    def __init__(self, directory='captures', prefix='capture'):
+        super().__init__()
+        self.directory = directory
+        self.prefix = re.sub(r'\W+', '_', prefix).strip('_') or 'capture'
+        self.queue = queue.Queue()
+        self.saved = 0
+        self.written = 0
+        self.running = False
+
+    def put(self, data, trigger, reason):
+        if self.running:
+            self.queue.put((data, trigger, reason))
+        else:
+            self.save(data, trigger, reason)
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        while self.running or not self.queue.empty():
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.save(*item)
+
+    def save(self, data, trigger, reason):
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r'\W+', '_', reason).strip('_').lower()
+        filename = os.path.join(self.directory, f"{self.prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{self.saved:03d}"
+                                                f"_{slug}.npz")
+        np.savez_compressed(filename, data=data, channels=np.array(CHANNELS), trigger=trigger, reason=reason)
+        self.saved += 1
+        self.written += os.path.getsize(filename)
+        print(f"Captured {data.shape[1]} samples around '{reason}' to {filename}")
+        self.captureSaved.emit(filename, reason)
+
+    def stop(self):
+        """Finish writing the queued captures and stop."""
+        self.running = False
+        self.wait()
+
+
+if __name__ == '__main__':
+    # Feed ten minutes of synthetic 1 kHz telemetry with a few events through a capture, and compare what is stored
+    # with logging everything. Captures go to a temporary folder.
+    import tempfile
+    from telemetry import T, HEADING, HEADING_CMD, SPINNER, SPINNER_CMD
+
+    rate, batch, duration = 1000, 50, 600.0
+    directory = tempfile.mkdtemp()
+    capture = TriggeredCapture(1 / rate, triggers=[StepTrigger(HEADING_CMD, 20, angular=True, name='heading jump'),
+                                                   DeviationTrigger(SPINNER, SPINNER_CMD, 1.0, hold=rate // 2,
+                                                                    name='spinner deviation')],
+                               directory=directory, prefix='demo')
+    capture.writer.start()
+
+    rng = np.random.default_rng(0)
+    block = np.zeros((len(CHANNELS), batch))
+    t_update = 0.0
+    for i in range(int(duration * rate / batch)):
+        t = (i * batch + np.arange(batch)) / rate
+        block[T] = t
+        block[HEADING_CMD] = np.where(t < 200, 90, 180)
+        block[HEADING] = block[HEADING_CMD] + rng.normal(0, 0.2, batch)
+        block[SPINNER_CMD] = 10
+        block[SPINNER] = 10 + rng.normal(0, 0.1, batch) + np.where((t > 400) & (t < 402), 3, 0)  # a stall
+        if i == int(300 * rate / batch):
+            capture.fire('Engage Motors off')
+        start = time.perf_counter()
+        capture.update(block)
+        t_update = max(t_update, time.perf_counter() - start)
+    capture.stop()
+
+    continuous = capture.samples * len(CHANNELS) * 8
+    print(capture.summary())
+    print(f"Continuous logging would be {continuous / 1024:.0f} kB uncompressed, "
+          f"{capture.writer.written / continuous:.2%} of it stored. Longest update {t_update * 1e6:.0f} µs.")
+    for name in sorted(os.listdir(directory)):
+        saved = np.load(os.path.join(directory, name))
+        print(f"{saved['reason']}: {saved['data'].shape[1]} samples, trigger at t = "
+              f"{saved['data'][0, saved['trigger']]:.3f} s")
@@ -0,0 +1,94 @@
+import threading
+
+
+class ControlState:
+    """Thread-safe store of the live control values (heading, frequency, Z and r, mode, pointing vector, ...).
+
+    This is the source of truth for the control values; the Parameter Tree only mirrors it. Values are keyed by their
+    path in the Parameter Tree, e.g. ('Rolling', 'Heading'). `set` updates a value and calls every subscriber with
+    (path, value) right away, in the calling thread, so a swarm pattern or the gamepad reaches the controller without
+    waiting on widget repaints. Changed paths are also collected until the Parameter Tree takes them with `take_dirty`
+    on its refresh timer.
+
+    Changes from different threads reach the subscribers in the order they were made: a set holds the dispatch lock
+    from updating the value until its subscribers have returned, and a set from another thread waits for it. A
+    subscriber may set values itself (the lock is reentrant), but must not wait on another thread that sets values,
+    nor block on the operator (e.g. a modal dialog), since every other thread's changes wait for it.
+
+    Attributes:
+        values (dict): current value per path
+        limits (dict): (min, max) per path, values set outside are clamped
+    """
+
+    def __init__(self, values, limits=None):
+        self.values = {tuple(path): value for path, value in values.items()}
+        self.limits = {tuple(path): limit for path, limit in (limits or {}).items()}
+        self.couplings = {}
+        self.subscribers = []
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.dispatch_lock = threading.RLock()
+
+    def couple(self, path_a, path_b, a_to_b, b_to_a):
+        """Keep two values in step, e.g. Z and r: setting one sets the other to a_to_b(a) or b_to_a(b)."""
+        self.couplings[tuple(path_a)] = (tuple(path_b), a_to_b)
+        self.couplings[tuple(path_b)] = (tuple(path_a), b_to_a)
+
+    def subscribe(self, callback):
+        """Call `callback(path, value)` on every change, from the thread that made the change."""
+        self.subscribers.append(callback)
+
+    def get(self, path):
+        with self.lock:
+            return self.values[tuple(path)]
+
+    def set(self, path, value):
+        """Set a value, clamped to its limits. Subscribers are only called if the value changed.
+
+        Returns:
+            True if the value changed
+        """
+        path = tuple(path)
+        with self.dispatch_lock:
+            with self.lock:
+                changed = self._set(path, value)
+                if changed and path in self.couplings:
+                    other, convert = self.couplings[path]
+                    changed += self._set(other, convert(changed[0][1]))
+
+            for path, value in changed:
+                for callback in self.subscribers:
+                    callback(path, value)
+        return bool(changed)
+
+    def set_limits(self, path, limits):
+        """Change the (min, max) of a value, or remove them with None. The value is clamped to the new limits."""
+        path = tuple(path)
+        with self.lock:
+            if limits is None:
+                self.limits.pop(path, None)
+                return
+            self.limits[path] = tuple(limits)
+            value = self.values[path]
+        self.set(path, value)
+
+    def _set(self, path, value):
+        if path not in self.values:
+            raise KeyError(f"No control value {path}")
+        if path in self.limits:
+            clamped = min(max(value, self.limits[path][0]), self.limits[path][1])
+            if clamped != value:
+                self.dirty.add(path)  # so the Parameter Tree shows the clamped value even if it didn't change
+            value = clamped
+        if self.values[path] == value:
+            return []
+        self.values[path] = value
+        self.dirty.add(path)
+        return [(path, value)]
+
+    def take_dirty(self):
+        """The values changed since the last call, as a dict of path: value."""
+        with self.lock:
+            dirty = {path: self.values[path] for path in self.dirty}
+            self.dirty.clear()
+        return dirty
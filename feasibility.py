@@ -0,0 +1,259 @@
+"""Offline check of which swarm patterns the heading axis can actually follow.
+
+Runs the patterns in threads/Swarm.py over grids of their parameters, in virtual time, and records the heading
+setpoints they make. Every trajectory is played through a non-realtime simulated heading axis with the rig's gear
+ratio, velocity limit and input filter bandwidth. The setpoints reach the axis as they would through RigPanel, which
+holds back heading updates that come less than 0.1 s after the last one it sent and sends the latest of them when the
+0.1 s are over. The simulations run in a process pool.
+
+For every parameter set it reports the pattern's fundamental frequency, and the amplitude and phase lag the magnet
+heading achieves at that frequency. The fastest feasible set of every pattern is picked: the one with the highest
+fundamental that reaches at least --min-gain of the commanded amplitude within --max-phase of lag. Run this file
+directly, see --help.
+
+Only the heading is checked. The rig has no camber axis, so the Camber the patterns set has nothing to follow. Cable
+wrap limits aren't modelled either, so a corkscrew is treated as turning freely.
+"""
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+from odrive.enums import *
+from sim_odrive import SimAxis
+from threads import Swarm
+
+# Parameter grids around the defaults in threads/Swarm.py. Names in STATE set the Parameter Tree value the pattern
+# starts from, the rest are passed to the pattern function.
+GRIDS = {
+    'Switchback': {'time_between_turn': [0.1, 0.2, 0.3, 0.5, 1.0], 'wiggle_angle': [15, 35, 60]},
+    'Corkscrew': {'total_time': [0.5, 1.0, 2.0], 'total_steps': [10, 20], 'alpha': [0.2, 0.4]},
+    'Flipping': {'explode_time': [0.1, 0.2, 0.5], 'time_between_explodes': [0.5, 1.0], 'Camber': [-60]},
+}
+STATE = ('Heading', 'Camber')
+
+
+class PatternRecorder:
+    """Stands in for a SwarmThread: runs a pattern in virtual time and records the values it sets.
+
+    Attributes:
+        values (dict): current value of each Parameter Tree child the pattern uses
+        duration (float): `running` is cleared once `wait` passes this time [s]
+        setpoints (list): (t, child, value) for every `set`
+    """
+
+    def __init__(self, values, duration):
+        self.values = dict(values)
+        self.duration = duration
+        self.t = 0.0
+        self.setpoints = []
+        self.running = True
+
+    def set(self, child, value, branch='Rolling'):
+        self.values[child] = value
+        self.setpoints.append((self.t, child, value))
+
+    def get(self, child, branch='Rolling'):
+        return self.values[child]
+
+    def wait(self, interval):
+        self.t += interval
+        if self.t >= self.duration:
+            self.running = False
+
+
+def heading_trajectory(pattern, params, start, duration, update_interval=0.1):
+    """The heading setpoints a pattern sends to the controller over `duration` seconds.
+
+    Args:
+        pattern: a pattern function from threads/Swarm.py
+        params (dict): its keyword arguments, and the starting values of the names in STATE
+        start (dict): starting Parameter Tree values, e.g. {'Heading': 138.5, 'Camber': 60}
+        update_interval (float): heading updates closer together than this are held back and the latest is sent when
+            the interval is over, like RigPanel.change does
+
+    Returns:
+        times [s] and unwrapped headings [deg] of the setpoints that are sent, starting with the initial heading at 0
+    """
+    values = dict(start)
+    values.update({name: value for name, value in params.items() if name in STATE})
+    recorder = PatternRecorder(values, duration)
+    pattern(recorder, **{name: value for name, value in params.items() if name not in STATE})
+
+    times, headings = [0.0], [values['Heading']]
+    last_sent, pending = -np.inf, None
+
+    def send(t, value):
+        times.append(t)
+        headings.append(headings[-1] + (value - headings[-1] + 180) % 360 - 180)  # the short way, as plan_heading
+
+    for t, child, value in recorder.setpoints:
+        t = round(t, 9)  # virtual time adds up float error, which would otherwise decide what is held back
+        if child != 'Heading' or t >= duration:
+            continue
+        if pending is not None and t >= last_sent + update_interval - 1e-9:  # the held back update went out first
+            last_sent = round(last_sent + update_interval, 9)
+            send(last_sent, pending)
+            pending = None
+        if t - last_sent < update_interval - 1e-9:
+            pending = value
+        else:
+            last_sent = t
+            send(t, value)
+    if pending is not None and last_sent + update_interval < duration:
+        send(round(last_sent + update_interval, 9), pending)
+    return np.array(times), np.array(headings)
+
+
+def simulate(times, headings, duration, heading_gr, vel_limit, bandwidth, sample_rate=1000):
+    """Play heading setpoints through a simulated heading axis in position filter mode.
+
+    Returns:
+        sample times [s], the commanded and the achieved unwrapped heading [deg] at each, and the fraction of the
+        samples the motor spent at its velocity limit
+    """
+    axis = SimAxis(realtime=False)
+    config = axis.controller.config
+    config.control_mode = CONTROL_MODE_POSITION_CONTROL
+    config.input_mode = INPUT_MODE_POS_FILTER
+    config.input_filter_bandwidth = bandwidth
+    config.vel_limit = vel_limit
+    turns_per_degree = -1 / (heading_gr * 360)  # the heading runs backwards, see ODriveController.heading_to_turns
+    axis.controller.input_pos = 0.0
+    axis.requested_state = AXIS_STATE_CLOSED_LOOP_CONTROL
+
+    n = int(duration * sample_rate)
+    t = np.arange(1, n + 1) / sample_rate
+    command = headings[np.searchsorted(times, t - 1 / sample_rate, side='right') - 1]
+    response = np.empty(n)
+    saturated = 0
+    for i in range(n):
+        if i == 0 or command[i] != command[i - 1]:
+            axis.controller.input_pos = (command[i] - headings[0]) * turns_per_degree
+        axis.advance(1 / sample_rate)
+        response[i] = headings[0] + axis.pos / turns_per_degree
+        saturated += abs(axis.vel) >= 0.99 * vel_limit
+    return t, command, response, saturated / n
+
+
+def tracking_metrics(t, command, response, settle=2.0):
+    """Amplitude and phase of the response at the command's fundamental frequency, after `settle` seconds.
+
+    A steady turn (the corkscrew) is taken out of both signals first, with the straight line fitted to the command.
+
+    Returns:
+        dict with the fundamental frequency [Hz], the command and response amplitudes [deg], their ratio (gain), the
+        phase lag [deg] and the same as a delay [s], and the RMS tracking error [deg]. None if the command doesn't move
+        periodically after `settle`.
+    """
+    keep = t >= settle
+    t, command, response = t[keep], command[keep], response[keep]
+    if t.size < 2 or np.ptp(command) == 0:
+        return None
+    trend = np.polyval(np.polyfit(t, command, 1), t)
+    r, y = command - trend, response - trend
+
+    # Fundamental from the windowed, zero padded spectrum of the command: its lowest strong peak, since the staircase of a
+    # fast pattern can have more power at the setpoint rate. Then measured over a whole number of its periods.
+    dt = t[1] - t[0]
+    size = 8 << int(t.size - 1).bit_length()
+    spectrum = np.abs(np.fft.rfft((r - r.mean()) * np.hanning(r.size), size))
+    spectrum[:int(np.ceil(size * dt / (t[-1] - t[0])))] = 0  # nothing slower than one cycle over the recording
+    middle = spectrum[1:-1]
+    peaks = np.flatnonzero((middle >= 0.25 * spectrum.max()) & (middle >= spectrum[:-2]) & (middle >= spectrum[2:]))
+    if peaks.size == 0:
+        return None
+    f0 = (peaks[0] + 1) / (size * dt)
+    cycles = int((t[-1] - t[0]) * f0)
+    if cycles < 1:
+        return None
+    n = int(round(cycles / f0 / dt))
+    basis = np.exp(-2j * np.pi * f0 * t[:n])
+    R, Y = np.dot(r[:n], basis), np.dot(y[:n], basis)
+    phase = float(np.degrees(np.angle(R * np.conj(Y))))
+    return {'frequency': f0, 'command_amplitude': 2 * abs(R) / n, 'amplitude': 2 * abs(Y) / n,
+            'gain': abs(Y) / abs(R), 'phase': phase, 'delay': phase / 360 / f0,
+            'rms_error': float(np.sqrt(np.mean((response[:n] - command[:n]) ** 2)))}
+
+
+def check(task):
+    """Expand, simulate and measure one (pattern name, params, bandwidth, settings) task. Runs in the pool's processes."""
+    name, params, bandwidth, settings = task
+    times, headings = heading_trajectory(Swarm.PATTERNS[name], params, settings['start'], settings['duration'],
+                                         settings['update_interval'])
+    t, command, response, saturation = simulate(times, headings, settings['duration'], settings['heading_gr'],
+                                                settings['vel_limit'], bandwidth)
+    metrics = tracking_metrics(t, command, response, settings['settle'])
+    return {'pattern': name, 'params': params, 'bandwidth': bandwidth, 'setpoints': times.size - 1, 'saturation': saturation,
+            'metrics': metrics}
+
+
+def tasks(grids, bandwidths, settings):
+    """Every combination of the parameter grids, per pattern and heading filter bandwidth."""
+    for name, grid in grids.items():
+        for bandwidth, values in itertools.product(bandwidths, itertools.product(*grid.values())):
+            yield name, dict(zip(grid, values)), bandwidth, settings
+
+
+def feasible(result, min_gain, max_phase):
+    m = result['metrics']
+    return m is not None and m['gain'] >= min_gain and abs(m['phase']) <= max_phase  # beyond 180° it wraps
+
+
+def report(results, min_gain=0.9, max_phase=30.0):
+    """Print the results table and the fastest feasible parameter set of every pattern.
+
+    Returns:
+        dict of pattern name: its fastest feasible result, or None
+    """
+    print(f"{'pattern':<11}{'bw':>5}  {'parameters':<60}{'f0 [Hz]':>8}{'cmd [°]':>9}{'got [°]':>9}{'gain':>6}{'lag [°]':>9}"
+          f"{'lag [ms]':>9}{'rms [°]':>9}{'vel sat':>8}  ok")
+    best = {}
+    for result in results:
+        params = ', '.join(f"{name} {value:g}" for name, value in result['params'].items())
+        row = f"{result['pattern']:<11}{result['bandwidth']:>5g}  {params:<60}"
+        m = result['metrics']
+        ok = feasible(result, min_gain, max_phase)
+        if m is None:
+            print(f"{row}  no periodic heading motion ({result['setpoints']} setpoints)")
+        else:
+            print(f"{row}{m['frequency']:>8.2f}{m['command_amplitude']:>9.1f}"
+                  f"{m['amplitude']:>9.1f}{m['gain']:>6.2f}{m['phase']:>9.1f}{m['delay'] * 1000:>9.0f}"
+                  f"{m['rms_error']:>9.1f}{result['saturation']:>8.0%}  {'yes' if ok else 'no'}")
+        best.setdefault(result['pattern'], None)
+        if ok and (best[result['pattern']] is None or m['frequency'] > best[result['pattern']]['metrics']['frequency']):
+            best[result['pattern']] = result
+
+    print(f"\nFastest patterns reaching {min_gain:.0%} of the commanded amplitude within {max_phase:g}° of lag:")
+    for name, result in best.items():
+        if result is None:
+            print(f"  {name}: none")
+        else:
+            params = ', '.join(f"{key} {value:g}" for key, value in result['params'].items())
+            print(f"  {name}: {params} at bandwidth {result['bandwidth']:g} ({result['metrics']['frequency']:.2f} Hz)")
+    return best
+
+
+if __name__ == '__main__':
+    from threads.ODriveController import ODriveController
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patterns', nargs='+', choices=list(GRIDS), default=list(GRIDS), help='patterns to check')
+    parser.add_argument('--bandwidths', nargs='+', type=float,
+                        help="heading filter bandwidths, default the rig's and the adaptive bandwidth's highest")
+    parser.add_argument('--duration', type=float, default=10.0, help='simulated time per parameter set [s]')
+    parser.add_argument('--settle', type=float, default=2.0, help='time left out of the metrics at the start [s]')
+    parser.add_argument('--min-gain', type=float, default=0.9, help='smallest acceptable amplitude ratio')
+    parser.add_argument('--max-phase', type=float, default=30.0, help='largest acceptable phase lag [deg]')
+    parser.add_argument('--processes', type=int, help='pool size, default one per CPU')
+    args = parser.parse_args()
+
+    ctrl = ODriveController(simulate=True)
+    settings = {'start': {'Heading': ctrl.initial_heading, 'Camber': 60}, 'duration': args.duration,
+                'settle': args.settle, 'update_interval': 0.1, 'heading_gr': ctrl.heading_gr,
+                'vel_limit': ctrl.heading_vel_limit}
+    bandwidths = args.bandwidths or [ctrl.heading_filter_bandwidth, ctrl.heading_bandwidth_scheduler.max_bw]
+    grids = {name: GRIDS[name] for name in args.patterns}
+
+    with mp.Pool(args.processes) as pool:
+        results = pool.map(check, list(tasks(grids, bandwidths, settings)))
+    report(results, args.min_gain, args.max_phase)
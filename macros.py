@@ -0,0 +1,115 @@
+import json
+import time
+import numpy as np
+from pyqtgraph.Qt import QtCore
+
+
+class MacroRecorder:
+    """Records the timestamped stream of control value changes reaching RigPanel.change.
+
+    Each event is [time since recording started in s, parameter path, value]. "Engage Motors" is never recorded, so a
+    replay can't engage or release the motors, and "r" is skipped because it is derived from "Z".
+
+    Attributes:
+        events (list): the recorded events
+        recording (bool): whether changes are currently being captured
+    """
+    skipped = ('Engage Motors', 'r')
+
+    def __init__(self):
+        self.events = []
+        self.recording = False
+        self.t0 = None
+
+    def start(self):
+        self.events = []
+        self.t0 = time.perf_counter()
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+
+    def record(self, path, value):
+        """Add a parameter change, if recording. `path` is the parameter's path in the Parameter Tree."""
+        if not self.recording or path[-1] in self.skipped:
+            return
+        self.events.append([time.perf_counter() - self.t0, list(path), value])
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'events': self.events}, f, indent=1)
+        print(f"Saved {len(self.events)} macro events to {filename}")
+
+
+def load_macro(filename):
+    """Read the events of a macro saved by MacroRecorder.save."""
+    with open(filename) as f:
+        return json.load(f)['events']
+
+
+class MacroPlayer(QtCore.QThread):
+    """Re-issues recorded parameter changes on a precise schedule.
+
+    Events are emitted with replayEvent(player, index, path, value, scheduled time) at their recorded time divided by
+    `speed`. The receiver applies the change to the Parameter Tree and hands the actual time back through `applied`, so
+    the deviation from the schedule is measured where it matters: when the change reaches the controller. Events are
+    queued to the receiver, so they can arrive after the player was stopped. The player they carry tells them apart.
+
+    Attributes:
+        events (list): events as recorded by MacroRecorder
+        speed (float): playback speed, 2.0 plays twice as fast
+        loops (int): how many times to play the macro, 0 repeats until stopped
+        deviations (np.ndarray): per event deviation of the last pass, actual minus scheduled [s]
+        spin_time (float): the final part of every wait is spent polling the clock instead of sleeping, since sleep
+            alone can overshoot by more than a millisecond
+    """
+    replayEvent = QtCore.pyqtSignal(object, int, object, object, float)
+
+    def __init__(self, events, speed=1.0, loops=1, spin_time=0.002):
+        super().__init__()
+        self.events = events
+        self.speed = speed
+        self.loops = loops
+        self.spin_time = spin_time
+        self.running = False
+        self.deviations = np.full(len(events), np.nan)
+
+    def applied(self, index, scheduled):
+        """Called by the receiver once event `index` has been applied."""
+        self.deviations[index] = time.perf_counter() - scheduled
+
+    def wait_until(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            pass
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        length = self.events[-1][0] / self.speed if self.events else 0.0
+        start = time.perf_counter()
+        n = 0
+        while self.running and (self.loops == 0 or n < self.loops):
+            pass_start = start + n * length
+            if n > 0:
+                self.report(n)  # the previous pass has had the whole gap before this one to be applied
+            self.deviations[:] = np.nan
+            for index, (t, path, value) in enumerate(self.events):
+                scheduled = pass_start + t / self.speed
+                self.wait_until(scheduled)
+                if not self.running:
+                    break
+                self.replayEvent.emit(self, index, path, value, scheduled)
+            n += 1
+        self.msleep(50)  # let the receiver apply the last events
+        self.report(n)
+        self.running = False
+
+    def report(self, n):
+        """Print the timing deviation statistics of pass `n`."""
+        done = self.deviations[~np.isnan(self.deviations)]
+        if done.size:
+            print(f"Macro pass {n}: {done.size} events, deviation mean {done.mean() * 1000:.2f} ms, "
+                  f"max {np.abs(done).max() * 1000:.2f} ms")
@@ -3,30 +3,36 @@ from xml.dom.minidom import Attr
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 import pyqtgraph as pg
 import sys
+import multiprocessing
 from time import sleep
-from misc_functions import qtsleep
+from misc_functions import loop_timing_report
+from threads.Arbiter import arbiter_report
 
 # Custom modules
-from threads.DataGenerator import Generator
 from threads.Controller import ControllerThread
-from threads.ODriveController import ODriveController
-from parametertree import MyParamTree
 from settings import SettingsWindow
-from plots import SignalPlot
-
-debug_mode = False # Switch to either use NI threads or a random data generator.
+from rigpanel import RigPanel
+from rigs import RIGS
+from macros import load_macro
+from profiler import SamplingProfiler
+
+debug_mode = False # Switch to feed the plots from the synthetic load generator in threads/DataGenerator.py
+debug_load = {'rate': 1000, 'batch': 10}  # Telemetry rate [Hz] and batch size of the load generator
+sim_mode = False  # Switch to drive the simulated ODrives in sim_odrive.py instead of the hardware
 fbs_mode = False  # Switch to use either the PyQt5 app starting or the FBS container
+software_gl = False  # Switch to render the 3D orientation view with Qt's software OpenGL, for machines without a GPU
 
 
 class MyWindow(QtGui.QMainWindow):
     """ The main window of the application.
 
-    This class is the parent to all the widgets inside of it. The grid layout of the UI is described here. This class
-    also serves as a "middle man" for communication between threads. e.g. data from the readThread is passed here and
-    then passed to the plot widget.
+    This class is the parent to all the widgets inside of it. The window holds one tab per actuator rig listed in
+    rigs.py; each tab is a RigPanel with its own plots, Parameter Tree and controller thread. The gamepad is shared
+    and drives whichever rig's tab is showing.
 
     Attributes:
         config: instantiated version of the SettingsWindow class located in settings.py
+        rigs (list): a RigPanel for every rig
     """
 
     def __init__(self):
@@ -44,11 +50,6 @@ class MyWindow(QtGui.QMainWindow):
         self.initUI()
         self.initThreads(self.config)
 
-        self.p1.keyPressed.connect(self.t.on_key)  # Connect keyPresses on signal plot to Param Tree
-
-        # Delay to avoid constantly sending updates to odrive controller
-        self.last_update = 0.2
-
     def initUI(self):
         """
         This method instantiates every widget and arranges them all inside the main window. This is where the
@@ -63,6 +64,9 @@ class MyWindow(QtGui.QMainWindow):
         mainMenu = self.menuBar()
         # mainMenu.setStyleSheet("""QMenuBar { background-color: #F0F0F0; }""")  # Makes the menu bar grey-ish
         fileMenu = mainMenu.addMenu('File')  # Adds the file button
+        macroMenu = mainMenu.addMenu('Macros')
+        rigMenu = mainMenu.addMenu('Rig')
+        experimentMenu = mainMenu.addMenu('Experiments')
         helpMenu = mainMenu.addMenu('Help')
 
         # Settings button
@@ -77,6 +81,33 @@ class MyWindow(QtGui.QMainWindow):
         exitButton.triggered.connect(self.close)
         fileMenu.addAction(exitButton)
 
+        # Macro buttons, record and replay the parameter changes of the rig that is showing
+        self.recordButton = QtWidgets.QAction('Record Macro', self)
+        self.recordButton.setCheckable(True)
+        self.recordButton.setShortcut('Ctrl+R')
+        self.recordButton.toggled.connect(self.toggle_recording)
+        macroMenu.addAction(self.recordButton)
+
+        playButton = QtWidgets.QAction('Play Macro...', self)
+        playButton.setShortcut('Ctrl+P')
+        playButton.triggered.connect(self.play_macro)
+        macroMenu.addAction(playButton)
+
+        stopButton = QtWidgets.QAction('Stop Macro', self)
+        stopButton.triggered.connect(lambda: self.current_rig().stop_macro())
+        macroMenu.addAction(stopButton)
+
+        # Find the origin of Z of the rig that is showing
+        homeButton = QtWidgets.QAction('Home Roboscope', self)
+        homeButton.triggered.connect(lambda: self.current_rig().home_roboscope())
+        rigMenu.addAction(homeButton)
+
+        # Frequency sweep of the rig that is showing, set up in its Parameter Tree
+        self.sweepButton = QtWidgets.QAction('Frequency Sweep', self)
+        self.sweepButton.setCheckable(True)
+        self.sweepButton.toggled.connect(self.toggle_sweep)
+        experimentMenu.addAction(self.sweepButton)
+
         # User Guide button in help menu
         userguideButton = QtGui.QAction("Open User Guide", self)
         userguideButton.setShortcut('Ctrl+H')
@@ -84,19 +115,37 @@ class MyWindow(QtGui.QMainWindow):
             "https://czimm79.github.io/mucontrol-userguide/index.html")))
         helpMenu.addAction(userguideButton)
 
+        # Timing statistics of every periodic loop (telemetry, gamepad, swarm patterns, ...) and ODrive board I/O
+        timingButton = QtWidgets.QAction('Loop Timing', self)
+        timingButton.triggered.connect(lambda: QtWidgets.QMessageBox.information(
+            self, 'Loop Timing',
+            '\n'.join(filter(None, (loop_timing_report(), arbiter_report()))) or 'No loops running.'))
+        helpMenu.addAction(timingButton)
+
+        # Stack sampling profiler of every thread, stopping it saves a flame graph
+        self.profiler = None
+        profileButton = QtWidgets.QAction('Profile Threads', self)
+        profileButton.setCheckable(True)
+        profileButton.toggled.connect(self.toggle_profiler)
+        helpMenu.addAction(profileButton)
+
         # Create an empty box to hold all the following widgets
         self.mainbox = QtGui.QWidget()
         self.setCentralWidget(self.mainbox)  # Put it in the center of the main window
         layout = QtWidgets.QGridLayout()  # All the widgets will be in a grid in the main box
         self.mainbox.setLayout(layout)  # set the layout
 
-        # Instantiate the plots from plots.py
-        self.p1 = SignalPlot(curve_colors=['r'])  # heading
-        self.p1.setYRange(0, 360)
-        self.p2 = SignalPlot(curve_colors=['g'])  # roboscope
-        self.p2.setYRange(0, 30)
-        self.p3 = SignalPlot(curve_colors=['b'])  # spinner
-        self.p3.setYRange(0, 30)
+        # One tab per rig
+        self.tabs = QtWidgets.QTabWidget()
+        self.rigs = []
+        for rig in RIGS:
+            panel = RigPanel(rig, self.config, simulate=sim_mode or debug_mode,
+                             load_test=debug_load if debug_mode else None)
+            panel.shutdown.progress.connect(lambda message, percent, name=rig['name']: self.statusBar().showMessage(
+                f"Shutting down {name} ({percent}%): {message}"))
+            panel.shutdown.finished.connect(self.close)
+            self.rigs.append(panel)
+            self.tabs.addTab(panel, rig['name'] + (' (simulated)' if sim_mode else ''))
 
         # Create control descriptions
         # self.keyboardlbl = QtWidgets.QLabel(
@@ -116,187 +165,146 @@ class MyWindow(QtGui.QMainWindow):
         # self.keyboardlbl.setFont(QtGui.QFont("Default", 11))  # Optionally, change font size
         # self.gamepadlbl.setFont(QtGui.QFont("Default", 11))
 
-        # Create plot labels
-        self.p1lbl = QtWidgets.QLabel('<b><u>Heading Angle</u></b>')
-        self.p2lbl = QtWidgets.QLabel('<b><u>Roboscope Z (cm)</u></b>')
-        self.p3lbl = QtWidgets.QLabel('<b><u>Magnet Rotation Frequency</u></b>')
-
-        # Parameter Tree widget
-        self.t = MyParamTree(self.config)  # From ParameterTree.py
-        self.t.paramChange.connect(self.change)  # Connect the output signal from changes in the param tree to change
+        # Latest telemetry of every rig, refreshed a few times a second
+        self.overviewlbl = QtWidgets.QLabel()
+        self.overview_timer = QtCore.QTimer()
+        self.overview_timer.timeout.connect(self.update_overview)
+        self.overview_timer.start(500)
 
         # Add widgets to the layout in their proper positions
-        layout.addWidget(self.p1lbl, 0, 0)
-        layout.addWidget(self.p2lbl, 0, 1)
-        layout.addWidget(self.p3lbl, 0, 2)
-        layout.addWidget(self.p1, 1, 0)
-        layout.addWidget(self.p2, 1, 1)
-        layout.addWidget(self.p3, 1, 2)
-        layout.addWidget(self.t, 3, 0, 1, 3)  # row, col, rowspan, colspan
-        #layout.addWidget(self.keyboardlbl, 2, 0, 1, 3)
-        layout.addWidget(self.gamepadlbl, 2, 0, 1, 3)
+        layout.addWidget(self.tabs, 0, 0)
+        layout.addWidget(self.overviewlbl, 1, 0)
+        #layout.addWidget(self.keyboardlbl, 2, 0)
+        layout.addWidget(self.gamepadlbl, 2, 0)
         
 
     def initThreads(self, config):
-        """Initialize the readThread and writeThread using configurations.
+        """Start the gamepad thread. Each rig ignores its events until its controller has connected.
 
         Args:
             config: The previously instantiated SettingsWindow class containing the persistent QSettings values
 
         """
-
-        self.odriveThread = ODriveController()
-        self.odriveThread.newheadingpos.connect(self.p1.on_new_data_update_plot)
-        self.odriveThread.newrobopos.connect(self.p2.on_new_data_update_plot)
-        self.odriveThread.newspinnervel.connect(self.p3.on_new_data_update_plot)
-        self.odriveThread.start()
-        qtsleep(3)  # wait for odrive to connect
-
         # Lastly, initialize and connect the controller input listening thread
         self.gamepadThread = ControllerThread()
-        self.gamepadThread.newGamepadEvent.connect(self.t.on_gamepad_event)
+        self.gamepadThread.newGamepadEvent.connect(self.on_gamepad_event)
         self.gamepadThread.start()
         self.gamepadThread.setPriority(QtCore.QThread.LowestPriority)
 
+    def current_rig(self):
+        """The RigPanel of the tab that is showing."""
+        return self.tabs.currentWidget()
+
+    def on_gamepad_event(self, gamepadEvent):
+        """Forward gamepad events to the Parameter Tree of the rig that is showing."""
+        self.current_rig().on_gamepad_event(gamepadEvent)
+
+    def toggle_recording(self, checked):
+        """Start recording the current rig's parameter changes, or stop and save them to a file."""
+        recorder = self.current_rig().recorder
+        if checked:
+            recorder.start()
+            self.statusBar().showMessage("Recording macro...")
+            return
+
+        recorder.stop()
+        self.statusBar().showMessage(f"Recorded {len(recorder.events)} events.")
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Macro', 'macro.json', 'Macros (*.json)')
+        if filename:
+            recorder.save(filename)
+
+    def play_macro(self):
+        """Ask for a macro file, speed and loop count, then replay it on the current rig."""
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Play Macro', '', 'Macros (*.json)')
+        if not filename:
+            return
+        speed, ok = QtWidgets.QInputDialog.getDouble(self, 'Play Macro', 'Speed:', 1.0, 0.01, 100.0, 2)
+        if not ok:
+            return
+        loops, ok = QtWidgets.QInputDialog.getInt(self, 'Play Macro', 'Loops (0 = until stopped):', 1, 0, 10000)
+        if not ok:
+            return
+        self.current_rig().play_macro(load_macro(filename), speed, loops)
+
+    def toggle_profiler(self, checked):
+        """Start sampling the stacks of every thread, or stop and save them as collapsed stacks for a flame graph."""
+        if checked:
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+            self.statusBar().showMessage("Profiling...")
+            return
+
+        self.profiler.stop()
+        summary = self.profiler.summary()
+        print(summary)
+        self.statusBar().showMessage(summary.splitlines()[0])
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Profile', 'profile.folded',
+                                                            'Collapsed stacks (*.folded *.txt)')
+        if filename:
+            self.profiler.save(filename)
+
+    def toggle_sweep(self, checked):
+        """Start a frequency sweep on the current rig, or stop the one that is running."""
+        rig = self.current_rig()
+        if not checked:
+            if rig.sweep is not None and rig.sweep.running:
+                rig.sweep.running = False  # finishes and reports the steps done so far
+            return
+        sweep = rig.start_sweep()
+        sweep.progress.connect(lambda done, total: self.statusBar().showMessage(
+            f"Frequency sweep: step {done} of {total}"))
+        sweep.sweepFinished.connect(lambda results: self.on_sweep_finished(sweep))
+
+    def on_sweep_finished(self, sweep):
+        """Offer to save the results of a finished sweep."""
+        self.sweepButton.setChecked(False)
+        self.statusBar().showMessage(f"Frequency sweep finished, {len(sweep.results)} steps.")
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Sweep', 'sweep.csv', 'CSV (*.csv)')
+        if filename:
+            sweep.save_csv(filename)
+
+    def update_overview(self):
+        self.overviewlbl.setText(' &nbsp; | &nbsp; '.join(panel.overview() for panel in self.rigs))
 
+    def closeEvent(self, evnt):
+        """ This method runs when Qt detects the main window closing. Used to gracefully end threads.
 
-    def change(self, param, changes):
-        """Parses the value change signals coming in from the Parameter Tree.
-
-        When a parameter is changed in the Parameter Tree by the UI, keyboard, or gamepad, the Parameter Tree sends a
-        signal to this method. The signal contains the param and changes args. This method uses if statements
-        to filter the corresponding value changes and send them to their proper places.
-
-        Args:
-            param: Name of the parameter being changed
-            changes: an iterable which contains one or more value change signals
-
-        """
-        for param, change, data in changes:
-            path = self.t.p.childPath(param)
-            isengaged = self.t.getTopLevelParamValue("Engage Motors")
-
-            # Logic for sending changes to the odriveThread
-            # Top branch parameters
-            if path[0] == 'Engage Motors':
-                self.toggle_control(data)
-            
-            elif path[0] == 'Control Mode':
-                if data == 'Rolling':
-                    self.odriveThread.mode = "Rolling"
-                    # Update with current parameter tree vals
-                    self.odriveThread.f = self.t.getParamValue("Frequency")
-                    self.odriveThread.h = self.t.getParamValue("Heading")
-
-                elif data == 'Pointing':
-                    self.odriveThread.mode = "Pointing"
-                    print("This functionality doesn't exist yet!")
-
-            elif path[0] == 'Heading Filter Bandwidth':
-                self.odriveThread.set_heading_filter_bandwidth(data)
-
-            elif path[0] == 'Constants':
-                if path[1] == 'Gain':
-                    print("Functionality does not exist yet.")
-                    #self.odriveThread.heading_pos_offset = data
-
-            elif path[0] == 'Roboscope Control':
-                if path[1] == 'Z':
-                    Z_current = self.t.getParamValue("Z", branch="Roboscope Control")
-                    self.odriveThread.z = Z_current
-                    self.odriveThread.update_roboscope()
-
-            # Dumb Rolling
-            elif (path[1] == 'Frequency'):
-                self.odriveThread.f = data
-                self.odriveThread.update_magnet_rotation_rate()
-
-            elif (path[1] == 'Camber') & (self.odriveThread.mode == "Rolling"):
-                print("no camber functionality yet.")
-
-            elif path[1] == 'Heading':
-                self.odriveThread.h = data
-                now = pg.ptime.time()
-
-                time_elapsed = now - self.last_update
-                if time_elapsed < 0.1:  # if a bunch of changes are made fast, skip updating
-                    pass
-                else:  # Continue along
-                    self.last_update = now
-                    self.odriveThread.update_heading()
-
-            # Pointing
-            elif (path[1] == "X") & (self.odriveThread.mode == "Pointing"):
-                self.odriveThread.mdes[0] = data
-
-            elif (path[1] == "Y") & (self.odriveThread.mode == "Pointing"):
-                self.odriveThread.mdes[1] = data
-
-            elif (path[1] == "Z") & (self.odriveThread.mode == "Pointing"):
-                self.odriveThread.mdes[2] = data
-
-
-
-    def toggle_control(self, data):
-        """A sub-method that toggles whether the motors are engaged or idle..
-
-        Args:
-            data: a boolean, whether the checkbox is checked or not
-
-        """
-        if data is True:  # If the box is checked
-            self.odriveThread.closed_loop()  # Turn on closed loop control
-
-        elif data is False:  # if box is unchecked
-            error_box = QtWidgets.QErrorMessage()
-            error_box.setModal(True)  # Cannot do other things in the app while this window is open
-            error_box.showMessage("Warning! Motors will free-spin and can DROP after this message is dismissed.")
-            error_box.exec_()
-            self.odriveThread.idle()  # release motors
-
-    def error_handling(self, error_message):
-        """When an error signal is sent to this method, show an error box with the message inside.
+        The first close request starts the shutdown sequence of every rig and is ignored, so the window stays open and
+        responsive while the roboscopes park. Each sequence closes the window again when it finishes; the close is
+        accepted once all of them are done.
 
         Args:
-            error_message: signal from either the writeThread or readThread containing the error message
+            evnt: the close event, ignored until every shutdown sequence has finished
 
         """
-        error_box = QtWidgets.QErrorMessage()
-        error_box.setModal(True)  # Cannot do other things in the app while this window is open
-        error_box.showMessage(error_message)
-        error_box.exec_()
+        if all(panel.shutdown.state == 'done' for panel in self.rigs):
+            evnt.accept()
+            return
 
-    def closeEvent(self, evnt):
-        """ This method runs when Qt detects the main window closing. Used to gracefully end threads.
+        evnt.ignore()
+        if self.profiler is not None:
+            self.profiler.stop()
 
-        The purpose of this method is to try and gracefully close threads to avoid persisting processes or bugs with
-        the National Instruments cards.
+        if self.gamepadThread.running:
+            # Close controller thread
+            self.gamepadThread.running = False
+            self.gamepadThread.exit()
 
-        Args:
-            evnt: dummy variable, unused
+        for panel in self.rigs:
+            panel.stop_macro()
+            panel.stop_sweep()
+            panel.capture.stop()
+            if panel.generator is not None:
+                panel.generator.running = False
 
-        """
-        # Close controller thread
-        self.gamepadThread.running = False
-        self.gamepadThread.exit()
-
-        # turn magnet off and gracefully lower roboscope
-        self.odriveThread.z = 0.2
-        self.odriveThread.update_roboscope()
-        self.odriveThread.f = 0
-        self.odriveThread.update_magnet_rotation_rate()
-        sleep(2)
-        
-        # data retriever
-        self.odriveThread.dataretriever.running = False
-
-        self.odriveThread.running = False
-        self.odriveThread.idle()
-        self.odriveThread.exit()
-        print("closed threads.")
-        sleep(0.5)
+            # turn magnet off and gracefully lower roboscope, then idle once telemetry shows it arrived
+            panel.shutdown.start(engaged=panel.t.getTopLevelParamValue("Engage Motors"))
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # rigs with a worker process, see worker.py
+
+    if software_gl:  # must be set before the application is created
+        QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_UseSoftwareOpenGL)
 
     if not fbs_mode:  # The normal way to start a PyQt app when Python is installed
         app = QtWidgets.QApplication([])  # Initialize application
@@ -1,3 +1,5 @@
+import time
+import weakref
 import numpy as np
 import pyqtgraph as pg
 from PyQt5.QtCore import QEventLoop, QTimer
@@ -22,6 +24,19 @@ def xy_to_cylindrical(x, y):
     return magnitude, degrees
 
 
+def shortest_angle_delta(current, target):
+    """
+    Signed change in degrees that takes the heading `current` to `target` the short way around the circle.
+    Args:
+        current: heading in degrees, may be unwrapped (outside 0-360)
+        target: heading in degrees
+
+    Returns:
+        delta: the change in degrees, between -180 and 180
+    """
+    return (target - current + 180) % 360 - 180
+
+
 def set_style():
     """ Simply set some config options and themes. """
     pg.setConfigOption('background', 'w')
@@ -42,4 +57,97 @@ def qtsleep(t):
 
 def unit_vector(vector):
     """ Returns the unit vector of the vector.  """
-    return vector / np.linalg.norm(vector)
\ No newline at end of file
+    return vector / np.linalg.norm(vector)
+
+
+class PeriodicLoop:
+    """Drift-free timing for periodic loops, based on absolute time.perf_counter() deadlines.
+
+    Call `wait()` once per iteration. Each deadline is the previous deadline plus one period, so the time spent in the
+    loop body (e.g. USB reads) doesn't stretch the period. If the body overruns a deadline, the next iteration starts
+    right away and the schedule restarts from there instead of bursting to catch up; the missed periods are counted.
+
+    Unlike qtsleep this doesn't spin a nested Qt event loop, so it belongs in worker threads, not the GUI thread.
+
+    Attributes:
+        period (float): loop period [s]
+        name (str): shown in the loop timing report
+        spin_time (float): the last part of each wait polls the clock instead of sleeping, for loops that need better
+            precision than the OS sleep granularity
+        period_achieved (float): smoothed measured period [s]
+        jitter (float): smoothed absolute wake-up error [s]
+        jitter_max (float): largest wake-up error seen [s]
+        overruns (int): iterations that ran past their deadline
+        missed (int): whole loop periods lost to overruns, counted in `period` also when wait() was given another
+            interval
+    """
+    instances = weakref.WeakSet()  # every live loop, for the timing report
+
+    def __init__(self, period, name='', spin_time=0.0, smoothing=0.05):
+        self.period = period
+        self.name = name
+        self.spin_time = spin_time
+        self.smoothing = smoothing
+        self.reset()
+        PeriodicLoop.instances.add(self)
+
+    def reset(self):
+        """Forget the schedule and statistics, the next wait() starts a new schedule."""
+        self.deadline = None
+        self.last_wake = None
+        self.iterations = 0
+        self.period_achieved = self.period
+        self.jitter = 0.0
+        self.jitter_max = 0.0
+        self.overruns = 0
+        self.missed = 0
+
+    def wait(self, interval=None):
+        """Sleep until the next deadline, `interval` seconds after the previous one (default: one period).
+
+        Returns:
+            the time.perf_counter() time of waking up
+        """
+        interval = self.period if interval is None else interval
+        now = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += interval
+
+        if now > self.deadline:
+            self.overruns += 1
+            self.missed += int((now - self.deadline) // self.period)
+            self.deadline = now
+        else:
+            remaining = self.deadline - now
+            if remaining > self.spin_time:
+                time.sleep(remaining - self.spin_time)
+            while time.perf_counter() < self.deadline:
+                pass
+
+        wake = time.perf_counter()
+        error = wake - self.deadline
+        self.jitter += self.smoothing * (abs(error) - self.jitter)
+        self.jitter_max = max(self.jitter_max, abs(error))
+        if self.last_wake is not None:
+            self.period_achieved += self.smoothing * (wake - self.last_wake - self.period_achieved)
+        self.last_wake = wake
+        self.iterations += 1
+        return wake
+
+    def stats(self):
+        """Timing statistics of the loop as a dict."""
+        return {'name': self.name, 'period': self.period, 'period_achieved': self.period_achieved,
+                'jitter': self.jitter, 'jitter_max': self.jitter_max, 'overruns': self.overruns,
+                'missed': self.missed, 'iterations': self.iterations}
+
+
+def loop_timing_report():
+    """One line of timing statistics per live PeriodicLoop."""
+    lines = []
+    for loop in sorted(PeriodicLoop.instances, key=lambda loop: loop.name):
+        s = loop.stats()
+        lines.append(f"{s['name']}: period {s['period'] * 1000:.1f} ms, achieved {s['period_achieved'] * 1000:.2f} ms, "
+                     f"jitter {s['jitter'] * 1000:.2f} ms (max {s['jitter_max'] * 1000:.2f}), "
+                     f"overruns {s['overruns']} ({s['missed']} periods missed)")
+    return '\n'.join(lines)
@@ -3,23 +3,29 @@ from pyqtgraph.parametertree import Parameter, ParameterTree
 import pyqtgraph.parametertree.parameterTypes as pTypes
 from PyQt5.QtCore import Qt
 import numpy as np
-from misc_functions import qtsleep
+from controlstate import ControlState
+from threads import Swarm
+from threads.Swarm import SwarmThread
 
 class MyParamTree(ParameterTree):
     """The parameter tree widget that lives in the bottom of the main window.
 
-    This is where the current parameters of the application live. When a parameter here is changed by ANY method
-    (UI, gamepad, keyboard), this object sends a signal to the MainWindow to get forward to the salient thread/object.
+    The current parameters of the application live in `state`, a ControlState whose subscribers forward every change
+    to the salient thread/object. The tree is a view of it: edits made in the UI are written to the state, and the
+    widgets are refreshed from the state at most `mirror_rate` times a second, so keyboard, gamepad and swarm updates
+    set the state directly and never wait on widget repaints. The convenience methods below all go through the state.
     The values are initialized from the config parameter passed in when instantiating this object.
 
     Attributes:
         params: a nested dictionary which contains the visable and edit-able parameters during program run-time
-        p: the actual parameter tree object that contains the values
+        p: the actual parameter tree object that displays the values
+        state (ControlState): the values themselves
 
     """
-    paramChange = QtCore.pyqtSignal(object, object)  # MyParamTree outputs a signal with param and changes.
+    coordinatedMove = QtCore.pyqtSignal(object)  # Targets for a synchronized multi-axis move, e.g. {'heading': 225}
+    swarmStarted = QtCore.pyqtSignal(str)  # name of the swarm pattern that just started
 
-    def __init__(self, config):
+    def __init__(self, config, mirror_rate=20):
         super().__init__()
         self.r0 = 33.78  # cm
         self.Zlims = (0.0, 27.0)
@@ -28,6 +34,9 @@ class MyParamTree(ParameterTree):
             {'name': 'Engage Motors', 'type': 'bool', 'value': False, 'tip': "Checked = Closed loop control, Unchecked = idle"},
             {'name': 'Control Mode', 'type': 'list', 'values': ['Rolling', "Pointing"], 'value': 'Rolling'},
             {'name': 'Heading Filter Bandwidth', 'type':'float', 'value': 6.0},
+            {'name': 'Adaptive Bandwidth', 'type': 'bool', 'value': False, 'tip': "Adapt the heading filter bandwidth to the rate and size of heading commands"},
+            {'name': 'Thermal Cap', 'type': 'bool', 'value': False, 'tip': "Limit the magnet frequency to what the spinner motor's estimated temperature allows"},
+            {'name': 'Triggered Capture', 'type': 'bool', 'value': False, 'tip': "Save the telemetry around heading jumps, spinner deviations, motor engage/release and swarm starts"},
             ComplexParameter(name='Roboscope Control', Zlims=self.Zlims, rlims=self.rlims, r0 = self.r0),
             {'name': 'Rolling', 'type': 'group', 'children': [
                 {'name': 'Frequency', 'type': 'float', 'value': 0, 'step': 1, 'siPrefix': True, 'suffix': 'Hz'},
@@ -39,6 +48,14 @@ class MyParamTree(ParameterTree):
                 {'name': 'Y', 'type': 'float', 'value': 0, 'step': 0.1},
                 {'name': 'Z', 'type': 'float', 'value': 0, 'step': 0.1},
             ]},
+            {'name': 'Frequency Sweep', 'type': 'group', 'expanded': False, 'children': [
+                {'name': 'Start', 'type': 'float', 'value': 1, 'step': 1, 'suffix': 'Hz'},
+                {'name': 'Stop', 'type': 'float', 'value': 20, 'step': 1, 'suffix': 'Hz'},
+                {'name': 'Step', 'type': 'float', 'value': 1, 'step': 0.5, 'limits': (0.01, 100), 'suffix': 'Hz'},
+                {'name': 'Dwell', 'type': 'float', 'value': 5, 'step': 1, 'limits': (0.1, 600), 'suffix': 's'},
+                {'name': 'Ramp', 'type': 'float', 'value': 0.5, 'step': 0.5, 'limits': (0, 60), 'suffix': 's'},
+                {'name': 'Settle', 'type': 'float', 'value': 1, 'step': 0.5, 'limits': (0, 600), 'suffix': 's', 'tip': "Telemetry from the start of each dwell that is left out of the results"},
+            ]},
             {'name': 'Constants', 'type': 'group', 'children': [
                 {'name': 'Gain', 'type': 'float', 'value': 0, 'step': 0.1}
             ]}
@@ -48,54 +65,93 @@ class MyParamTree(ParameterTree):
         self.p = Parameter.create(name='self.params', type='group', children=self.params)
         self.setParameters(self.p, showTop=False)
 
-        self.p.sigTreeStateChanged.connect(self.sendChange)  # When the params change, send to method to emit.
+        self.p.sigTreeStateChanged.connect(self.sendChange)  # When the params are edited, send them to the state.
+
+        # The state holds every value of the tree, with the same limits and the Z/r coupling of ComplexParameter
+        values, limits = {}, {}
+        for param in self.leaves(self.p):
+            path = tuple(self.p.childPath(param))
+            values[path] = param.value()
+            if param.type() in ('float', 'int') and param.opts.get('limits') is not None:
+                limits[path] = tuple(param.opts['limits'])
+        self.state = ControlState(values, limits)
+        self.state.couple(('Roboscope Control', 'Z'), ('Roboscope Control', 'r'),
+                          lambda Z: self.r0 - Z, lambda r: self.r0 - r)
+
+        # Refresh the widgets from the state at a capped rate
+        self.mirroring = False  # set while the widgets are being refreshed, so those changes aren't sent back
+        self.mirror_timer = QtCore.QTimer()
+        self.mirror_timer.timeout.connect(self.mirror)
+        self.mirror_timer.start(int(1000 / mirror_rate))
 
         # Connect keyPresses
         self.setFocusPolicy(Qt.NoFocus)
 
-        self.running_explode = False
+        self.swarm = None  # SwarmThread running a swarm pattern, or finishing its last step after being stopped
+        self.next_pattern = None  # toggled on while the previous pattern was finishing, starts once it is done
+
+    @staticmethod
+    def leaves(param):
+        """Every parameter under `param` that holds a value, i.e. everything but plain groups."""
+        for child in param.children():
+            if child.type() != 'group':
+                yield child
+            yield from MyParamTree.leaves(child)
 
     def sendChange(self, param, changes):
-        self.paramChange.emit(param, changes)
+        """Write the values edited in the UI to the state."""
+        if self.mirroring:
+            return
+        for param, change, data in changes:
+            if change == 'value':
+                self.state.set(self.p.childPath(param), data)
+
+    def mirror(self):
+        """Refresh the widgets with the values that changed in the state since the last refresh."""
+        dirty = self.state.take_dirty()
+        if not dirty:
+            return
+        self.mirroring = True
+        try:
+            for path, value in dirty.items():
+                self.p.param(*path).setValue(value)
+        finally:
+            self.mirroring = False
 
     # Convenience methods for modifying parameter values.
     def getParamValue(self, child, branch='Rolling'):
         """Get the current value of a parameter."""
-        return self.p.param(branch, child).value()
+        return self.state.get((branch, child))
 
     def getTopLevelParamValue(self, name):
         """Get the current value of a top level parameter"""
-        return self.p.param(name).value()
+        return self.state.get((name,))
 
     def setTopLevelParamValue(self, name, value):
         """Set value of a top level parameter"""
-        return self.p.param(name).setValue(value)
+        return self.state.set((name,), value)
 
     def setParamValue(self, child, value, branch='Rolling'):
         """Set the current value of a parameter."""
-        return self.p.param(branch, child).setValue(value)
+        return self.state.set((branch, child), value)
 
     def stepParamValue(self, child, delta, limits=None, branch='Rolling'):
         """Change a parameter by a delta. Can be negative or positive."""
+        curVal = self.getParamValue(child, branch)
+        newVal = curVal + delta
         if limits is not None:
-            param = self.p.param(branch, child)
-            curVal = param.value()
-            newVal = curVal + delta
             if (newVal < limits[1]) & (newVal > limits[0]):
-                return param.setValue(newVal)
+                return self.setParamValue(child, newVal, branch)
             elif newVal >= limits[1]:
                 print(f"{newVal} is greater than {limits[1]}")
-                return param.setValue(limits[1])
+                return self.setParamValue(child, limits[1], branch)
             elif newVal <= limits[0]:
                 print(f"{newVal} is less than {limits[0]}")
-                return param.setValue(limits[0])
+                return self.setParamValue(child, limits[0], branch)
             else:
                 print(f"this shouldn't happen, newVal={newVal}, limits={limits}")
         else:
-            param = self.p.param(branch, child)
-            curVal = param.value()
-            newVal = curVal + delta
-            return param.setValue(newVal)
+            return self.setParamValue(child, newVal, branch)
 
     def on_key(self, key):
         """ On a keypress on the plot widget, forward the keypress to the correct function below."""
@@ -139,6 +195,8 @@ class MyParamTree(ParameterTree):
         self.stepParamValue('Frequency', -1)
 
     def Key_B(self):  # also controller B
+        # Move both axes together so the field doesn't pass through unintended poses, then show the targets
+        self.coordinatedMove.emit({'heading': 225, 'z': self.r0 - 8.3})
         self.setParamValue('Heading', 225)
         self.setParamValue('r', 8.3, branch="Roboscope Control")
 
@@ -159,146 +217,58 @@ class MyParamTree(ParameterTree):
     def Key_T(self):
         """Toggles the toggle value"""
         # TODO Change so getParamValue can access the top level parameters.
-        cur = self.p.param("Engage Motors").value()
+        cur = self.getTopLevelParamValue("Engage Motors")
 
         set = not cur
 
-        self.p.param("Engage Motors").setValue(set)
+        self.setTopLevelParamValue("Engage Motors", set)
 
     def Key_U(self):  # also start
         #self.setParamValue('Heading', 225)
         self.setParamValue("Z", 0.2, branch="Roboscope Control")
 
-    def explode(self):
-        """Explode the wheel by applying an orthogonal camber angle briefly."""
-        camber = self.getParamValue("Camber")
-        heading = self.getParamValue('Heading')
-        ortho = camber - 90
-        time = 0.2  # default 0.2
-
-        # Tilt
-        self.setParamValue('Camber', ortho)
-        if np.abs(ortho) > 91:
-            self.setParamValue('Heading', (heading - 180) % 360)
+    def toggle_pattern(self, pattern):
+        """Start a swarm pattern from threads/Swarm.py on its own thread, or stop the one that is running.
 
-        qtsleep(time)  # sleep using PyQt5
+        A stopped pattern finishes its step and resets its parameters first. A pattern toggled on in the meantime
+        starts once that is done, so two patterns never run at once.
+        """
+        if self.swarm is not None and self.swarm.isRunning():
+            if self.swarm.running:
+                self.swarm.running = False
+                self.next_pattern = None
+            else:  # still finishing, toggle the pattern that follows it
+                self.next_pattern = pattern if self.next_pattern is None else None
+            return
+        self.start_pattern(pattern)
 
+    def start_pattern(self, pattern):
+        self.swarm = SwarmThread(pattern, self.state)
+        self.swarm.finished.connect(self.on_pattern_finished)
+        self.swarm.start()
+        self.swarm.setPriority(QtCore.QThread.HighPriority)
+        self.swarmStarted.emit(pattern.__name__)
 
-        # Reset
-        self.setParamValue('Camber', camber)
-        if np.abs(ortho) > 91:
-            self.setParamValue('Heading', heading)
+    def on_pattern_finished(self):
+        """Start the pattern that was toggled on while the previous one was finishing."""
+        if self.next_pattern is not None:
+            pattern, self.next_pattern = self.next_pattern, None
+            self.start_pattern(pattern)
 
     def toggle_explode(self):
-        time_between_explodes = 0.5  # default 0.5
-        self.running_explode = not self.running_explode
-        while self.running_explode:
-            self.explode()
-
-            qtsleep(time_between_explodes)  # wait
-
-
-    def switchback(self, time, driving_heading, wiggle_angle):
-        """Switchback swarm execution code.
-
-        Args:
-            time (float): time constant between each turn
-            driving_heading (int): uphill direction, overall movement direction
-            wiggle_angle (int): deviation from centerline, determines angle of switchbacks
-        """
-        
-        # turn left
-        new_heading_1 = (driving_heading - wiggle_angle) % 360
-        self.setParamValue('Heading', new_heading_1)
-        qtsleep(time)  # sleep using PyQt5
-
-        # turn right
-        new_heading_2 = (driving_heading + wiggle_angle) % 360
-        self.setParamValue('Heading', new_heading_2)
-        qtsleep(time)
+        self.toggle_pattern(Swarm.flipping)
 
     def toggle_switchback(self):
         """Toggle the switchback field."""
-        time_between_turn = 0.2
-        wiggle_angle = 35
-
-        self.running_explode = not self.running_explode
-        driving_heading = self.getParamValue('Heading')
-        while self.running_explode:
-            self.switchback(time_between_turn, driving_heading, wiggle_angle)
-
-            # After running climb at least once, the wheel is currently in `right` formation. To update the driving heading, we'll
-            # read what it is now, and subtract the wiggle angle.
-            # driving_heading = (self.getParamValue('Heading') - wiggle_angle) % 360
-
-            # If there has been a change to the Heading from the user, update the driving heading.
-            if driving_heading != (self.getParamValue('Heading') - wiggle_angle) % 360:
-                driving_heading = self.getParamValue('Heading')
-
-        # reset back to original heading
-        self.setParamValue('Heading', driving_heading)
-
-
-    def my_corkscrew(self):
-        """My version of the corkscrew motion, described in signal_sandbox notebook."""
-        print('running corkscrew')
-        z_start = self.getParamValue('Heading')
-        camber = self.getParamValue('Camber')
-        camber_max = 70
-        total_steps = 10  # Must be an even number
-        camber_half_steps = (camber_max - camber) / (total_steps // 2)
-
-        total_time = 1.0
-        step_time = total_time / total_steps
-        alpha = 0.4
-        beta = total_time - alpha
-        a = 360 / (2 * beta + alpha)
-
-        time = np.linspace(0, total_time, num=total_steps)
-
-        for seconds in time:  
-            # Calculate z_phase given current time
-            if seconds <= alpha:
-                z_phase = a * seconds + z_start
-            elif seconds > alpha:
-                z_phase = 2 * a * seconds - a * alpha + z_start
-            else:
-                print('Something went terribly wrong with the corkscrew code.')
-
-            # Calculate camber angle
-            if seconds <= total_time / 2: # first half of time steps, bow down camber
-                camber += camber_half_steps
-            elif seconds > total_time / 2: # second half, rise up
-                camber -= camber_half_steps
-
-            print(z_phase)
-            print(camber)
-            self.setParamValue('Heading', z_phase % 360)  # set Heading
-            self.setParamValue('Camber', camber)  # set camber
-
-            # Wait
-            qtsleep(step_time)
+        self.toggle_pattern(Swarm.switchback)
 
     def toggle_my_corkscrew(self):
-        time_between_explodes = 0.01
-        self.running_explode = not self.running_explode
-        while self.running_explode:
-            self.my_corkscrew()
-            
-            qtsleep(time_between_explodes)  # wait
+        self.toggle_pattern(Swarm.corkscrew)
 
-        
     def toggle_swarm(self):
         swarm = self.getParamValue('Swarm Mode')
-
-        if swarm == 'Corkscrew':
-            self.toggle_my_corkscrew()
-        elif swarm == 'Flipping':
-            self.toggle_explode()
-        elif swarm == 'Switchback':
-            self.toggle_switchback()
-        elif swarm == 'Rolling':
-            return
+        if swarm in Swarm.PATTERNS:
+            self.toggle_pattern(Swarm.PATTERNS[swarm])
 
     def set_heading_offset(self):
         self.setParamValue("Heading Offset", branch="Constants")
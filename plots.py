@@ -1,15 +1,19 @@
 import pyqtgraph as pg
-from pyqtgraph.Qt import QtCore
+from pyqtgraph.Qt import QtCore, QtWidgets
 import numpy as np
-import pyqtgraph.opengl as gl
+from time import perf_counter
+try:
+    import pyqtgraph.opengl as gl
+except ImportError:  # PyOpenGL is missing, OrientationView falls back to a 2D view
+    gl = None
 
 
 class SignalPlot(pg.PlotWidget):
-    """
+    """ Scrolling plot of a measured signal, optionally overlaid with its commanded value as a dashed curve.
     """
     keyPressed = QtCore.pyqtSignal(object)
 
-    def __init__(self, curve_colors = ['b', 'g', 'r']):
+    def __init__(self, curve_colors = ['b', 'g', 'r'], command_color=None):
         super().__init__()
         self.line_width = 4
         self.curve_colors = curve_colors
@@ -23,6 +27,11 @@ class SignalPlot(pg.PlotWidget):
         # Set up curves
         self.data = np.zeros(100)
         self.curve = self.plot(self.data, pen=self.pens[0], clear=False)
+        self.command = np.zeros(100)
+        self.command_curve = None
+        if command_color is not None:
+            self.command_curve = self.plot(self.command, clear=False,
+                                           pen=pg.mkPen(command_color, width=2, style=QtCore.Qt.DashLine))
 
 
     def keyPressEvent(self, event):
@@ -30,13 +39,34 @@ class SignalPlot(pg.PlotWidget):
         super().keyPressEvent(event)
         self.keyPressed.emit(event.key())
 
-    def on_new_data_update_plot(self, incomingData):
-        """ Update plot."""
-
-        self.data[:-1] = self.data[1:]  # shift data in the array one sample left
-                                          # (see also: np.roll)
-        self.data[-1] = incomingData  # update last point
+    @staticmethod
+    def shift_in(buffer, incomingData):
+        """ Shift a sample or a batch of samples into the end of a buffer."""
+        n = np.size(incomingData)  # a single sample, or a batch of them
+        if n >= buffer.size:
+            buffer[:] = incomingData[-buffer.size:]
+        else:
+            buffer[:-n] = buffer[n:]  # shift data in the array n samples left
+                                      # (see also: np.roll)
+            buffer[-n:] = incomingData  # update last points
+
+    def on_new_data_update_plot(self, incomingData, commanded=None):
+        """ Update plot with a sample or a batch of samples, and their commanded values if given. Plots in hidden rig
+        tabs only buffer the data, so extra rigs don't cost repaint time."""
+        self.shift_in(self.data, incomingData)
+        if commanded is not None:
+            self.shift_in(self.command, commanded)
+        if self.isVisible():
+            self.curve.setData(self.data, clear=False)
+            if self.command_curve is not None:
+                self.command_curve.setData(self.command, clear=False)
+
+    def showEvent(self, event):
+        """ Catch up on the data buffered while the plot was hidden."""
+        super().showEvent(event)
         self.curve.setData(self.data, clear=False)
+        if self.command_curve is not None:
+            self.command_curve.setData(self.command, clear=False)
 
 
         # for i in range(0, np.size(incomingData)):  # For each entry in incomingData
@@ -91,3 +121,110 @@ class MultiSignalPlot(pg.PlotWidget):
         #     # Plot each value
         #     self.plot(incomingData, clear=False, pen=self.pens[i])
 
+
+class OrientationView(QtWidgets.QWidget):
+    """3D view of the magnet: its position above the workspace, the heading, the rotation plane and the field direction.
+
+    The magnet sits r = r0 - Z cm above the workspace. The field rotates in the vertical plane through the heading
+    direction, and its direction is drawn at the magnet phase from the rig's MagnetPhaseEstimator. Telemetry only
+    stores the latest pose with `set_pose`; a timer redraws at most `max_fps` times a second while the view is
+    showing, so the cost doesn't grow with the telemetry rate. The vertex arrays are allocated once and rewritten in
+    place every frame.
+
+    Without PyOpenGL the view falls back to a 2D side view of the rotation plane. On machines without a GPU, start
+    the app with the software_gl switch in main.py to render with Qt's software OpenGL.
+
+    Attributes:
+        r0 (float): magnet distance to the workspace at Z = 0 [cm]
+        phase_estimator: MagnetPhaseEstimator of the rig, or None to draw the field at phase 0
+        radius (float): drawn radius of the rotation plane [cm]
+    """
+
+    def __init__(self, r0, phase_estimator=None, max_fps=30, radius=5.0, circle_points=64):
+        super().__init__()
+        self.r0 = r0
+        self.phase_estimator = phase_estimator
+        self.radius = radius
+        self.heading = None
+        self.r = r0
+
+        # Vertex arrays, rewritten in place every frame
+        angles = np.linspace(0, 2 * np.pi, circle_points)
+        self.cos_table, self.sin_table = np.cos(angles), np.sin(angles)
+        self.magnet = np.zeros((1, 3))
+        self.circle = np.zeros((circle_points, 3))
+        self.arrow = np.zeros((2, 3))
+        self.heading_line = np.zeros((2, 3))
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+        if gl is not None:
+            self.initGL(layout)
+        else:
+            self.init2D(layout)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(int(1000 / max_fps))
+
+    def initGL(self, layout):
+        self.view = gl.GLViewWidget()
+        self.view.setCameraPosition(distance=3 * self.r0, elevation=20)
+        self.view.opts['center'] = pg.Vector(0, 0, self.r0 / 2)
+        grid = gl.GLGridItem()
+        grid.setSize(40, 40)
+        grid.setSpacing(5, 5)
+        self.view.addItem(grid)
+        self.heading_item = gl.GLLinePlotItem(pos=self.heading_line, color=(1, 0, 0, 1), width=3)
+        self.circle_item = gl.GLLinePlotItem(pos=self.circle, color=(0, 0, 1, 1), width=2)
+        self.arrow_item = gl.GLLinePlotItem(pos=self.arrow, color=(1, 0.6, 0, 1), width=4)
+        self.magnet_item = gl.GLScatterPlotItem(pos=self.magnet, color=(0.5, 0.5, 0.5, 1), size=15)
+        for item in (self.heading_item, self.circle_item, self.arrow_item, self.magnet_item):
+            self.view.addItem(item)
+        layout.addWidget(self.view)
+
+    def init2D(self, layout):
+        self.view = pg.PlotWidget()
+        self.view.setAspectLocked(True)
+        self.view.setXRange(-2 * self.radius, 2 * self.radius)
+        self.view.setYRange(0, self.r0 + self.radius)
+        self.view.setLabel('bottom', 'along heading (cm)')
+        self.view.setLabel('left', 'height (cm)')
+        self.circle_x = self.cos_table * self.radius  # the side view of the rotation plane doesn't change width
+        self.circle_item = self.view.plot(pen=pg.mkPen('b', width=2))
+        self.arrow_item = self.view.plot(pen=pg.mkPen((255, 150, 0), width=4))
+        layout.addWidget(self.view)
+
+    def set_pose(self, heading, z):
+        """Latest heading [deg] and roboscope Z [cm], drawn on the next frame."""
+        self.heading = heading
+        self.r = self.r0 - z
+
+    def refresh(self):
+        """Redraw with the latest pose and phase, if the view is showing."""
+        if self.heading is None or not self.isVisible():
+            return
+        phase = None if self.phase_estimator is None else self.phase_estimator.phase_at(perf_counter())
+        phase = np.radians(phase or 0.0)
+        h = np.radians(self.heading)
+        hx, hy = np.cos(h), np.sin(h)
+
+        self.magnet[0] = (0, 0, self.r)
+        self.heading_line[1] = (2 * self.radius * hx, 2 * self.radius * hy, 0)
+        np.multiply(self.cos_table, self.radius * hx, out=self.circle[:, 0])
+        np.multiply(self.cos_table, self.radius * hy, out=self.circle[:, 1])
+        np.multiply(self.sin_table, self.radius, out=self.circle[:, 2])
+        self.circle[:, 2] += self.r
+        self.arrow[0] = self.magnet[0]
+        self.arrow[1] = (self.radius * np.cos(phase) * hx, self.radius * np.cos(phase) * hy,
+                         self.r + self.radius * np.sin(phase))
+
+        if gl is not None:
+            self.heading_item.setData(pos=self.heading_line)
+            self.circle_item.setData(pos=self.circle)
+            self.arrow_item.setData(pos=self.arrow)
+            self.magnet_item.setData(pos=self.magnet)
+        else:  # side view of the rotation plane, the horizontal axis points along the heading
+            self.circle_item.setData(self.circle_x, self.circle[:, 2])
+            self.arrow_item.setData([0, self.radius * np.cos(phase)], self.arrow[:, 2])
@@ -0,0 +1,148 @@
+import linecache
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pyqtgraph.Qt import QtCore
+from misc_functions import PeriodicLoop
+
+
+# Calls that block a thread without using the CPU: sleeping, waiting on locks, events and queues, and event loops
+BLOCKING_CALLS = frozenset(('sleep', 'wait', 'acquire', 'exec_', 'exec', 'join', 'select', 'poll', 'recv',
+                            'recv_bytes', 'accept'))
+CALL = re.compile(r'(\w+)\s*\(')
+
+
+class SamplingProfiler(QtCore.QThread):
+    """Low-overhead stack sampling profiler for every Python thread of the application.
+
+    While running it snapshots the stack of every thread with sys._current_frames() at a fixed interval and counts
+    identical stacks, so the profiled code isn't instrumented or slowed down beyond the occasional snapshot. Samples
+    are attributed to threads by name: the GUI thread, Python threads by their thread name, and QThreads by the class
+    whose run() is at the bottom of the stack (ODriveController, DataRetriever, ControllerThread, SwarmThread, ...).
+
+    Most threads spend most of their time blocked (waiting for the next period, a queue, a board transaction or the
+    Qt event loop), which would otherwise make up most of the samples. So every sample is weighted by the CPU time
+    its thread used since the previous sample, from the thread's CPU clock (time.pthread_getcpuclockid). Where there
+    is none (Windows), a sample counts as one interval of CPU time unless the thread is blocked, i.e. the line its
+    innermost Python frame is on calls one of BLOCKING_CALLS.
+
+    `save` writes the stacks in the collapsed stack format ("thread;outer;...;inner weight" per line, the weight in
+    µs of CPU time) read by flamegraph.pl, speedscope and similar flame graph viewers.
+
+    Attributes:
+        interval (float): time between samples [s]
+        stacks (Counter): CPU time per (thread, frame, ...) stack, outermost frame first [s]
+        samples (int): stack snapshots taken, including those of blocked threads
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__()
+        self.interval = interval
+        self.running = False
+        self.stacks = Counter()
+        self.samples = 0
+        self.labels = {}  # frame label per code object
+        self.thread_names = {}  # thread name per (thread id, code object at the bottom of its stack)
+        self.blocking = {}  # whether a line calls one of BLOCKING_CALLS, per (code object, line number)
+        self.cpu_times = {}  # CPU time of each thread at its previous sample [s]
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        self.stacks = Counter()
+        self.samples = 0
+        self.cpu_times = {}
+        own = threading.get_ident()
+        loop = PeriodicLoop(self.interval, name='Profiler')
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.sample(ident, frame)
+            loop.wait()
+
+    def sample(self, ident, frame):
+        """Add the CPU time of the thread to the stack that `frame` is the innermost frame of."""
+        self.samples += 1
+        weight = self.cpu_time_used(ident)
+        if weight is None:  # no CPU clock
+            weight = 0.0 if self.is_blocked(frame) else self.interval
+        if weight <= 0.0:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = self.labels.get(code)
+            if label is None:
+                label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            stack.append(label)
+            root = frame
+            frame = frame.f_back
+        stack.append(self.thread_name(ident, root))
+        stack.reverse()
+        self.stacks[tuple(stack)] += weight
+
+    def cpu_time_used(self, ident):
+        """CPU time the thread used since its previous sample [s], or None without a CPU clock for it."""
+        try:
+            now = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):  # not on this platform, or the thread just ended
+            return None
+        previous = self.cpu_times.get(ident, now)
+        self.cpu_times[ident] = now
+        return max(0.0, now - previous)
+
+    def is_blocked(self, frame):
+        """Whether the line the innermost Python frame is on calls one of BLOCKING_CALLS."""
+        key = (frame.f_code, frame.f_lineno)
+        blocked = self.blocking.get(key)
+        if blocked is None:
+            line = linecache.getline(frame.f_code.co_filename, frame.f_lineno)
+            blocked = self.blocking[key] = any(call in BLOCKING_CALLS for call in CALL.findall(line))
+        return blocked
+
+    def thread_name(self, ident, root):
+        """Name of the thread with id `ident`, whose outermost frame is `root`."""
+        key = (ident, root.f_code)
+        name = self.thread_names.get(key)
+        if name is None:
+            if ident == threading.main_thread().ident:
+                name = 'GUI'
+            elif ident in threading._active:
+                name = threading._active[ident].name
+            elif root.f_code.co_name == 'run' and 'self' in root.f_locals:
+                name = type(root.f_locals['self']).__name__
+            else:
+                name = f"Thread {ident}"
+            self.thread_names[key] = name
+        return name
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def save(self, filename):
+        """Write the collapsed stacks for a flame graph, weighted in µs of CPU time."""
+        with open(filename, 'w') as f:
+            for stack, cpu in self.stacks.most_common():
+                if round(cpu * 1e6) > 0:
+                    f.write(f"{';'.join(stack)} {round(cpu * 1e6)}\n")
+        print(f"Saved {sum(self.stacks.values()) * 1000:.0f} ms of CPU time in {self.samples} profiler samples to "
+              f"{filename}")
+
+    def summary(self, top=5):
+        """CPU time per thread and each thread's functions with the most CPU time at the top of the stack."""
+        total = sum(self.stacks.values())
+        threads, functions = Counter(), {}
+        for stack, cpu in self.stacks.items():
+            threads[stack[0]] += cpu
+            functions.setdefault(stack[0], Counter())[stack[-1]] += cpu
+
+        lines = [f"{total * 1000:.0f} ms of CPU time in {self.samples} samples at {1 / self.interval:.0f} Hz"]
+        for name, cpu in threads.most_common():
+            lines.append(f"{name}: {cpu * 1000:.0f} ms CPU ({cpu / total * 100:.1f}%)")
+            for function, t in functions[name].most_common(top):
+                lines.append(f"    {t / cpu * 100:5.1f}%  {function}")
+        return '\n'.join(lines)
@@ -0,0 +1,473 @@
+import numpy as np
+from pyqtgraph.Qt import QtCore, QtWidgets
+import pyqtgraph as pg
+
+from threads.ODriveController import ODriveController
+from parametertree import MyParamTree
+from plots import SignalPlot, OrientationView
+from telemetry import LagEstimator
+from shutdown import ShutdownSequence
+from macros import MacroRecorder, MacroPlayer
+from threads.DataGenerator import Generator
+from worker import ControllerProcess
+from threads.FrequencySweep import FrequencySweep
+from thermal import ThermalModel
+from capture import TriggeredCapture, StepTrigger, DeviationTrigger
+from telemetry import HEADING_CMD, SPINNER, SPINNER_CMD
+
+
+class RigPanel(QtWidgets.QWidget):
+    """ Everything that belongs to one actuator rig: its plots, its Parameter Tree and its ODriveController.
+
+    The main window holds one RigPanel per entry in rigs.RIGS, each in its own tab. This class serves as the "middle
+    man" between the Parameter Tree and the rig's controller thread, and passes the controller's telemetry to the plots.
+
+    Attributes:
+        rig: the rig's entry in rigs.RIGS
+        odriveThread: the ODriveController worker for this rig, or its worker.ControllerProcess client when the rig
+            runs its controller in a separate process
+        t: the rig's Parameter Tree
+        latest (dict): the most recent telemetry value of every channel, for the overview across rigs
+        connected (bool): set once the controller has found and configured the boards, until then the Parameter Tree
+            is disabled and keyboard and gamepad input is ignored
+        thermal (ThermalModel): spinner motor temperature estimate from the telemetry current, which caps the
+            Frequency when "Thermal Cap" is checked
+        capture (TriggeredCapture): saves the telemetry around events to captures/ while "Triggered Capture" is
+            checked
+    """
+
+    headingDeferred = QtCore.pyqtSignal(int)  # delay [ms] of the heading update held back by the 0.1 s throttle
+    releaseRequested = QtCore.pyqtSignal()  # "Engage Motors" was unchecked, warn and then idle
+
+    def __init__(self, rig, config, simulate=False, load_test=None):
+        super().__init__()
+        self.rig = rig
+        self.config = config
+        self.latest = {'heading': None, 'z': None, 'spinner': None}
+
+        # Delay to avoid constantly sending updates to odrive controller. The latest of the skipped heading changes is
+        # sent once the delay is over, by a timer that is started in the GUI thread whichever thread made the change.
+        self.last_update = 0.2
+        self.heading_timer = QtCore.QTimer()
+        self.heading_timer.setSingleShot(True)
+        self.heading_timer.timeout.connect(self.send_heading)
+        self.headingDeferred.connect(self.heading_timer.start)
+
+        # The warning before releasing the motors is a modal dialog. It is shown from the event loop rather than from
+        # change, which runs with the ControlState's dispatch lock held and would block every other thread's changes.
+        self.releaseRequested.connect(self.release_motors, QtCore.Qt.QueuedConnection)
+
+        # Set when the watchdog has already idled the motors, so unchecking "Engage Motors" skips the warning
+        self.watchdog_tripped = False
+
+        # Operator input record and replay
+        self.recorder = MacroRecorder()
+        self.player = None
+
+        self.generator = None  # synthetic telemetry source when load testing
+        self.sweep = None  # running FrequencySweep
+        self.connected = False
+        self.thermal = ThermalModel()
+
+        self.initUI()
+        self.initThreads(simulate, load_test)
+
+        self.p1.keyPressed.connect(self.on_key)  # Connect keyPresses on signal plot to Param Tree
+
+    def initUI(self):
+        """Instantiate the rig's widgets and arrange them in a grid."""
+        layout = QtWidgets.QGridLayout()  # All the widgets will be in a grid in the panel
+        self.setLayout(layout)  # set the layout
+
+        # Instantiate the plots from plots.py, measured (solid) and commanded (dashed)
+        self.p1 = SignalPlot(curve_colors=['r'], command_color='k')  # heading
+        self.p1.setYRange(0, 360)
+        self.p2 = SignalPlot(curve_colors=['g'], command_color='k')  # roboscope
+        self.p2.setYRange(0, 30)
+        self.p3 = SignalPlot(curve_colors=['b'], command_color='k')  # spinner
+        self.p3.setYRange(0, 30)
+
+        # Create plot labels
+        self.p1lbl = QtWidgets.QLabel('<b><u>Heading Angle</u></b>')
+        self.p2lbl = QtWidgets.QLabel('<b><u>Roboscope Z (cm)</u></b>')
+        self.p3lbl = QtWidgets.QLabel('<b><u>Magnet Rotation Frequency</u></b>')
+
+        # Command to response delay of each plot's axis, shown in its label a few times a second
+        self.lags = [(self.p1lbl, 'Heading Angle', LagEstimator(angular=True)),
+                     (self.p2lbl, 'Roboscope Z (cm)', LagEstimator()),
+                     (self.p3lbl, 'Magnet Rotation Frequency', LagEstimator())]
+        self.lag_timer = QtCore.QTimer()
+        self.lag_timer.timeout.connect(self.update_lags)
+        self.lag_timer.start(250)
+        self.p4lbl = QtWidgets.QLabel('<b><u>Magnet Orientation</u></b>')
+
+        # Spinner motor thermal budget, refreshed once a second
+        self.thermallbl = QtWidgets.QLabel()
+        self.thermal_timer = QtCore.QTimer()
+        self.thermal_timer.timeout.connect(self.update_thermal)
+        self.thermal_timer.start(1000)
+
+        # Parameter Tree widget
+        self.t = MyParamTree(self.config)  # From ParameterTree.py
+        self.t.state.subscribe(self.change)  # Every change of the rig's control values goes to change
+        self.t.coordinatedMove.connect(lambda targets: self.odriveThread.coordinated_move(**targets))
+        self.t.swarmStarted.connect(lambda name: self.capture.fire(f"swarm {name}"))
+
+        # 3D view of the magnet pose, its phase source is connected in initThreads
+        self.orientation = OrientationView(self.t.r0)
+
+        # Add widgets to the layout in their proper positions
+        layout.addWidget(self.p1lbl, 0, 0)
+        layout.addWidget(self.p2lbl, 0, 1)
+        layout.addWidget(self.p3lbl, 0, 2)
+        layout.addWidget(self.p1, 1, 0)
+        layout.addWidget(self.p2, 1, 1)
+        layout.addWidget(self.p3, 1, 2)
+        layout.addWidget(self.p4lbl, 0, 3)
+        layout.addWidget(self.orientation, 1, 3)
+        layout.addWidget(self.thermallbl, 2, 0, 1, 4)
+        layout.addWidget(self.t, 3, 0, 1, 4)  # row, col, rowspan, colspan
+
+    def initThreads(self, simulate, load_test=None):
+        """Create and start the rig's ODriveController. Input is enabled when it reports the boards are connected.
+
+        Args:
+            simulate (bool): drive the simulated ODrives in sim_odrive.py
+            load_test (dict): if given, the plots are fed by the synthetic load generator instead of the controller,
+                with the Generator keyword arguments in this dict (rate, batch, ...)
+        """
+        attributes = {'home_on_connect': self.rig.get('home_on_connect', False)}
+        if self.rig.get('process'):
+            self.odriveThread = ControllerProcess(simulate=simulate, drv1_serial=self.rig['drv1_serial'],
+                                                  drv2_serial=self.rig['drv2_serial'], attributes=attributes)
+        else:
+            self.odriveThread = ODriveController(simulate=simulate, drv1_serial=self.rig['drv1_serial'],
+                                                 drv2_serial=self.rig['drv2_serial'])
+            for name, value in attributes.items():
+                setattr(self.odriveThread, name, value)
+        if load_test is None:
+            source = self.odriveThread
+        else:
+            self.generator = Generator(**load_test)
+            self.generator.newBatch.connect(self.generator.ack)  # queued after the plot updates of the same batch
+            self.generator.start()
+            source = self.generator
+        source.newTelemetry.connect(self.on_telemetry)
+        self.telemetry_source = source
+        self.odriveThread.watchdog.zlims = self.t.Zlims
+        self.odriveThread.watchdog.tripped.connect(self.on_watchdog_trip)
+        self.odriveThread.connected.connect(self.on_connected)
+        self.odriveThread.homed.connect(self.on_homed)
+        self.odriveThread.ioError.connect(self.on_io_error)
+        self.orientation.phase_estimator = self.odriveThread.phase_estimator
+
+        # Telemetry around heading jumps and the spinner falling behind, events are fired from change and swarmStarted
+        period = 1 / load_test['rate'] if load_test is not None else self.odriveThread.telemetry_period
+        self.capture = TriggeredCapture(period, prefix=self.rig['name'], triggers=[
+            StepTrigger(HEADING_CMD, 20, angular=True, name='heading jump'),
+            DeviationTrigger(SPINNER, SPINNER_CMD, 1.0, hold=int(np.ceil(0.5 / period)), name='spinner deviation')])
+        self.capture.enabled = self.t.getTopLevelParamValue("Triggered Capture")
+        self.capture.writer.start()
+        self.t.setEnabled(False)
+        self.odriveThread.start()
+
+        # Parks the actuator when the window is closed
+        self.shutdown = ShutdownSequence(self.odriveThread)
+
+    def on_connected(self):
+        """The controller found and configured the boards, accept input from now on."""
+        self.connected = True
+        self.t.setEnabled(True)
+        print(f"{self.rig['name']} connected.")
+
+    def on_key(self, key):
+        if self.accepts_input():
+            self.t.on_key(key)
+
+    def on_gamepad_event(self, gamepadEvent):
+        if self.accepts_input():
+            self.t.on_gamepad_event(gamepadEvent)
+
+    def accepts_input(self):
+        """Whether keyboard and gamepad input is handled.
+
+        It is ignored until the boards are connected and while the roboscope is homed, like the Parameter Tree, which
+        is disabled then.
+        """
+        return self.connected and not self.odriveThread.homing_in_progress
+
+    def change(self, path, data):
+        """Forwards the value changes of the rig's ControlState to the controller.
+
+        When a parameter is changed by the UI, keyboard, gamepad, a swarm pattern or a macro, the ControlState calls
+        this method with the parameter's path and new value, in the thread that made the change. This method uses if
+        statements to filter the corresponding value changes and send them to their proper places.
+
+        Args:
+            path: path of the parameter being changed in the Parameter Tree, e.g. ('Rolling', 'Heading')
+            data: the new value
+
+        """
+        self.recorder.record(path, data)
+
+        # Logic for sending changes to the odriveThread
+        # Top branch parameters
+        if path[0] == 'Engage Motors':
+            self.capture.fire(f"Engage Motors {'on' if data else 'off'}")
+            self.toggle_control(data)
+
+        elif path[0] == 'Control Mode':
+            if data == 'Rolling':
+                self.odriveThread.mode = "Rolling"
+                # Update with current parameter tree vals
+                self.odriveThread.f = self.t.getParamValue("Frequency")
+                self.odriveThread.h = self.t.getParamValue("Heading")
+
+            elif data == 'Pointing':
+                self.odriveThread.mode = "Pointing"
+                print("This functionality doesn't exist yet!")
+
+        elif path[0] == 'Heading Filter Bandwidth':
+            self.odriveThread.set_heading_filter_bandwidth(data)
+
+        elif path[0] == 'Adaptive Bandwidth':
+            self.odriveThread.set_adaptive_heading_bandwidth(data)
+
+        elif path[0] == 'Frequency Sweep':
+            pass  # read when a sweep is started
+
+        elif path[0] == 'Thermal Cap':
+            pass  # applied by update_thermal, once a second
+
+        elif path[0] == 'Triggered Capture':
+            self.capture.enabled = data
+
+        elif path[0] == 'Constants':
+            if path[1] == 'Gain':
+                print("Functionality does not exist yet.")
+                #self.odriveThread.heading_pos_offset = data
+
+        elif path[0] == 'Roboscope Control':
+            if path[1] == 'Z':
+                self.odriveThread.z = data
+                # homing ends by moving to the latest Z, and a coordinated move sends it when it is done
+                if not self.odriveThread.homing_in_progress and not self.odriveThread.move_in_progress:
+                    self.odriveThread.update_roboscope()
+
+        # Dumb Rolling
+        elif (path[1] == 'Frequency'):
+            self.odriveThread.f = data
+            self.odriveThread.update_magnet_rotation_rate()
+
+        elif (path[1] == 'Camber') & (self.odriveThread.mode == "Rolling"):
+            print("no camber functionality yet.")
+
+        elif path[1] == 'Heading' and self.odriveThread.move_in_progress:
+            self.odriveThread.h = data  # sent when the coordinated move is done, if it isn't the move's target
+
+        elif path[1] == 'Heading':
+            self.odriveThread.h = data
+            now = pg.ptime.time()
+
+            time_elapsed = now - self.last_update
+            if time_elapsed < 0.1:  # if a bunch of changes are made fast, send the latest one when the 0.1 s are over
+                self.headingDeferred.emit(int(np.ceil((0.1 - time_elapsed) * 1000)))
+            else:  # Continue along
+                self.send_heading()
+
+        # Pointing
+        elif (path[1] == "X") & (self.odriveThread.mode == "Pointing"):
+            self.odriveThread.mdes[0] = data
+
+        elif (path[1] == "Y") & (self.odriveThread.mode == "Pointing"):
+            self.odriveThread.mdes[1] = data
+
+        elif (path[1] == "Z") & (self.odriveThread.mode == "Pointing"):
+            self.odriveThread.mdes[2] = data
+
+    def send_heading(self):
+        """Send the heading h to the controller, now or when the throttle's timer runs out."""
+        if self.odriveThread.move_in_progress:  # the move sends h when it is done
+            return
+        self.last_update = pg.ptime.time()
+        self.odriveThread.update_heading()
+
+    def toggle_control(self, data):
+        """A sub-method that toggles whether the motors are engaged or idle..
+
+        Args:
+            data: a boolean, whether the checkbox is checked or not
+
+        """
+        if data is True:  # If the box is checked
+            self.odriveThread.closed_loop()  # Turn on closed loop control
+
+        elif data is False and self.watchdog_tripped:  # motors were already released by the watchdog
+            self.watchdog_tripped = False
+            self.odriveThread.idle()
+
+        elif data is False:  # if box is unchecked
+            self.releaseRequested.emit()
+
+    def release_motors(self):
+        """Warn that the motors will free-spin, then idle them once the warning is dismissed."""
+        error_box = QtWidgets.QErrorMessage()
+        error_box.setModal(True)  # Cannot do other things in the app while this window is open
+        error_box.showMessage("Warning! Motors will free-spin and can DROP after this message is dismissed.")
+        error_box.exec_()
+        if self.t.getTopLevelParamValue("Engage Motors"):  # engaged again while the warning was up
+            return
+        self.odriveThread.idle()  # release motors
+
+    def home_roboscope(self):
+        """Home the roboscope against its end stop. The Parameter Tree is disabled until it is done."""
+        if not self.connected or self.odriveThread.homing_in_progress or self.odriveThread.move_in_progress:
+            return
+        self.t.setEnabled(False)
+        self.odriveThread.home_roboscope()
+
+    def on_homed(self, report):
+        """Homing finished, tell the operator if the origin couldn't be found."""
+        self.t.setEnabled(self.connected)
+        if not report['success']:
+            self.error_handling(f"{self.rig['name']} roboscope homing failed: {report['reason']}. "
+                                f"Z is still measured from the previous origin.")
+
+    def on_watchdog_trip(self, trip):
+        """The watchdog idled the motors. Reflect that in the Parameter Tree and tell the operator why.
+
+        Args:
+            trip: the trip record emitted by the watchdog, a dict with the reason and reaction latency
+
+        """
+        self.watchdog_tripped = True
+        self.t.setTopLevelParamValue("Engage Motors", False)
+        self.error_handling(f"{self.rig['name']} watchdog idled the motors: {trip['reason']} "
+                            f"(reaction time {trip['latency'] * 1000:.1f} ms)")
+
+    def on_io_error(self, message):
+        """Idling a motor failed on its board, so it may still be powered. Tell the operator.
+
+        Args:
+            message: what failed and why, from the board's arbiter
+
+        """
+        self.error_handling(f"{self.rig['name']} could not release a motor: {message}. "
+                            f"Check the ODrive connection, the motor may still be powered.")
+
+    def error_handling(self, error_message):
+        """When an error signal is sent to this method, show an error box with the message inside.
+
+        Args:
+            error_message: signal from either the writeThread or readThread containing the error message
+
+        """
+        error_box = QtWidgets.QErrorMessage()
+        error_box.setModal(True)  # Cannot do other things in the app while this window is open
+        error_box.showMessage(error_message)
+        error_box.exec_()
+
+    def play_macro(self, events, speed=1.0, loops=1):
+        """Replay recorded parameter changes on this rig. Stops a macro that is already playing.
+
+        An empty macro is refused, and so is repeating a macro whose events are all at its start (loops=0), which
+        would replay it as fast as the thread can run.
+        """
+        if not events:
+            self.error_handling("The macro has no events to play.")
+            return
+        if loops == 0 and events[-1][0] <= 0:
+            self.error_handling("The macro's events all happen at once, it can't be repeated until stopped.")
+            return
+        self.stop_macro()
+        self.player = MacroPlayer(events, speed, loops)
+        self.player.replayEvent.connect(self.apply_replay_event)
+        self.player.start()
+        self.player.setPriority(QtCore.QThread.HighestPriority)
+
+    def stop_macro(self):
+        if self.player is not None:
+            self.player.running = False
+            self.player.wait()
+            self.player = None  # its events still queued are ignored
+
+    def apply_replay_event(self, player, index, path, value, scheduled):
+        """Set a replayed value in the rig's ControlState, which forwards it to the controller like any other change.
+
+        Events of a player that has since been stopped or replaced are dropped.
+        """
+        if player is not self.player:
+            return
+        self.t.state.set(path, value)
+        player.applied(index, scheduled)
+
+    def start_sweep(self):
+        """Run a magnet frequency sweep with the settings in the Parameter Tree.
+
+        Returns:
+            the running FrequencySweep, which emits sweepFinished with the results table
+        """
+        self.stop_sweep()
+        settings = {name: self.t.getParamValue(name, branch='Frequency Sweep')
+                    for name in ('Start', 'Stop', 'Step', 'Dwell', 'Ramp', 'Settle')}
+        if not self.t.getTopLevelParamValue("Engage Motors"):
+            print("Frequency sweep: the motors aren't engaged, the spinner won't follow.")
+        self.sweep = FrequencySweep(self.t.state, settings['Start'], settings['Stop'], settings['Step'],
+                                    settings['Dwell'], settings['Ramp'], settings['Settle'])
+        self.telemetry_source.newTelemetry.connect(self.sweep.on_telemetry)
+        self.sweep.start()
+        self.sweep.setPriority(QtCore.QThread.HighPriority)
+        return self.sweep
+
+    def stop_sweep(self):
+        if self.sweep is not None:
+            self.sweep.running = False
+            self.sweep.wait()
+            self.telemetry_source.newTelemetry.disconnect(self.sweep.on_telemetry)
+            self.sweep = None
+
+    def on_telemetry(self, frame):
+        """Hand a TelemetryFrame to the plots, each takes its channel's whole batch at once."""
+        self.p1.on_new_data_update_plot(frame.heading, frame.heading_cmd)
+        self.p2.on_new_data_update_plot(frame.z, frame.z_cmd)
+        self.p3.on_new_data_update_plot(frame.spinner, frame.spinner_cmd)
+        for (label, title, estimator), (command, response) in zip(self.lags, (
+                (frame.heading_cmd, frame.heading), (frame.z_cmd, frame.z), (frame.spinner_cmd, frame.spinner))):
+            estimator.update(frame.t, command, response)
+        self.thermal.update(frame.t, frame.spinner_current, frame.spinner_cmd, frame.fet_temp)
+        self.capture.update(frame.data[:, :frame.n])
+        self.latest['heading'] = frame.heading[-1]
+        self.latest['z'] = frame.z[-1]
+        self.latest['spinner'] = frame.spinner[-1]
+        self.orientation.set_pose(frame.heading[-1], frame.z[-1])
+
+    def update_lags(self):
+        """Show the latest command to response delay estimates in the plot labels."""
+        if not self.isVisible():
+            return
+        for label, title, estimator in self.lags:
+            lag = estimator.estimate()
+            lag_text = '--' if lag is None else f"{lag * 1000:.0f} ms"
+            label.setText(f"<b><u>{title}</u></b> &nbsp; lag {lag_text}")
+
+    def update_thermal(self):
+        """Show the spinner motor's thermal budget and, with "Thermal Cap" checked, limit the Frequency to it."""
+        cap = self.thermal.frequency_cap() if self.t.getTopLevelParamValue("Thermal Cap") else None
+        path = ('Rolling', 'Frequency')
+        if cap is None:
+            self.t.state.set_limits(path, None)
+        else:
+            cap = np.floor(cap * 10) / 10  # 0.1 Hz steps, so the frequency isn't nudged every second
+            if abs(self.t.state.get(path)) > cap:
+                print(f"{self.rig['name']}: thermal cap, magnet frequency limited to {cap:.1f} Hz")
+            self.t.state.set_limits(path, (-cap, cap))
+        if self.isVisible():
+            cap_text = '' if cap is None else f", frequency capped at {cap:.1f} Hz"
+            self.thermallbl.setText(self.thermal.summary() + cap_text)
+
+    def overview(self):
+        """One line summary of the rig's latest telemetry."""
+        def fmt(value, spec):
+            return '--' if value is None else format(value, spec)
+        return (f"<b>{self.rig['name']}</b>: heading {fmt(self.latest['heading'], '.1f')}°, "
+                f"Z {fmt(self.latest['z'], '.2f')} cm, spinner {fmt(self.latest['spinner'], '.1f')} Hz")
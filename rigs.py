@@ -0,0 +1,18 @@
+"""Registry of the actuator rigs driven from this program.
+
+Each entry gets its own tab with plots and a parameter tree, and its own ODriveController worker. Add a dict here
+when a rig is added to the lab.
+
+    name: tab title
+    drv1_serial: serial number of the board driving the heading (axis0) and spinner (axis1)
+    drv2_serial: serial number of the board driving the roboscope (axis0)
+    process: run the rig's ODriveController in a worker process (see worker.py), so ODrive I/O doesn't compete with
+        the GUI for the GIL
+    home_on_connect: home the roboscope against its end stop whenever the boards are connected, instead of taking Z = 0
+        from wherever it happens to be (see threads/Homing.py)
+"""
+
+RIGS = [
+    {'name': 'Rig 1', 'drv1_serial': '208739A04D4D', 'drv2_serial': '207539694D4D', 'process': False,
+     'home_on_connect': False},
+]
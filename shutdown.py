@@ -0,0 +1,102 @@
+from pyqtgraph.Qt import QtCore
+import pyqtgraph as pg
+
+
+class ShutdownSequence(QtCore.QObject):
+    """State machine that parks the actuator before the program closes.
+
+    Instead of sleeping for a fixed time, the roboscope is sent to its park position and the magnet is stopped, then
+    the telemetry is watched until both have actually arrived (or `timeout` runs out). Only then are the motors idled
+    and the odrive threads stopped. Runs on a QTimer so the GUI keeps repainting and can show the progress.
+
+    States: 'ready' -> 'parking' -> 'idling' -> 'done'
+
+    Attributes:
+        odriveThread: the ODriveController (or worker.ControllerProcess) to shut down
+        park_z (float): roboscope park position [cm]
+        z_tolerance (float): how close to park_z counts as parked [cm]
+        spinner_threshold (float): spinner frequency below which the magnet counts as stopped [Hz]
+        timeout (float): give up waiting and idle anyway after this many seconds
+    """
+    progress = QtCore.pyqtSignal(str, int)  # message, percent complete
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, odriveThread, park_z=0.2, z_tolerance=0.1, spinner_threshold=0.5, timeout=15.0, period=50):
+        super().__init__()
+        self.odriveThread = odriveThread
+        self.park_z = park_z
+        self.z_tolerance = z_tolerance
+        self.spinner_threshold = spinner_threshold
+        self.timeout = timeout
+
+        self.state = 'ready'
+        self.z = None
+        self.spinner = None
+        self.start_distance = None
+        self.start_time = None
+
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(period)
+        self.timer.timeout.connect(self.step)
+
+        odriveThread.newTelemetry.connect(self.on_telemetry)
+
+    def on_telemetry(self, frame):
+        self.z = frame.z[-1]
+        self.spinner = frame.spinner[-1]
+
+    def start(self, engaged=True):
+        """Begin the sequence. If the motors aren't engaged nothing can move, so skip straight to idling."""
+        if self.state != 'ready':
+            return
+        self.start_time = pg.ptime.time()
+        if engaged:
+            self.odriveThread.z = self.park_z
+            self.odriveThread.update_roboscope()
+            self.odriveThread.f = 0
+            self.odriveThread.update_magnet_rotation_rate()
+            self.state = 'parking'
+        else:
+            self.state = 'idling'
+        self.timer.start()
+
+    def is_parked(self):
+        """True once telemetry shows the roboscope at park_z and the magnet stopped."""
+        if self.z is None or self.spinner is None:
+            return False
+        return abs(self.z - self.park_z) < self.z_tolerance and abs(self.spinner) < self.spinner_threshold
+
+    def step(self):
+        """Advance the state machine, called by the timer."""
+        elapsed = pg.ptime.time() - self.start_time
+
+        if self.state == 'parking':
+            if self.is_parked():
+                self.progress.emit(f"Parked after {elapsed:.1f} s.", 100)
+                self.state = 'idling'
+            elif elapsed > self.timeout:
+                print(f"Shutdown: not parked after {self.timeout} s (Z = {self.z}, spinner = {self.spinner}), "
+                      f"idling anyway.")
+                self.progress.emit("Timed out while parking, idling motors.", 100)
+                self.state = 'idling'
+            else:
+                z = self.z if self.z is not None else float('nan')
+                spinner = self.spinner if self.spinner is not None else float('nan')
+                self.progress.emit(f"Parking roboscope, Z = {z:.2f} cm, spinner = {spinner:.1f} Hz",
+                                   self.percent_parked())
+
+        elif self.state == 'idling':
+            self.timer.stop()
+            self.odriveThread.stop()
+            print(f"closed threads after {elapsed:.1f} s.")
+            self.state = 'done'
+            self.finished.emit()
+
+    def percent_parked(self):
+        """Fraction of the roboscope travel to park_z that has been covered, as an integer percent."""
+        if self.z is None:
+            return 0
+        distance = abs(self.z - self.park_z)
+        if self.start_distance is None:
+            self.start_distance = max(distance, self.z_tolerance)
+        return int(100 * max(0.0, min(1.0, 1 - distance / self.start_distance)))
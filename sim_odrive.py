@@ -0,0 +1,237 @@
+import threading
+import time
+from odrive.enums import *
+
+
+class SimAxis:
+    """Software model of a single ODrive axis, used in place of the hardware on a dev machine.
+
+    Only the part of the odrive object tree that this program touches is modelled: the encoder estimates, the
+    controller inputs and config, the motor current and FET temperature, and the requested/current axis state.
+    Position control runs through the same 2nd order input filter the firmware uses for INPUT_MODE_POS_FILTER,
+    followed by a velocity limited position loop and a first order velocity response.
+
+    Attributes:
+        realtime (bool): if True the model advances with the wall clock every time it is touched. If False, time only
+            moves when `advance` is called, which lets offline tools run faster than real time.
+        encoder, controller, motor: namespaces mirroring `axis.encoder`, `axis.controller` and `axis.motor`
+        end_stop (float): a hard stop below which the axis can't move [turns], like the roboscope's, or None
+        backlash (float): lost motion between the motor and its load [turns], like the heading belt's
+        load_pos (float): position of the load after the backlash [turns]. The encoder reads the motor, not this.
+    """
+
+    # Motor current in closed loop: torque for the acceleration, friction, viscous and air drag [A per turns/s^2,
+    # A, A per turns/s, A per (turns/s)^2]
+    current_coefficients = (0.005, 0.3, 0.02, 0.001)
+    fet_rise = 0.3  # steady state FET temperature rise [°C/A^2]
+    fet_tau = 30.0  # [s]
+    current_lim = 10.0  # [A]
+
+    def __init__(self, realtime=True, dt=0.001, vel_tau=0.02, coast_tau=0.5, accel_limit=200.0):
+        self.realtime = realtime
+        self.dt = dt  # integration step [s]
+        self.vel_tau = vel_tau  # time constant of the velocity loop [s]
+        self.coast_tau = coast_tau  # time constant of free-spin decay when idle [s]
+        self.accel_limit = accel_limit  # [turns/s^2]
+
+        self.lock = threading.RLock()
+        self.sim_time = 0.0
+        self._last_sync = time.perf_counter()
+
+        # Physical state
+        self.pos = 0.0  # [turns]
+        self.vel = 0.0  # [turns/s]
+        self.current = 0.0  # [A]
+        self.fet_temp = 25.0  # [°C]
+        self.end_stop = None  # lower mechanical limit of travel [turns], None for a free axis
+        self.backlash = 0.0  # [turns]
+        self.load_pos = 0.0  # [turns]
+
+        # Controller state
+        self.pos_setpoint = 0.0
+        self.vel_setpoint = 0.0
+        self.current_state = AXIS_STATE_IDLE
+        self.error = 0
+
+        self.encoder = _SimEncoder(self)
+        self.controller = _SimController(self)
+        self.motor = _SimMotor(self)
+
+    @property
+    def requested_state(self):
+        return self.current_state
+
+    @requested_state.setter
+    def requested_state(self, state):
+        with self.lock:
+            self.sync()
+            if state == AXIS_STATE_CLOSED_LOOP_CONTROL and self.current_state != state:
+                # Entering closed loop starts the filter from wherever the axis currently is
+                self.pos_setpoint = self.pos
+                self.vel_setpoint = 0.0
+            self.current_state = state
+
+    def clock(self):
+        """Current model time in seconds."""
+        return self.sim_time
+
+    def sync(self):
+        """Bring a realtime model up to the current wall clock time."""
+        if not self.realtime:
+            return
+        with self.lock:
+            now = time.perf_counter()
+            elapsed = now - self._last_sync
+            self._last_sync = now
+            self._integrate(elapsed)
+
+    def advance(self, t):
+        """Advance a non-realtime model by `t` seconds. Has the same signature as time.sleep."""
+        with self.lock:
+            self._integrate(t)
+
+    def _integrate(self, t):
+        steps = int(t / self.dt)
+        for _ in range(steps):
+            self._step(self.dt)
+        remainder = t - steps * self.dt
+        if remainder > 1e-9:
+            self._step(remainder)
+
+    def _step(self, dt):
+        config = self.controller.config
+        if self.current_state == AXIS_STATE_CLOSED_LOOP_CONTROL:
+            if config.control_mode == CONTROL_MODE_VELOCITY_CONTROL:
+                vel_des = self.controller.input_vel_value
+            else:
+                if config.input_mode == INPUT_MODE_POS_FILTER:
+                    # Same gains as ODrive Controller::update_filter_gains, critically damped
+                    ki = 2.0 * config.input_filter_bandwidth
+                    kp = 0.25 * ki * ki
+                    accel = kp * (self.controller.input_pos_value - self.pos_setpoint) + ki * (0.0 - self.vel_setpoint)
+                    self.vel_setpoint += dt * accel
+                    self.pos_setpoint += dt * self.vel_setpoint
+                else:
+                    self.pos_setpoint = self.controller.input_pos_value
+                    self.vel_setpoint = 0.0
+                vel_des = self.vel_setpoint + config.pos_gain * (self.pos_setpoint - self.pos)
+            vel_des = max(-config.vel_limit, min(config.vel_limit, vel_des))
+            accel = max(-self.accel_limit, min(self.accel_limit, (vel_des - self.vel) / self.vel_tau))
+            inertia, friction, viscous, drag = self.current_coefficients
+            if self.vel < 0:
+                friction = -friction
+            elif self.vel == 0:
+                friction = 0.0
+            self.current = inertia * accel + friction + viscous * self.vel + drag * self.vel * abs(self.vel)
+        else:
+            accel = -self.vel / self.coast_tau
+            self.current = 0.0
+
+        self.vel += accel * dt
+        self.pos += self.vel * dt
+        if self.end_stop is not None and self.pos <= self.end_stop:
+            self.pos = self.end_stop
+            if self.vel < 0:
+                self.vel = 0.0
+                if self.current_state == AXIS_STATE_CLOSED_LOOP_CONTROL:
+                    self.current = -self.current_lim  # the velocity integrator winds up against the stop
+        half = self.backlash / 2  # the load only moves once the motor takes up the slack
+        self.load_pos = min(max(self.load_pos, self.pos - half), self.pos + half)
+        self.fet_temp += (25.0 + self.fet_rise * self.current ** 2 - self.fet_temp) * dt / self.fet_tau
+        self.sim_time += dt
+
+
+class _SimEncoder:
+    def __init__(self, axis):
+        self._axis = axis
+
+    @property
+    def pos_estimate(self):
+        self._axis.sync()
+        return self._axis.pos
+
+    @property
+    def vel_estimate(self):
+        self._axis.sync()
+        return self._axis.vel
+
+
+class _SimCurrentControl:
+    def __init__(self, axis):
+        self._axis = axis
+
+    @property
+    def Iq_measured(self):
+        self._axis.sync()
+        return self._axis.current
+
+
+class _SimThermistor:
+    def __init__(self, axis):
+        self._axis = axis
+
+    @property
+    def temperature(self):
+        self._axis.sync()
+        return self._axis.fet_temp
+
+
+class _SimMotor:
+    def __init__(self, axis):
+        self.current_control = _SimCurrentControl(axis)
+        self.fet_thermistor = _SimThermistor(axis)
+
+
+class _SimControllerConfig:
+    def __init__(self):
+        self.control_mode = CONTROL_MODE_POSITION_CONTROL
+        self.input_mode = INPUT_MODE_PASSTHROUGH
+        self.input_filter_bandwidth = 2.0
+        self.vel_limit = 2.0
+        self.pos_gain = 20.0
+
+
+class _SimController:
+    def __init__(self, axis):
+        self._axis = axis
+        self.config = _SimControllerConfig()
+        self.input_pos_value = 0.0
+        self.input_vel_value = 0.0
+
+    @property
+    def input_pos(self):
+        return self.input_pos_value
+
+    @input_pos.setter
+    def input_pos(self, value):
+        self._axis.sync()  # the command takes effect from now on, not from the last time the model was touched
+        self.input_pos_value = value
+
+    @property
+    def input_vel(self):
+        return self.input_vel_value
+
+    @input_vel.setter
+    def input_vel(self, value):
+        self._axis.sync()
+        self.input_vel_value = value
+
+
+class SimODrive:
+    """A simulated two axis ODrive board."""
+
+    def __init__(self, serial_number, realtime=True):
+        self.serial_number = serial_number
+        self.axis0 = SimAxis(realtime=realtime)
+        self.axis1 = SimAxis(realtime=realtime)
+        self.vbus_voltage = 24.0
+
+
+_boards = {}
+
+
+def find_any(serial_number=None, realtime=True, **kwargs):
+    """Drop-in replacement for odrive.find_any. Returns the same simulated board every time a serial is requested."""
+    if serial_number not in _boards:
+        _boards[serial_number] = SimODrive(serial_number, realtime=realtime)
+    return _boards[serial_number]
@@ -0,0 +1,196 @@
+import numpy as np
+
+# Rows of a TelemetryFrame block
+T, HEADING, Z, SPINNER, SPINNER_POS, HEADING_CMD, Z_CMD, SPINNER_CMD, SPINNER_CURRENT, FET_TEMP = range(10)
+CHANNELS = ('t', 'heading', 'z', 'spinner', 'spinner_pos', 'heading_cmd', 'z_cmd', 'spinner_cmd', 'spinner_current',
+            'fet_temp')
+
+
+class TelemetryFrame:
+    """A batch of N timestamped telemetry samples of every channel, packed into one preallocated NumPy block.
+
+    DataRetriever fills a frame with raw readings (motor turns and turns/s), ODriveController.convert_frame turns the
+    whole block into heading [deg], Z [cm] and spinner frequency [Hz] in one vectorized step, and the frame is then
+    delivered with a single signal. The channel properties are views, so writing to them writes to the block.
+
+    Next to each measured channel, the commanded value at the time of the sample is recorded (heading setpoint [deg],
+    roboscope target [cm] and magnet frequency [Hz]), already in those units. The spinner motor current [A] and the
+    spinner board's FET temperature [°C] (NaN when the firmware doesn't report it) feed the thermal model.
+
+    Attributes:
+        data (np.ndarray): channels x capacity block, rows indexed by T, HEADING, Z, SPINNER, SPINNER_POS,
+            HEADING_CMD, Z_CMD, SPINNER_CMD, SPINNER_CURRENT, FET_TEMP
+        n (int): number of samples filled in
+    """
+    __slots__ = ('data', 'n')
+
+    def __init__(self, capacity):
+        self.data = np.zeros((len(CHANNELS), capacity))
+        self.n = 0
+
+    def append(self, t, heading, z, spinner, spinner_pos, heading_cmd, z_cmd, spinner_cmd, spinner_current, fet_temp):
+        """Add one sample. Returns True when the frame is full."""
+        self.data[:, self.n] = (t, heading, z, spinner, spinner_pos, heading_cmd, z_cmd, spinner_cmd, spinner_current,
+                                fet_temp)
+        self.n += 1
+        return self.full()
+
+    def full(self):
+        return self.n == self.data.shape[1]
+
+    @property
+    def t(self):
+        """Sample times, time.perf_counter() seconds."""
+        return self.data[T, :self.n]
+
+    @property
+    def heading(self):
+        return self.data[HEADING, :self.n]
+
+    @property
+    def z(self):
+        return self.data[Z, :self.n]
+
+    @property
+    def spinner(self):
+        return self.data[SPINNER, :self.n]
+
+    @property
+    def spinner_pos(self):
+        return self.data[SPINNER_POS, :self.n]
+
+    @property
+    def heading_cmd(self):
+        return self.data[HEADING_CMD, :self.n]
+
+    @property
+    def z_cmd(self):
+        return self.data[Z_CMD, :self.n]
+
+    @property
+    def spinner_cmd(self):
+        return self.data[SPINNER_CMD, :self.n]
+
+    @property
+    def spinner_current(self):
+        return self.data[SPINNER_CURRENT, :self.n]
+
+    @property
+    def fet_temp(self):
+        return self.data[FET_TEMP, :self.n]
+
+
+class SampleTiming:
+    """Running statistics of the intervals between telemetry sample timestamps, against the nominal period.
+
+    Measures the timing jitter of the telemetry as it arrives, wherever it was sampled (e.g. in a worker process).
+
+    Attributes:
+        period (float): nominal sample period [s]
+        n (int): intervals measured
+        max_error (float): largest deviation of an interval from the period [s]
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.last = None
+        self.n = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.max_error = 0.0
+
+    def update(self, t):
+        """Add the sample timestamps `t` (an array, in order)."""
+        if t.size == 0:
+            return
+        intervals = np.diff(t) if self.last is None else np.diff(t, prepend=self.last)
+        self.last = t[-1]
+        if intervals.size == 0:
+            return
+        self.n += intervals.size
+        self.sum += intervals.sum()
+        self.sum_sq += np.dot(intervals, intervals)
+        self.max_error = max(self.max_error, float(np.abs(intervals - self.period).max()))
+
+    def stats(self):
+        """Mean interval, its standard deviation (the jitter) and the largest deviation from the period, in s."""
+        if self.n == 0:
+            return {'mean': None, 'jitter': None, 'max_error': None}
+        mean = self.sum / self.n
+        return {'mean': mean, 'jitter': max(0.0, self.sum_sq / self.n - mean * mean) ** 0.5,
+                'max_error': self.max_error}
+
+    def report(self):
+        s = self.stats()
+        if s['mean'] is None:
+            return "no telemetry intervals measured"
+        return (f"{self.n} intervals, mean {s['mean'] * 1000:.2f} ms (nominal {self.period * 1000:.2f}), "
+                f"jitter {s['jitter'] * 1000:.3f} ms, max error {s['max_error'] * 1000:.2f} ms")
+
+
+class LagEstimator:
+    """Rolling estimate of the delay from a commanded signal to the measured response.
+
+    Samples are written into fixed-size rings that are allocated once. Every sample is stored twice, `window` apart, so
+    the latest `window` samples are always one contiguous, time ordered view and never need to be copied into order.
+    `estimate` cross-correlates the sample-to-sample changes of the command and the response over that window, less
+    their means (vectorized, with FFTs) and returns the lag of the correlation peak, refined between samples with a parabola.
+
+    Attributes:
+        window (int): samples in the correlation window
+        max_lag (int): longest lag searched, in samples
+        angular (bool): the signals are angles in degrees, unwrapped before correlating
+    """
+
+    def __init__(self, window=128, max_lag=40, angular=False):
+        self.window = window
+        self.max_lag = max_lag
+        self.angular = angular
+        self.t = np.zeros(2 * window)
+        self.command = np.zeros(2 * window)
+        self.response = np.zeros(2 * window)
+        self.index = 0  # where the next sample goes
+        self.count = 0  # samples written, up to window
+
+    def update(self, t, command, response):
+        """Add a batch of samples (arrays of equal length)."""
+        n = min(t.size, self.window)
+        t, command, response = t[-n:], command[-n:], response[-n:]
+        first = min(n, self.window - self.index)  # the part up to the end of the ring, then the part that wraps
+        for ring, values in ((self.t, t), (self.command, command), (self.response, response)):
+            for start, part in ((self.index, values[:first]), (0, values[first:])):
+                ring[start:start + part.size] = part
+                ring[start + self.window:start + self.window + part.size] = part
+        self.index = (self.index + n) % self.window
+        self.count = min(self.count + n, self.window)
+
+    def estimate(self):
+        """Delay of the response behind the command [s], or None if the command didn't change in the window."""
+        if self.count < self.window:
+            return None
+        span = slice(self.index, self.index + self.window)
+        command, response = self.command[span], self.response[span]
+        if self.angular:
+            command, response = np.unwrap(np.radians(command)), np.unwrap(np.radians(response))
+        dc, dr = np.diff(command), np.diff(response)
+        if not np.all(np.isfinite(dc)) or not np.all(np.isfinite(dr)):
+            return None
+        dc -= dc.mean()
+        dr -= dr.mean()
+        if not np.any(np.abs(dc) > 1e-9):
+            return None
+
+        n = dc.size
+        size = 1 << int(2 * n - 1).bit_length()
+        correlation = np.fft.irfft(np.conj(np.fft.rfft(dc, size)) * np.fft.rfft(dr, size), size)[:self.max_lag + 1]
+        peak = int(np.argmax(correlation))
+        if correlation[peak] <= 0:
+            return None
+        offset = 0.0
+        if 0 < peak < self.max_lag:
+            a, b, c = correlation[peak - 1:peak + 2]
+            if a - 2 * b + c != 0:
+                offset = 0.5 * (a - c) / (a - 2 * b + c)
+        t = self.t[span]
+        dt = (t[-1] - t[0]) / (self.window - 1)
+        return (peak + offset) * dt
@@ -0,0 +1,151 @@
+import numpy as np
+
+
+class ThermalModel:
+    """First order (RC) thermal model of the spinner motor, fed with its measured current.
+
+    The winding temperature rise approaches `k * I**2` with time constant `tau`. From the current estimate this gives:
+
+    * `remaining_time`: how long the motor can keep drawing a current before reaching `t_max`
+    * `duty`: the fraction of the time it can draw that current in the long run
+    * `continuous_frequency`: the highest magnet frequency it can spin at indefinitely, from a quadratic fit of the
+      measured current against the commanded frequency (drag grows with speed)
+
+    k and tau are properties of the motor and its mounting. The defaults are conservative guesses; identify them
+    from a heating run (the winding temperature after a long constant current run gives k, the time to 63% gives tau).
+
+    Attributes:
+        temperature (float): estimated winding temperature [°C]
+        current (float): latest measured current magnitude [A]
+        fet_temperature (float): latest FET temperature reported by the board [°C], None if the firmware doesn't
+    """
+
+    def __init__(self, k=0.6, tau=120.0, t_ambient=25.0, t_max=90.0, bin_width=1.0, min_bins=3):
+        self.k = k  # steady state temperature rise per A^2 [°C/A^2]
+        self.tau = tau  # [s]
+        self.t_ambient = t_ambient
+        self.t_max = t_max
+        self.temperature = t_ambient
+        self.current = 0.0
+        self.fet_temperature = None
+        self.last_t = None
+
+        # Mean current per commanded frequency bin, for the current vs frequency fit
+        self.bin_width = bin_width
+        self.min_bins = min_bins
+        self.bins = {}  # bin index: [samples, sum of currents]
+
+    def update(self, t, current, frequency=None, fet_temperature=None):
+        """Add a batch of measured current samples, taken at times t [s] while spinning at commanded `frequency` [Hz].
+
+        Batches are short next to tau, so the model takes one step per batch with its mean squared current.
+        """
+        current = np.abs(current)
+        valid = np.isfinite(current)
+        if not valid.any():
+            return
+        t, current = t[valid], current[valid]
+        if self.last_t is not None and t[-1] > self.last_t:
+            rise = self.temperature - self.t_ambient
+            rise += (self.k * np.mean(current * current) - rise) * (1 - np.exp(-(t[-1] - self.last_t) / self.tau))
+            self.temperature = self.t_ambient + rise
+        self.last_t = t[-1]
+        self.current = float(current[-1])
+
+        if frequency is not None:
+            frequency = np.abs(frequency[valid])
+            spinning = np.isfinite(frequency) & (frequency != 0)
+            indices = np.rint(frequency[spinning] / self.bin_width).astype(int)
+            for index in np.unique(indices):
+                counts = self.bins.setdefault(int(index), [0, 0.0])
+                counts[0] += np.count_nonzero(indices == index)
+                counts[1] += float(current[spinning][indices == index].sum())
+        if fet_temperature is not None and np.size(fet_temperature) and np.isfinite(fet_temperature[-1]):
+            self.fet_temperature = float(fet_temperature[-1])
+
+    def remaining_time(self, current=None):
+        """Seconds until t_max at `current` (default: the latest measurement), inf if it is sustainable."""
+        current = self.current if current is None else current
+        steady = self.t_ambient + self.k * current * current
+        if steady <= self.t_max:
+            return np.inf
+        if self.temperature >= self.t_max:
+            return 0.0
+        return -self.tau * np.log((steady - self.t_max) / (steady - self.temperature))
+
+    def duty(self, current=None):
+        """Long run fraction of the time the motor can draw `current` (default: the latest measurement)."""
+        current = self.current if current is None else current
+        if current == 0:
+            return 1.0
+        return min(1.0, (self.t_max - self.t_ambient) / (self.k * current * current))
+
+    def current_fit(self):
+        """Coefficients (highest power first) of the quadratic fit of current against frequency, None until enough
+        frequencies have been run."""
+        if len(self.bins) < self.min_bins:
+            return None
+        f = np.array([index * self.bin_width for index in self.bins])
+        i = np.array([total / n for n, total in self.bins.values()])
+        return np.polyfit(f, i, 2)
+
+    def current_at(self, frequency):
+        """Expected current when spinning at `frequency` [Hz], None without a fit."""
+        fit = self.current_fit()
+        return None if fit is None else max(0.0, float(np.polyval(fit, abs(frequency))))
+
+    def continuous_frequency(self, f_max=100.0):
+        """Highest frequency [Hz] the motor can sustain indefinitely, None without a fit."""
+        fit = self.current_fit()
+        if fit is None:
+            return None
+        current_limit = np.sqrt((self.t_max - self.t_ambient) / self.k)
+        frequencies = np.linspace(0, f_max, 1001)
+        sustainable = frequencies[np.polyval(fit, frequencies) <= current_limit]
+        return float(sustainable.max()) if sustainable.size else 0.0
+
+    def frequency_cap(self, guard_time=60.0, f_max=100.0):
+        """Highest frequency [Hz] that leaves at least `guard_time` seconds before t_max from the current temperature,
+        None without a fit. Above continuous_frequency while the motor is cool, it falls towards it as it heats up."""
+        fit = self.current_fit()
+        if fit is None:
+            return None
+        frequencies = np.linspace(0, f_max, 1001)
+        steady = self.t_ambient + self.k * np.maximum(np.polyval(fit, frequencies), 0) ** 2
+        if self.temperature >= self.t_max:
+            allowed = steady <= self.t_max
+        else:
+            # Time to reach t_max is at least guard_time where steady - t_max <= (steady - T) * exp(-guard_time / tau)
+            allowed = steady - self.t_max <= (steady - self.temperature) * np.exp(-guard_time / self.tau)
+        sustainable = frequencies[allowed]
+        return float(sustainable.max()) if sustainable.size else 0.0
+
+    def summary(self):
+        remaining = self.remaining_time()
+        remaining = 'continuous' if remaining == np.inf else f"{remaining:.0f} s left"
+        fet = '' if self.fet_temperature is None else f", FET {self.fet_temperature:.0f} °C"
+        continuous = self.continuous_frequency()
+        continuous = '' if continuous is None else f", continuous up to {continuous:.1f} Hz"
+        return (f"Spinner motor {self.current:.1f} A, {self.temperature:.0f} °C est. (limit {self.t_max:.0f}){fet}: "
+                f"{remaining}, duty {self.duty() * 100:.0f}%{continuous}")
+
+
+if __name__ == '__main__':
+    # Run the model on a simulated current trace: a frequency ladder, then 35 Hz (above the continuous limit) held
+    # under the thermal cap. Run from the top folder with `python thermal.py`
+    def simulated_current(f):
+        """Spinner current of the simulated ODrive (see sim_odrive.SimAxis) at a magnet frequency."""
+        vel = f / (3 / 10)
+        return 0.3 + 0.02 * vel + 0.001 * vel * vel
+
+    model = ThermalModel()
+    t, dt = 0.0, 0.1
+    for requested in [5, 10, 15, 20] + [35] * 10:
+        cap = model.frequency_cap()
+        f = requested if cap is None else min(requested, cap)
+        times = t + dt * np.arange(1, 301)  # 30 s per step
+        current = simulated_current(f) + 0.05 * np.random.standard_normal(times.size)
+        for batch in range(0, times.size, 10):  # 1 s telemetry frames
+            model.update(times[batch:batch + 10], current[batch:batch + 10], np.full(10, f))
+        t = times[-1]
+        print(f"{t:5.0f} s at {f:.1f} Hz: {model.summary()}")
@@ -0,0 +1,214 @@
+import itertools
+import queue
+import threading
+import weakref
+from collections import deque
+from time import perf_counter
+from pyqtgraph.Qt import QtCore
+
+# Transaction priorities, lowest first
+SAFETY, COMMAND, TELEMETRY = range(3)
+PRIORITY_NAMES = ('safety', 'command', 'telemetry')
+
+
+class Transaction:
+    """A pending call on an ODrive board. `result` waits for it to run and returns its return value."""
+    __slots__ = ('fn', 'args', 'priority', 'submitted', 'done', 'value', 'error', 'cancelled')
+
+    def __init__(self, priority, fn, args):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.submitted = perf_counter()
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.cancelled = False
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"ODrive transaction {self.fn.__name__} did not run within {timeout} s")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class BoardArbiter(QtCore.QThread):
+    """Serializes the USB (fibre) transactions of one ODrive board by priority.
+
+    Every read and write on the board is submitted as a Transaction and run by this thread, safety first (idle),
+    then commands (setpoints, state and config changes), then telemetry reads. Transactions of the same priority run
+    in the order they were submitted. A safety transaction cancels the commands queued before it, so a setpoint or a
+    closed loop request that was waiting can't undo an idle.
+
+    Nobody waits on a command write, so a failed one (e.g. the board dropping off USB) is printed. A failed safety
+    transaction is printed and emitted with safetyFailed as well, since it means a motor may not have been released.
+    Whoever waits on a transaction's `result` gets its exception raised.
+
+    Telemetry backs off while command traffic is heavy: `telemetry_interval` stretches the telemetry period by the
+    command rate over the last `window` seconds relative to `busy_rate`, up to `max_backoff` times.
+
+    When the thread isn't running (before the controller starts it, or in offline tools), transactions run right
+    away in the calling thread.
+
+    Attributes:
+        name (str): shown in the report, e.g. "I/O 208739A04D4D"
+        counts, wait_total, wait_max (list): transactions run, and their total and longest queue wait [s], per priority
+        cancelled (int): commands cancelled by a safety transaction
+        safeties (int): safety transactions submitted so far, to tell whether an idle happened in the meantime
+        backoff (float): current telemetry period multiplier
+    """
+    safetyFailed = QtCore.pyqtSignal(str)  # what failed and why
+    instances = weakref.WeakSet()  # every live arbiter, for the report
+
+    def __init__(self, name='', busy_rate=20.0, max_backoff=3.0, window=1.0):
+        super().__init__()
+        self.name = name
+        self.busy_rate = busy_rate  # [commands/s]
+        self.max_backoff = max_backoff
+        self.window = window  # [s]
+        self.running = False
+
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.safety_sequence = -1  # sequence number of the latest safety transaction
+
+        self.lock = threading.Lock()
+        self.counts = [0, 0, 0]
+        self.wait_total = [0.0, 0.0, 0.0]
+        self.wait_max = [0.0, 0.0, 0.0]
+        self.cancelled = 0
+        self.safeties = 0
+        self.commands = deque()  # submission times of the recent commands
+        self.backoff = 1.0
+        self.started = None
+        BoardArbiter.instances.add(self)
+
+    def submit(self, priority, fn, *args):
+        """Queue `fn(*args)` on the board at `priority`. Returns its Transaction."""
+        transaction = Transaction(priority, fn, args)
+        with self.lock:
+            if priority == SAFETY:
+                self.safeties += 1
+            elif priority == COMMAND:
+                self.commands.append(transaction.submitted)
+        if not self.running:
+            self.execute(transaction)
+            return transaction
+        sequence = next(self.sequence)
+        if priority == SAFETY:
+            self.safety_sequence = sequence
+        self.queue.put((priority, sequence, transaction))
+        return transaction
+
+    def call(self, priority, fn, *args):
+        """Run `fn(*args)` on the board at `priority` and return its result."""
+        return self.submit(priority, fn, *args).result()
+
+    def write(self, priority, obj, attribute, value):
+        """Queue setting an attribute of an odrive object, e.g. write(COMMAND, axis.controller, 'input_pos', 2.0)."""
+        return self.submit(priority, setattr, obj, attribute, value)
+
+    def read(self, priority, obj, attribute):
+        """Read an attribute of an odrive object and return it, e.g. read(TELEMETRY, axis.encoder, 'pos_estimate')."""
+        return self.call(priority, getattr, obj, attribute)
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.started = perf_counter()
+        while self.running:
+            try:
+                priority, sequence, transaction = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if transaction is None:  # woken up to stop
+                continue
+            if priority == COMMAND and sequence < self.safety_sequence:
+                transaction.cancelled = True
+                transaction.done.set()
+                with self.lock:
+                    self.cancelled += 1
+                continue
+            self.execute(transaction)
+
+    def execute(self, transaction):
+        start = perf_counter()
+        try:
+            transaction.value = transaction.fn(*transaction.args)
+        except Exception as e:  # handed to whoever waits on the result
+            transaction.error = e
+        transaction.done.set()
+        if transaction.error is not None and transaction.priority != TELEMETRY:
+            message = f"{self.name}: {PRIORITY_NAMES[transaction.priority]} {describe(transaction)} failed: " \
+                      f"{transaction.error!r}"
+            print(message)
+            if transaction.priority == SAFETY:
+                self.safetyFailed.emit(message)
+
+        wait = start - transaction.submitted
+        p = transaction.priority
+        with self.lock:
+            self.counts[p] += 1
+            self.wait_total[p] += wait
+            self.wait_max[p] = max(self.wait_max[p], wait)
+
+    def start(self, priority=QtCore.QThread.InheritPriority):
+        self.running = True  # submissions queue up from now on
+        super().start(priority)
+
+    def stop(self):
+        """Stop serving. Transactions submitted after this run in the calling thread."""
+        self.running = False
+        self.queue.put((-1, -1, None))
+        self.wait(1000)
+        while True:  # anything left over still runs, in order
+            try:
+                priority, sequence, transaction = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if transaction is not None:
+                self.execute(transaction)
+
+    def command_rate(self):
+        """Commands submitted per second over the last `window` seconds."""
+        now = perf_counter()
+        with self.lock:
+            while self.commands and self.commands[0] < now - self.window:
+                self.commands.popleft()
+            return len(self.commands) / self.window
+
+    def telemetry_interval(self, period):
+        """The telemetry period to use now: `period`, stretched while command traffic is heavy."""
+        self.backoff = min(self.max_backoff, max(1.0, self.command_rate() / self.busy_rate))
+        return period * self.backoff
+
+    def stats(self):
+        """Transaction statistics of the board as a dict."""
+        elapsed = perf_counter() - self.started if self.started is not None else 0.0
+        with self.lock:
+            counts = list(self.counts)
+            mean_wait = [total / n if n else 0.0 for total, n in zip(self.wait_total, counts)]
+            return {'name': self.name, 'rate': sum(counts) / elapsed if elapsed else 0.0, 'counts': counts,
+                    'mean_wait': mean_wait, 'max_wait': list(self.wait_max), 'cancelled': self.cancelled,
+                    'backoff': self.backoff, 'queued': self.queue.qsize()}
+
+    def report(self):
+        s = self.stats()
+        waits = ', '.join(f"{name} {n} (wait {mean * 1000:.2f} ms, max {longest * 1000:.2f})" for name, n, mean, longest
+                          in zip(PRIORITY_NAMES, s['counts'], s['mean_wait'], s['max_wait']))
+        return (f"{s['name']}: {s['rate']:.0f} transactions/s, {waits}, {s['cancelled']} commands cancelled, "
+                f"telemetry backoff x{s['backoff']:.1f}")
+
+
+def describe(transaction):
+    """What a transaction does, e.g. "requested_state = 1" for a write."""
+    if transaction.fn is setattr:
+        return f"{transaction.args[1]} = {transaction.args[2]}"
+    if transaction.fn is getattr:
+        return f"read {transaction.args[1]}"
+    return transaction.fn.__name__
+
+
+def arbiter_report():
+    """One line of transaction statistics per live BoardArbiter."""
+    return '\n'.join(arbiter.report() for arbiter in sorted(BoardArbiter.instances, key=lambda arbiter: arbiter.name))
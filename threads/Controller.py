@@ -1,6 +1,6 @@
 from pyqtgraph.Qt import QtCore
 from misc_functions import xy_to_cylindrical
-from time import sleep
+from misc_functions import PeriodicLoop
 import XInput as xi
 
 
@@ -19,6 +19,7 @@ class ControllerThread(QtCore.QThread):
 
         self.running = False
         self.sleep_constant = sleep_constant
+        self.loop = PeriodicLoop(sleep_constant, name='Gamepad')
         # Initialize variables to keep track of x and y
         self.x = 0
         self.y = 0
@@ -39,7 +40,7 @@ class ControllerThread(QtCore.QThread):
 
         # Start the process loop
         while self.running:
-            sleep(self.sleep_constant)
+            self.loop.wait()
             events = xi.get_events()
             for event in events:
                 self.filter_events(event)
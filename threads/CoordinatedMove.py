@@ -0,0 +1,134 @@
+import time
+from pyqtgraph.Qt import QtCore
+from odrive.enums import *
+from misc_functions import PeriodicLoop
+from threads.Arbiter import COMMAND, TELEMETRY
+
+
+def min_jerk(s):
+    """Minimum jerk position profile. Maps normalized time s in [0, 1] to normalized position in [0, 1]."""
+    return s * s * s * (10 - 15 * s + 6 * s * s)
+
+
+class CoordinatedMove(QtCore.QThread):
+    """Moves the heading and roboscope on one shared time base so both start and finish together.
+
+    Both axes follow a minimum jerk profile over the same duration, and their setpoints are written back to back on
+    every scheduler tick. While streaming, the position axes run in passthrough mode, since the input filters of the
+    two axes have different bandwidths and would otherwise delay them by different amounts. Writes go through the
+    boards' arbiters as commands, so they keep their order and go ahead of telemetry reads. The magnet frequency can
+    be ramped linearly along with them. After the last setpoint the encoders are watched, with telemetry reads through
+    the arbiters, until both axes have arrived, and the difference between their arrival times is reported.
+
+    Attributes:
+        controller: the ODriveController whose axes are moved
+        tick (float): setpoint streaming period [s]
+        heading_tolerance (float): arrived within this many degrees
+        z_tolerance (float): arrived within this many cm
+        arrival_timeout (float): how long to wait for arrival after the last setpoint [s]
+        report (dict): filled in when the move finishes, also emitted with moveFinished
+    """
+    moveFinished = QtCore.pyqtSignal(object)
+
+    # The peak velocity of the minimum jerk profile is 1.875 times the average velocity
+    PEAK_VELOCITY_FACTOR = 1.875
+
+    def __init__(self, controller, heading=None, z=None, f=None, duration=None, tick=0.01, vel_margin=0.8,
+                 heading_tolerance=1.0, z_tolerance=0.05, arrival_timeout=3.0):
+        super().__init__()
+        self.controller = controller
+        self.tick = tick
+        self.vel_margin = vel_margin  # fraction of vel_limit the profile is allowed to use
+        self.heading_tolerance = heading_tolerance
+        self.z_tolerance = z_tolerance
+        self.arrival_timeout = arrival_timeout
+        self.report = None
+        self.loop = PeriodicLoop(tick, name='Coordinated move')
+
+        c = controller
+        with c.heading_lock:
+            self.h_start = c.heading_unwrapped
+            self.h_end = c.plan_heading(heading) if heading is not None else c.heading_unwrapped
+        self.z_start = c.z
+        self.z_end = z if z is not None else c.z
+        self.f_start = c.f
+        self.f_end = f if f is not None else c.f
+        self.duration = duration if duration is not None else self.shortest_duration()
+
+        # The targets are the setpoints from now on. Changes made while the move runs are kept, and sent when it ends
+        c.h = self.h_end % 360
+        c.z = self.z_end
+        c.f = self.f_end
+
+    def shortest_duration(self):
+        """Shortest move time that keeps both axes under vel_margin of their velocity limits."""
+        c = self.controller
+        heading_turns = abs(c.heading_to_turns(self.h_end) - c.heading_to_turns(self.h_start))
+        z_vel_limit = c.drv2_arbiter.read(COMMAND, c.ow2.controller.config, 'vel_limit')
+        z_turns = abs(c.z_to_turns(self.z_end) - c.z_to_turns(self.z_start))
+        heading_time = self.PEAK_VELOCITY_FACTOR * heading_turns / (self.vel_margin * c.heading_vel_limit)
+        z_time = self.PEAK_VELOCITY_FACTOR * z_turns / (self.vel_margin * z_vel_limit)
+        return max(heading_time, z_time, self.tick)
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        c = self.controller
+        heading_config = c.ow3.controller.config
+        z_config = c.ow2.controller.config
+        heading_input_mode = c.drv1_arbiter.read(COMMAND, heading_config, 'input_mode')
+        z_input_mode = c.drv2_arbiter.read(COMMAND, z_config, 'input_mode')
+        c.drv1_arbiter.write(COMMAND, heading_config, 'input_mode', INPUT_MODE_PASSTHROUGH)
+        c.drv2_arbiter.write(COMMAND, z_config, 'input_mode', INPUT_MODE_PASSTHROUGH)
+
+        with c.heading_lock:
+            direction = c.heading_direction if self.h_end == self.h_start else (1 if self.h_end > self.h_start else -1)
+            c.heading_direction = direction
+
+        # Stream setpoints for both boards on the same tick
+        t0 = time.perf_counter()
+        ticks = int(round(self.duration / self.tick))
+        for i in range(1, ticks + 1):
+            self.loop.wait()
+            s = min_jerk(i / ticks)
+            with c.heading_lock:
+                c.heading_command = self.h_start + s * (self.h_end - self.h_start)
+                heading = c.compensate_heading(c.heading_command, direction)
+                c.drv1_arbiter.write(COMMAND, c.ow3.controller, 'input_pos', c.heading_to_turns(heading))
+            c.z_command = self.z_start + s * (self.z_end - self.z_start)
+            c.drv2_arbiter.write(COMMAND, c.ow2.controller, 'input_pos', c.z_to_turns(c.z_command))
+            if self.f_end != self.f_start:
+                c.f_command = self.f_start + i / ticks * (self.f_end - self.f_start)
+                c.drv1_arbiter.write(COMMAND, c.ow1.controller, 'input_vel', c.f_command / c.magnet_gr)
+        with c.heading_lock:
+            c.heading_unwrapped = self.h_end
+        stream_time = time.perf_counter() - t0
+
+        c.drv1_arbiter.write(COMMAND, heading_config, 'input_mode', heading_input_mode)
+        c.drv2_arbiter.write(COMMAND, z_config, 'input_mode', z_input_mode)
+
+        # Watch for both axes to arrive, the heading encoder at the compensated command
+        h_command = c.compensate_heading(self.h_end, direction)
+        heading_arrival, z_arrival = None, None
+        while heading_arrival is None or z_arrival is None:
+            now = time.perf_counter()
+            if now - t0 > self.duration + self.arrival_timeout:
+                break
+            heading_pos = c.drv1_arbiter.submit(TELEMETRY, getattr, c.ow3.encoder, 'pos_estimate')
+            z_pos = c.drv2_arbiter.read(TELEMETRY, c.ow2.encoder, 'pos_estimate')
+            heading = (c.initial_heading - heading_pos.result() * c.heading_gr * 360)
+            z = (z_pos - c.initial_robopos) * c.roboscope_cmperturn
+            if heading_arrival is None and abs(heading - h_command) < self.heading_tolerance:
+                heading_arrival = now - t0
+            if z_arrival is None and abs(z - self.z_end) < self.z_tolerance:
+                z_arrival = now - t0
+            self.loop.wait()
+
+        skew = None if heading_arrival is None or z_arrival is None else heading_arrival - z_arrival
+        self.report = {'duration': self.duration, 'stream_time': stream_time, 'heading_arrival': heading_arrival,
+                       'z_arrival': z_arrival, 'skew': skew}
+        if skew is None:
+            print(f"Coordinated move: an axis did not arrive within {self.arrival_timeout} s. {self.report}")
+        else:
+            print(f"Coordinated move in {self.duration:.2f} s, arrival skew {skew * 1000:.0f} ms "
+                  f"(heading minus roboscope).")
+        self.moveFinished.emit(self.report)
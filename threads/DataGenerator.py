@@ -1,32 +1,138 @@
+import threading
+import time
 import numpy as np
 from pyqtgraph.Qt import QtCore
+from telemetry import TelemetryFrame, T, HEADING, Z, SPINNER, HEADING_CMD, Z_CMD, SPINNER_CMD, SPINNER_CURRENT, FET_TEMP
+from misc_functions import PeriodicLoop
 
 
 class Generator(QtCore.QThread):
-    """Debugging thread that generates random data to send to the plot in place of the national instruments cards.
+    """Synthetic telemetry source for stress-testing the telemetry to GUI pipeline.
 
-    Uses np.random.normal to generate random data in a loop. Data is then emitted using the custom signal.
+    Emits realistic heading, roboscope and spinner telemetry frames on the same signal as ODriveController, at a configurable
+    sample rate and batch size, so the rate at which the GUI can no longer keep up can be found without the hardware.
+    All sample buffers are preallocated.
 
+    Every batch is followed by newBatch(sequence number, emit time). Connected to `ack` (which runs in the GUI thread
+    after the plots have handled the batch), it measures the lag from emission to display. When more than
+    `max_in_flight` batches are waiting on the GUI, new batches are dropped instead of queued and counted as dropped
+    samples. A summary is printed and emitted with newReport once a second.
+
+    Attributes:
+        rate (float): telemetry sample rate [Hz], from 10 Hz to tens of kHz
+        batch (int): samples per emitted batch
+        max_in_flight (int): batches allowed to wait on the GUI before dropping
     """
-    newData = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal 'newData'
+    newTelemetry = QtCore.pyqtSignal(object)
+    newBatch = QtCore.pyqtSignal(int, float)
+    newReport = QtCore.pyqtSignal(object)
 
-    def __init__(self, multi, freq, chunksize=100, delay=20):
+    def __init__(self, rate=10, batch=1, max_in_flight=8, report_interval=1.0, lag=0.05):
         super().__init__()
-        self.chunksize = chunksize
-        self.delay = delay
-        self.multi = multi
-        self.freq = freq
-        self.output = np.zeros([6, self.chunksize])
+        self.rate = rate
+        self.batch = batch
+        self.max_in_flight = max_in_flight
+        self.report_interval = report_interval
+        self.lag = lag  # the measured channels trail the commanded ones by this much [s]
         self.running = False
 
+        # One frame per batch that may be in flight, a frame is only reused once the GUI has acknowledged it
+        self.frames = [TelemetryFrame(batch) for _ in range(max_in_flight)]
+        self.offsets = np.arange(batch) / rate  # sample times within a batch, relative to its first sample
+        self.noise = np.random.standard_normal(4096)  # cycled through for the encoder noise
+        self.noise_index = np.arange(batch)
+        self.emitted = 0
+        self.loop = PeriodicLoop(batch / rate, name='Load generator')
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.lags = []
+
+    def fill(self, frame, t0):
+        """Write one batch of telemetry starting at time t0 (perf_counter s) into `frame`, without allocating."""
+        t, heading, z, spinner = frame.data[T], frame.data[HEADING], frame.data[Z], frame.data[SPINNER]
+        heading_cmd, z_cmd, spinner_cmd = frame.data[HEADING_CMD], frame.data[Z_CMD], frame.data[SPINNER_CMD]
+        frame.n = self.batch
+
+        # Commanded, then measured `lag` seconds behind
+        for time_offset, heading, z in ((0, heading_cmd, z_cmd), (self.lag, heading, z)):
+            np.add(self.offsets, t0 - time_offset, out=t)
+
+            # Heading: switchback-like ±35° square wave around 180° every 0.2 s
+            np.divide(t, 0.2, out=heading)
+            np.floor(heading, out=heading)
+            np.remainder(heading, 2, out=heading)
+            np.multiply(heading, 70, out=heading)
+            np.add(heading, 145, out=heading)
+
+            # Roboscope: slow sweep between 0 and 20 cm
+            np.multiply(t, 2 * np.pi / 20, out=z)
+            np.sin(z, out=z)
+            np.multiply(z, 10, out=z)
+            np.add(z, 10, out=z)
+        np.add(self.offsets, t0, out=t)
+
+        # Spinner: 10 Hz with encoder noise
+        np.add(self.noise_index, self.batch, out=self.noise_index)
+        np.take(self.noise, self.noise_index, out=spinner, mode='wrap')
+        np.multiply(spinner, 0.05, out=spinner)
+        np.add(spinner, 10, out=spinner)
+        spinner_cmd.fill(10)
+
+        # Spinner current, about what the simulated ODrive draws at 10 Hz, and no FET thermistor
+        np.multiply(spinner, 0.2, out=frame.data[SPINNER_CURRENT])
+        frame.data[FET_TEMP].fill(np.nan)
+
     def run(self):
         """ This method runs when the thread is started."""
         self.running = True
+        self.loop.period = self.batch / self.rate
+        self.loop.reset()
+        last_report = time.perf_counter()
+        seq = 0
         while self.running:
-            try:
-                self.output = self.multi * np.random.normal(size=(6, self.chunksize))
-                self.newData.emit(self.output)  # send the new output to the pyqtSignal 'newData'
-                QtCore.QThread.msleep(self.delay)
-            except Exception as e:
-                print(str(e))
-                pass
+            self.loop.wait()
+            t_batch = self.loop.deadline - self.loop.period  # the batch holds the samples of the period that just ended
+
+            with self.lock:
+                full = self.in_flight >= self.max_in_flight
+                if full:
+                    self.dropped += self.batch
+                else:
+                    self.in_flight += 1
+                    self.sent += self.batch
+
+            if not full:
+                # Batches are acknowledged in order, so this frame's previous batch has already been plotted
+                frame = self.frames[self.emitted % self.max_in_flight]
+                self.emitted += 1
+                self.fill(frame, t_batch)
+                self.newTelemetry.emit(frame)
+                self.newBatch.emit(seq, time.perf_counter())
+            seq += 1
+
+            now = time.perf_counter()
+            if now - last_report > self.report_interval:
+                self.report(now - last_report)
+                last_report = now
+
+    def ack(self, seq, t_emit):
+        """Slot for newBatch, runs in the GUI thread once the batch has been plotted."""
+        lag = time.perf_counter() - t_emit
+        with self.lock:
+            self.in_flight -= 1
+            self.lags.append(lag)
+
+    def report(self, interval):
+        """Print and emit the delivered rate, dropped samples and GUI lag since the last report."""
+        with self.lock:
+            sent, dropped, lags = self.sent, self.dropped, self.lags
+            self.sent, self.dropped, self.lags = 0, 0, []
+        lags = np.array(lags) if lags else np.zeros(1)
+        stats = {'rate': self.rate, 'delivered': sent / interval, 'dropped': dropped,
+                 'lag_mean': lags.mean(), 'lag_max': lags.max()}
+        print(f"Load test at {self.rate:.0f} Hz: delivered {stats['delivered']:.0f} samples/s, "
+              f"dropped {dropped}, GUI lag mean {stats['lag_mean'] * 1000:.1f} ms, max {stats['lag_max'] * 1000:.1f} ms")
+        self.newReport.emit(stats)
@@ -0,0 +1,120 @@
+import csv
+import threading
+import numpy as np
+from pyqtgraph.Qt import QtCore
+from misc_functions import PeriodicLoop
+
+
+class FrequencySweep(QtCore.QThread):
+    """Steps the magnet frequency through a ladder and measures the spinner frequency reached at every step.
+
+    Each step ramps linearly from the previous frequency to the step's frequency over `ramp` seconds, then holds it
+    for `dwell` seconds. The frequency is set through the rig's ControlState, so it reaches
+    ODriveController.update_magnet_rotation_rate like any other change (and shows in the Parameter Tree). All waits
+    are on absolute deadlines, so the dwell times stay exact over a long sweep.
+
+    Telemetry frames handed to `on_telemetry` are gated by their sample timestamps: only spinner samples from the
+    settled part of each dwell, after the first `settle` seconds, count towards that step. When the sweep ends the
+    frequency goes back to where it was, and the results are emitted with sweepFinished.
+
+    Attributes:
+        frequencies (np.ndarray): the commanded frequency of every step [Hz]
+        results (list): per step dict of commanded and achieved (mean, std) frequency and the number of samples
+    """
+    progress = QtCore.pyqtSignal(int, int)  # steps done, total steps
+    sweepFinished = QtCore.pyqtSignal(object)
+
+    def __init__(self, state, start, stop, step, dwell, ramp=0.0, settle=0.5, tick=0.02, latency=0.3):
+        super().__init__()
+        self.state = state
+        self.dwell = dwell
+        self.ramp = ramp
+        self.settle = settle
+        self.latency = latency  # time for the telemetry of the last step to arrive [s]
+        self.loop = PeriodicLoop(tick, name='Frequency sweep')
+        self.running = False
+
+        step = abs(step) if stop >= start else -abs(step)
+        self.frequencies = np.arange(start, stop + step / 2, step)
+        self.windows = []  # (start, end) of the settled part of every step, time.perf_counter() s
+        self.sums = np.zeros((len(self.frequencies), 3))  # per step: samples, sum, sum of squares
+        self.lock = threading.Lock()
+        self.results = []
+
+    def set_frequency(self, f):
+        self.state.set(('Rolling', 'Frequency'), float(f))
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        initial = self.state.get(('Rolling', 'Frequency'))
+        previous = initial
+        self.loop.reset()
+        self.loop.wait(0)  # start the schedule now
+        for index, f in enumerate(self.frequencies):
+            if not self.running:
+                break
+
+            # Ramp, one setpoint per tick
+            ticks = int(round(self.ramp / self.loop.period))
+            for i in range(1, ticks + 1):
+                self.loop.wait()
+                self.set_frequency(previous + i / ticks * (f - previous))
+            if ticks == 0:
+                self.set_frequency(f)
+            previous = f
+
+            # Dwell, measuring the settled part
+            t_dwell = self.loop.deadline
+            with self.lock:
+                self.windows.append((t_dwell + self.settle, t_dwell + self.dwell))
+            self.hold(self.dwell)
+            self.progress.emit(index + 1, len(self.frequencies))
+
+        self.set_frequency(initial)
+        self.msleep(int(self.latency * 1000))
+        self.results = self.tabulate()
+        self.print_table()
+        self.running = False
+        self.sweepFinished.emit(self.results)
+
+    def hold(self, duration):
+        """Wait until `duration` seconds after the current deadline, a tick at a time so a stop is noticed quickly."""
+        end = self.loop.deadline + duration
+        while self.running and end - self.loop.deadline > self.loop.period:
+            self.loop.wait()
+        if self.running and end - self.loop.deadline > 1e-6:  # not just rounding left over from the ticks
+            self.loop.wait(end - self.loop.deadline)
+
+    def on_telemetry(self, frame):
+        """Slot for the controller's newTelemetry, adds the settled spinner samples to their steps."""
+        with self.lock:
+            windows = list(enumerate(self.windows))[-2:]  # a frame can straddle two steps
+        t = frame.t
+        for index, (start, end) in windows:
+            spinner = frame.spinner[(t >= start) & (t < end)]
+            if spinner.size:
+                with self.lock:
+                    self.sums[index] += (spinner.size, spinner.sum(), np.dot(spinner, spinner))
+
+    def tabulate(self):
+        results = []
+        with self.lock:
+            for f, (n, total, total_sq) in zip(self.frequencies[:len(self.windows)], self.sums):
+                mean = total / n if n else np.nan
+                std = np.sqrt(max(0.0, total_sq / n - mean * mean)) if n else np.nan
+                results.append({'commanded': float(f), 'achieved': float(mean), 'std': float(std), 'samples': int(n)})
+        return results
+
+    def print_table(self):
+        print(f"Frequency sweep, {self.dwell} s dwell ({self.settle} s settling), {self.ramp} s ramps:")
+        print("  commanded [Hz]  achieved [Hz]  std [Hz]  samples")
+        for r in self.results:
+            print(f"  {r['commanded']:14.2f}  {r['achieved']:13.3f}  {r['std']:8.3f}  {r['samples']:7d}")
+
+    def save_csv(self, filename):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['commanded', 'achieved', 'std', 'samples'])
+            writer.writeheader()
+            writer.writerows(self.results)
+        print(f"Saved {len(self.results)} sweep steps to {filename}")
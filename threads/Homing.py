@@ -0,0 +1,198 @@
+import time
+from pyqtgraph.Qt import QtCore
+from odrive.enums import *
+from misc_functions import PeriodicLoop
+from threads.Arbiter import COMMAND, TELEMETRY
+
+
+class RoboscopeHoming(QtCore.QThread):
+    """Finds the roboscope end stop and sets the origin of Z (ODriveController.initial_robopos) from it.
+
+    The roboscope is driven in velocity control towards the end stop at `fast_vel` until it stalls, backs off by
+    `backoff` turns, then touches the end stop again at `slow_vel`. A stall is the measured velocity staying below
+    `stall_fraction` of the commanded one for `stall_time`, and, if `stall_current` is set, the motor current staying
+    above it (the current threshold depends on the rig's current limit, so it is off by default). The position of the
+    slow touch is the reference, and Z = 0 is `home_offset` cm away from it.
+
+    The watchdog's roboscope bounds check is suspended while homing, since the end stop lies outside them. Afterwards
+    the roboscope goes back to position control at the current Z setpoint, measured from the new origin, and is left
+    idle there unless the motors are engaged. The time taken and the shift of the origin are reported with homingFinished.
+
+    All board I/O goes through the roboscope board's arbiter, commands at COMMAND and measurements at TELEMETRY
+    priority. A safety idle on that board while homing (the motors released, a watchdog trip) aborts it, and the
+    roboscope is not put back into closed loop afterwards.
+
+    Attributes:
+        controller: the ODriveController whose roboscope is homed
+        direction (int): -1 when the end stop is below Z = 0, +1 when above
+        report (dict): filled in when homing finishes, also emitted with homingFinished
+        running (bool): clearing it aborts homing, which leaves the origin unchanged and the roboscope idle
+        released (bool): a safety idle happened on the roboscope board while homing
+    """
+    homingFinished = QtCore.pyqtSignal(object)
+
+    def __init__(self, controller, direction=-1, fast_vel=2.0, slow_vel=0.2, backoff=0.1, home_offset=0.5,
+                 stall_fraction=0.2, stall_time=0.05, stall_current=None, grace=0.2, max_travel=10.0, tick=0.005):
+        super().__init__()
+        self.controller = controller
+        self.direction = direction
+        self.fast_vel = fast_vel  # [turns/s]
+        self.slow_vel = slow_vel  # [turns/s]
+        self.backoff = backoff  # [turns]
+        self.home_offset = home_offset  # [cm]
+        self.stall_fraction = stall_fraction
+        self.stall_time = stall_time  # [s]
+        self.stall_current = stall_current  # [A]
+        self.grace = grace  # time to get up to speed before a stall can be detected [s]
+        self.max_travel = max_travel  # give up when no end stop was found within this many turns
+        self.loop = PeriodicLoop(tick, name='Roboscope homing')
+        self.report = None
+        self.safeties = 0
+        self.released = False
+        self.running = False
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        c = self.controller
+        arbiter = c.drv2_arbiter
+        axis = c.ow2
+        config = axis.controller.config
+        self.safeties = arbiter.safeties
+        self.released = False
+        input_mode = arbiter.read(COMMAND, config, 'input_mode')
+        c.watchdog.check_z = False
+
+        t0 = time.perf_counter()
+        arbiter.write(COMMAND, axis.controller, 'input_vel', 0.0)
+        arbiter.write(COMMAND, config, 'control_mode', CONTROL_MODE_VELOCITY_CONTROL)
+        arbiter.write(COMMAND, config, 'input_mode', INPUT_MODE_PASSTHROUGH)
+        arbiter.write(COMMAND, axis, 'requested_state', AXIS_STATE_CLOSED_LOOP_CONTROL)
+
+        fast = self.seek(self.fast_vel)
+        t_fast = time.perf_counter()
+        slow = None
+        if fast is not None and self.back_off(fast):
+            slow = self.seek(self.slow_vel)
+        t_slow = time.perf_counter()
+
+        # Back to position control, which starts from wherever the axis is on entering closed loop
+        arbiter.write(COMMAND, axis.controller, 'input_vel', 0.0)
+        arbiter.write(COMMAND, axis, 'requested_state', AXIS_STATE_IDLE)
+        arbiter.write(COMMAND, config, 'control_mode', CONTROL_MODE_POSITION_CONTROL)
+        arbiter.write(COMMAND, config, 'input_mode', input_mode).result()
+        previous = c.initial_robopos
+        if slow is not None:
+            c.initial_robopos = slow - self.direction * self.home_offset / c.roboscope_cmperturn
+        if self.active():  # an abort or a safety idle leaves the roboscope idle
+            # Queued behind the check, so a safety idle from here on still cancels or follows it
+            arbiter.write(COMMAND, axis, 'requested_state', AXIS_STATE_CLOSED_LOOP_CONTROL)
+            c.update_roboscope()
+            if not c.watchdog.armed:  # the motors aren't engaged
+                self.wait_arrival()
+                arbiter.write(COMMAND, axis, 'requested_state', AXIS_STATE_IDLE)
+        c.watchdog.check_z = True
+
+        self.report = {'success': slow is not None, 'time': time.perf_counter() - t0, 'fast_time': t_fast - t0,
+                       'slow_time': t_slow - t_fast, 'origin': c.initial_robopos,
+                       'shift': (c.initial_robopos - previous) * c.roboscope_cmperturn,
+                       'repeatability': None if slow is None else (slow - fast) * c.roboscope_cmperturn}
+        if slow is None:
+            if self.released:
+                reason = 'motors released'
+            elif not self.running:
+                reason = 'aborted'
+            else:
+                reason = f"no end stop within {self.max_travel} turns"
+            self.report['reason'] = reason
+            print(f"Roboscope homing failed ({reason}), origin unchanged.")
+        else:
+            print(f"Roboscope homed in {self.report['time']:.2f} s (approach {self.report['fast_time']:.2f} s, "
+                  f"touch {self.report['slow_time']:.2f} s). Origin moved {self.report['shift']:+.3f} cm, fast and "
+                  f"slow touch {self.report['repeatability'] * 10:+.2f} mm apart.")
+        self.running = False
+        self.homingFinished.emit(self.report)
+
+    def active(self):
+        """Whether homing goes on: not aborted, and no safety idle on the roboscope board since it started."""
+        if self.controller.drv2_arbiter.safeties != self.safeties:
+            self.released = True
+        return self.running and not self.released
+
+    def measure(self):
+        """Position [turns], velocity [turns/s] and current [A] of the roboscope, read as one board transaction."""
+        axis = self.controller.ow2
+        return axis.encoder.pos_estimate, axis.encoder.vel_estimate, axis.motor.current_control.Iq_measured
+
+    def seek(self, speed):
+        """Drive towards the end stop at `speed` [turns/s] until it stalls.
+
+        Returns:
+            the position of the stall [turns], or None if there was none within max_travel or homing was aborted
+        """
+        arbiter = self.controller.drv2_arbiter
+        axis = self.controller.ow2
+        start = arbiter.read(TELEMETRY, axis.encoder, 'pos_estimate')
+        arbiter.write(COMMAND, axis.controller, 'input_vel', self.direction * speed)
+        self.loop.reset()
+        t_start = time.perf_counter()
+        stall_start = None
+        while self.active():
+            t = self.loop.wait()
+            pos, vel, current = arbiter.call(TELEMETRY, self.measure)
+            if abs(pos - start) > self.max_travel:
+                break
+            stalled = abs(vel) < self.stall_fraction * speed
+            if stalled and self.stall_current is not None:
+                stalled = abs(current) >= self.stall_current
+            if not stalled or t - t_start < self.grace:
+                stall_start = None
+            elif stall_start is None:
+                stall_start = t
+            elif t - stall_start >= self.stall_time:
+                arbiter.write(COMMAND, axis.controller, 'input_vel', 0.0)
+                return pos if self.active() else None  # an idle stalls it too
+        arbiter.write(COMMAND, axis.controller, 'input_vel', 0.0)
+        return None
+
+    def back_off(self, stop):
+        """Drive away from the end stop at `stop` until `backoff` turns clear of it. Returns False if aborted."""
+        arbiter = self.controller.drv2_arbiter
+        axis = self.controller.ow2
+        arbiter.write(COMMAND, axis.controller, 'input_vel', -self.direction * self.fast_vel)
+        self.loop.reset()
+        while self.active() and \
+                self.direction * (stop - arbiter.read(TELEMETRY, axis.encoder, 'pos_estimate')) < self.backoff:
+            self.loop.wait()
+        arbiter.write(COMMAND, axis.controller, 'input_vel', 0.0)
+        return self.active()
+
+    def wait_arrival(self, tolerance=0.05, timeout=3.0):
+        """Wait until the roboscope is within `tolerance` cm of its setpoint, or `timeout` seconds."""
+        c = self.controller
+        end = time.perf_counter() + timeout
+        self.loop.reset()
+        while time.perf_counter() < end:
+            pos = c.drv2_arbiter.read(TELEMETRY, c.ow2.encoder, 'pos_estimate')
+            if abs(pos - c.z_to_turns(c.z)) * c.roboscope_cmperturn < tolerance:
+                return
+            self.loop.wait()
+
+
+if __name__ == '__main__':
+    # Home the simulated roboscope, which starts 0.4 turns above its end stop, and check the origin it finds.
+    # Run from the top folder with `python -m threads.Homing`
+    import sys
+    from pyqtgraph.Qt import QtWidgets
+    from threads.ODriveController import ODriveController
+
+    app = QtWidgets.QApplication([])
+    ctrl = ODriveController(simulate=True)
+    ctrl.run()
+    homing = RoboscopeHoming(ctrl)
+    homing.run()
+    expected = ctrl.ow2.end_stop + homing.home_offset / ctrl.roboscope_cmperturn
+    error = (homing.report['origin'] - expected) * ctrl.roboscope_cmperturn * 10
+    print(f"Origin error {error:+.3f} mm")
+    ctrl.stop()
+    sys.exit(0 if abs(error) < 0.1 else 1)
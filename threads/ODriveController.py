@@ -1,21 +1,43 @@
+import threading
 import numpy as np
 from pyqtgraph.Qt import QtCore
-from misc_functions import qtsleep, unit_vector
+from misc_functions import PeriodicLoop, unit_vector, shortest_angle_delta
 import odrive
 from odrive.enums import *
 import fibre.libfibre
-from time import sleep
+from time import sleep, perf_counter
+from threads.Watchdog import Watchdog
+from threads.PhaseStreamer import MagnetPhaseEstimator, PhaseStreamer
+from threads.CoordinatedMove import CoordinatedMove
+from threads.Homing import RoboscopeHoming
+from threads.Arbiter import BoardArbiter, SAFETY, COMMAND, TELEMETRY
+from telemetry import TelemetryFrame
+from bandwidth import BandwidthScheduler
+from backlash import HeadingCompensation
 
 class DataRetriever(QtCore.QThread):
     """ Sub-thread of ODriveController that reads the current position of the axes.
+
+    Raw readings, and the setpoints they are responding to, are packed into a TelemetryFrame of `batch` samples,
+    which is emitted once full. The watchdog and the phase estimator still get every sample as soon as it is read.
+
+    With `arbiters` (the BoardArbiters of drv1 and drv2), each board's readings are one telemetry transaction, the two
+    boards are read in parallel, and the period backs off while the boards are busy with commands.
     """
-    newDataSUB = QtCore.pyqtSignal(object)
+    newFrameSUB = QtCore.pyqtSignal(object)
 
-    def __init__(self, ows):
+    def __init__(self, ows, watchdog=None, phase_estimator=None, batch=1, period=0.1, name='Telemetry', setpoints=None,
+                 arbiters=None):
         super().__init__()
+        self.arbiters = arbiters
         self.running = False
+        self.batch = batch
+        self.setpoints = setpoints  # returns the commanded (heading, z, frequency) to record with each sample
+        self.loop = PeriodicLoop(period, name=name)
 
         self.ows = ows
+        self.watchdog = watchdog  # fed directly from this thread so safety checks skip the GUI event loop
+        self.phase_estimator = phase_estimator
 
     def read_pos(self, axis):
         return axis.encoder.pos_estimate
@@ -23,31 +45,85 @@ class DataRetriever(QtCore.QThread):
     def read_vel(self, axis):
         return axis.encoder.vel_estimate
 
+    def read_current(self, axis):
+        return axis.motor.current_control.Iq_measured
+
+    @staticmethod
+    def find_fet_thermistor(axis):
+        """The FET thermistor of an axis, which moved from `axis` to `axis.motor` in firmware 0.5.2. None on firmware
+        without one."""
+        for owner in (axis.motor, axis):
+            try:
+                return owner.fet_thermistor
+            except AttributeError:
+                pass
+        return None
+
+    def read_drv1(self, thermistor):
+        """Heading and spinner readings, the time the spinner was sampled, its current and the FET temperature."""
+        ow3pos = self.read_pos(self.ows[2])  # heading
+        t_before = perf_counter()
+        ow1pos = self.read_pos(self.ows[0])  # spinner
+        ow1vel = self.read_vel(self.ows[0])
+        t_spinner = (t_before + perf_counter()) / 2  # best guess of when the spinner was sampled
+        ow1current = self.read_current(self.ows[0])
+        fet_temp = thermistor.temperature if thermistor is not None else np.nan
+        return ow3pos, t_spinner, ow1pos, ow1vel, ow1current, fet_temp
+
     def run(self):
         """ This method runs when the thread is started."""
         self.running = True
+        self.loop.reset()
+        frame = TelemetryFrame(self.batch)
+        thermistor = self.find_fet_thermistor(self.ows[0])
         while self.running:
-            ow3pos = self.read_pos(self.ows[2])  # heading
-            ow2pos = self.read_pos(self.ows[1])  # roboscope
-            ow1vel = self.read_vel(self.ows[0])  # spinner
-            self.newDataSUB.emit([ow3pos, ow2pos, ow1vel])
-            qtsleep(0.1)
-            
+            if self.arbiters is None:
+                drv1 = self.read_drv1(thermistor)
+                ow2pos = self.read_pos(self.ows[1])  # roboscope
+                interval = None
+            else:
+                drv1_read = self.arbiters[0].submit(TELEMETRY, self.read_drv1, thermistor)
+                ow2pos = self.arbiters[1].call(TELEMETRY, self.read_pos, self.ows[1])
+                drv1 = drv1_read.result()
+                interval = max(arbiter.telemetry_interval(self.loop.period) for arbiter in self.arbiters)
+            ow3pos, t_spinner, ow1pos, ow1vel, ow1current, fet_temp = drv1
+            if self.phase_estimator is not None:
+                self.phase_estimator.update(t_spinner, ow1pos, ow1vel)
+            if self.watchdog is not None:
+                self.watchdog.feed(perf_counter(), [ow3pos, ow2pos, ow1vel])
+            commanded = self.setpoints() if self.setpoints is not None else (np.nan, np.nan, np.nan)
+            if frame.append(t_spinner, ow3pos, ow2pos, ow1vel, ow1pos, *commanded, ow1current, fet_temp):
+                self.newFrameSUB.emit(frame)
+                frame = TelemetryFrame(self.batch)
+            self.loop.wait(interval)
+
 
 class ODriveController(QtCore.QThread):
     """Thread for sending and recieving commands to the ODrive.
 
     """
-    newheadingpos = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal
-    newrobopos = QtCore.pyqtSignal(object)
-    newspinnervel = QtCore.pyqtSignal(object)
+    newTelemetry = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal, a TelemetryFrame
+    connected = QtCore.pyqtSignal()  # Emitted once the boards are found, configured and telemetry is running
+    homed = QtCore.pyqtSignal(object)  # Emitted with the RoboscopeHoming report when homing finishes
+    ioError = QtCore.pyqtSignal(str)  # Emitted when idling a motor failed on its board, with what failed
 
-    def __init__(self):
+    def __init__(self, simulate=False, drv1_serial="208739A04D4D", drv2_serial="207539694D4D"):
         super().__init__()
         self.running = False
+        self.simulate = simulate  # use the software model in sim_odrive.py instead of the hardware
 
         self.mode = "Rolling"
 
+        # Board serial numbers, one pair per rig (see rigs.py)
+        self.drv1_serial = drv1_serial  # heading and spinner
+        self.drv2_serial = drv2_serial  # roboscope
+
+        # Every read and write on a board goes through its arbiter: idle first, then commands, then telemetry
+        self.drv1_arbiter = BoardArbiter(f"I/O {drv1_serial}")
+        self.drv2_arbiter = BoardArbiter(f"I/O {drv2_serial}")
+        self.drv1_arbiter.safetyFailed.connect(self.ioError)
+        self.drv2_arbiter.safetyFailed.connect(self.ioError)
+
         # Gear Ratios
         self.magnet_gr = 3/10 # 4/15 for old 3d printed pulley
         self.heading_gr = 3/19
@@ -60,9 +136,64 @@ class ODriveController(QtCore.QThread):
         self.f = 0.0
         self.h = 138.5
 
+        # Continuous heading setpoint in degrees. Unlike h it doesn't wrap at 0/360, so every heading change can take
+        # the short way around. The limits keep the heading gear from winding up the cables, in unwrapped degrees.
+        self.heading_unwrapped = self.h
+        # Magnet heading of the setpoint last sent to the board, unwrapped. h can be ahead of it (an update the GUI
+        # hasn't sent yet, the target of a coordinated move that is still streaming). The watchdog checks against it.
+        self.heading_command = self.h
+        self.heading_wrap_limits = (self.initial_heading - 360, self.initial_heading + 360)
+
+        # Backlash and nonlinearity of the heading belt, measured with backlash.py and loaded when the boards connect.
+        # The direction the heading last moved in (+1 increasing, -1 decreasing) picks the side of the backlash.
+        self.heading_compensation = None
+        self.heading_direction = 1
+        self.sim_heading_backlash = 0.02  # [motor turns]
+        # The spinner's vel_limit is configured on the rig boards, well above the firmware default of 2 turns/s that
+        # the simulated boards start with
+        self.sim_spinner_vel_limit = 200.0  # [turns/s]
+
+        # Held while the heading setpoint state above is read and updated, which happens from the GUI, swarm, macro
+        # and coordinated move threads
+        self.heading_lock = threading.Lock()
+
         # Roboscope distance
         self.z = 0.0  # distance the roboscope has moved
-        
+
+        # The Z and frequency last sent to the boards. Like heading_command these are what the telemetry records as
+        # commanded, since z and f can be ahead of them while a coordinated move runs.
+        self.z_command = self.z
+        self.f_command = self.f
+
+        # Position filter tuning, see tuning.py for measuring these
+        self.heading_filter_bandwidth = 6.0
+        self.heading_vel_limit = 15
+        self.roboscope_filter_bandwidth = 4.0
+
+        # Adapts the heading filter bandwidth to the heading commands when enabled, see bandwidth.py
+        self.heading_bandwidth_scheduler = BandwidthScheduler(self.heading_filter_bandwidth)
+
+        # Safety watchdog, idles the axes when telemetry goes out of bounds or stops arriving
+        self.watchdog = Watchdog(self)
+
+        # Samples per telemetry frame, and the telemetry read period [s]
+        self.telemetry_batch = 1
+        self.telemetry_period = 0.1
+
+        # Magnet phase, extrapolated between spinner readings and published for camera synchronization
+        self.phase_estimator = MagnetPhaseEstimator(self.magnet_gr)
+        self.phase_stream_rate = 100  # [Hz]
+        self.phasestreamer = PhaseStreamer(self.phase_estimator, self.phase_stream_rate)
+
+        # Synchronized multi-axis moves, see coordinated_move
+        self.move = None
+        self.move_in_progress = False
+
+        # Roboscope homing against its end stop, see home_roboscope. With home_on_connect the origin of Z is found
+        # every time the boards are connected, instead of taken from wherever the roboscope happens to be.
+        self.homing = None
+        self.homing_in_progress = False
+        self.home_on_connect = False
 
 
     def run(self):
@@ -70,8 +201,17 @@ class ODriveController(QtCore.QThread):
 
         # Find a connected ODrive (this will block until you connect one)
         print("Finding ODrives...")
-        drv1 = odrive.find_any(serial_number="208739A04D4D")
-        drv2 = odrive.find_any(serial_number="207539694D4D")
+        if self.simulate:
+            import sim_odrive
+            drv1 = sim_odrive.find_any(serial_number=self.drv1_serial)
+            drv2 = sim_odrive.find_any(serial_number=self.drv2_serial)
+            if drv2.axis0.end_stop is None:
+                drv2.axis0.end_stop = drv2.axis0.pos - 0.4  # like the rigs, not parked right at home
+            drv1.axis0.backlash = self.sim_heading_backlash
+            drv1.axis1.controller.config.vel_limit = self.sim_spinner_vel_limit
+        else:
+            drv1 = odrive.find_any(serial_number=self.drv1_serial)
+            drv2 = odrive.find_any(serial_number=self.drv2_serial)
 
 
         self.ow3 = drv1.axis0  # heading
@@ -79,71 +219,256 @@ class ODriveController(QtCore.QThread):
         self.ow2 = drv2.axis0  # roboscope
         
         self.ows = [self.ow1, self.ow2, self.ow3]
+        self.arbiters = [self.drv1_arbiter, self.drv2_arbiter, self.drv1_arbiter]  # of each of ows
         print("found ows")
 
+        self.heading_compensation = HeadingCompensation.load(self.heading_compensation_file(), self.heading_gr,
+                                                             self.initial_heading)
+        if self.heading_compensation is not None:
+            print(f"Compensating heading backlash of {self.heading_compensation.backlash:.2f}°")
+
         self.ow1.controller.config.control_mode = CONTROL_MODE_VELOCITY_CONTROL
         self.ow3.controller.config.control_mode = CONTROL_MODE_POSITION_CONTROL
         self.ow2.controller.config.control_mode = CONTROL_MODE_POSITION_CONTROL
 
         # apply filter for roboscope position control
-        self.ow2.controller.config.input_filter_bandwidth = 4.0
+        self.ow2.controller.config.input_filter_bandwidth = self.roboscope_filter_bandwidth
         self.ow2.controller.config.input_mode = INPUT_MODE_POS_FILTER
 
         # apply filter for heading position control
-        self.ow3.controller.config.vel_limit = 15
-        self.ow3.controller.config.input_filter_bandwidth = 6.0
+        self.ow3.controller.config.vel_limit = self.heading_vel_limit
+        self.ow3.controller.config.input_filter_bandwidth = self.heading_filter_bandwidth
         self.ow3.controller.config.input_mode = INPUT_MODE_POS_FILTER
 
         #self.ow3.controller.config.input_mode = INPUT_MODE_PASSTHROUGH
 
+        self.drv1_arbiter.start(QtCore.QThread.HighPriority)
+        self.drv2_arbiter.start(QtCore.QThread.HighPriority)
+
         self.update_heading()
         self.update_magnet_rotation_rate()
 
         self.initial_robopos = self.ow2.encoder.pos_estimate
         self.robopos = self.initial_robopos
 
+        self.watchdog.start()
+        self.watchdog.setPriority(QtCore.QThread.TimeCriticalPriority)
+
         # open a reading thread
-        self.dataretriever = DataRetriever(self.ows)
-        self.dataretriever.newDataSUB.connect(self.pass_data_up)
+        self.dataretriever = DataRetriever(self.ows, self.watchdog, self.phase_estimator, self.telemetry_batch,
+                                           self.telemetry_period, name=f"Telemetry {self.drv1_serial}",
+                                           setpoints=lambda: (self.heading_command % 360, self.z_command,
+                                                              self.f_command),
+                                           arbiters=(self.drv1_arbiter, self.drv2_arbiter))
+        self.dataretriever.newFrameSUB.connect(self.pass_data_up)
         self.dataretriever.start()
 
+        self.phasestreamer.rate = self.phase_stream_rate
+        self.phasestreamer.start()
+
+        if self.home_on_connect:
+            self.home_roboscope().wait()
+
+        self.connected.emit()
+
     def set_heading_filter_bandwidth(self, b):
-        self.ow3.controller.config.input_filter_bandwidth = b
+        self.heading_filter_bandwidth = b
+        self.heading_bandwidth_scheduler.base = b
+        self.heading_bandwidth_scheduler.current = b
+        self.drv1_arbiter.write(COMMAND, self.ow3.controller.config, 'input_filter_bandwidth', b)
+
+    def set_adaptive_heading_bandwidth(self, enabled):
+        """Turn the heading bandwidth scheduler on or off. Turning it off restores the set bandwidth."""
+        self.heading_bandwidth_scheduler.enabled = enabled
+        if not enabled:
+            self.set_heading_filter_bandwidth(self.heading_filter_bandwidth)
 
     def closed_loop(self):
         """Set motors to closed loop control."""
-        for ow in self.ows:
-            ow.requested_state = AXIS_STATE_CLOSED_LOOP_CONTROL
+        for ow, arbiter in zip(self.ows, self.arbiters):
+            arbiter.write(COMMAND, ow, 'requested_state', AXIS_STATE_CLOSED_LOOP_CONTROL)
+        self.watchdog.arm()
 
     def idle(self):
-        """Release motors."""
-        for ow in self.ows:
-            ow.requested_state = AXIS_STATE_IDLE
+        """Release motors. Goes ahead of everything else queued on the boards, and returns once they are idle.
+
+        Returns:
+            whether every axis was idled. A failed write is printed and emitted with ioError by its board's arbiter.
+        """
+        self.watchdog.disarm()
+        writes = [arbiter.write(SAFETY, ow, 'requested_state', AXIS_STATE_IDLE)
+                  for ow, arbiter in zip(self.ows, self.arbiters)]
+        for write in writes:  # every board gets its idle, even when another one failed
+            write.done.wait()
+        return all(write.error is None for write in writes)
+
+    def stop(self):
+        """Idle the motors and stop the telemetry, phase and watchdog threads."""
+        if self.homing is not None and self.homing.running:
+            self.homing.running = False
+            self.homing.wait(1000)
+        self.idle()
+        for thread in (self.dataretriever, self.phasestreamer, self.watchdog):
+            thread.running = False
+            thread.wait(1000)
+        for arbiter in (self.drv1_arbiter, self.drv2_arbiter):
+            arbiter.stop()
+            print(arbiter.report())
+        self.running = False
+        self.exit()
 
     def update_magnet_rotation_rate(self):
         """Send velocity command to a the motor spinning the magnet given local variable f (Hz). Convert according to the gear ratio."""
-        self.ow1.controller.input_vel = self.f / self.magnet_gr
+        self.f_command = self.f
+        self.drv1_arbiter.write(COMMAND, self.ow1.controller, 'input_vel', self.f / self.magnet_gr)
+
+    def plan_heading(self, h):
+        """Unwrapped heading that reaches the heading h the shortest way around from the current setpoint."""
+        target = self.heading_unwrapped + shortest_angle_delta(self.heading_unwrapped, h)
+
+        # Go the long way around if the short way would wind the cables past their limits
+        if target > self.heading_wrap_limits[1]:
+            target -= 360
+        elif target < self.heading_wrap_limits[0]:
+            target += 360
+        return target
+
+    def heading_compensation_file(self):
+        """The heading compensation table of these boards, see backlash.py."""
+        return f"heading_compensation_{self.drv1_serial}{'_sim' if self.simulate else ''}.npz"
+
+    def compensate_heading(self, heading_unwrapped, direction):
+        """Unwrapped heading to command so the magnet lands on `heading_unwrapped`, approaching in `direction`."""
+        if self.heading_compensation is None:
+            return heading_unwrapped
+        return self.heading_compensation.command(heading_unwrapped, direction)
+
+    def heading_to_turns(self, heading_unwrapped):
+        """Heading gear motor position for an unwrapped heading in degrees."""
+        # + self.heading_pos_offset 138.5 + requested_heading * self.heading_gr * 360 
+        return (self.initial_heading - heading_unwrapped) / (self.heading_gr * 360)
+
+    def z_to_turns(self, z):
+        """Roboscope motor position for a roboscope distance in cm."""
+        return (z / self.roboscope_cmperturn) + self.initial_robopos
 
     def update_heading(self):
-        """Send position command to a heading gear."""
-        # + self.heading_pos_offset 138.5 + requested_heading * self.heading_gr * 360 
-        self.ow3.controller.input_pos = (self.initial_heading - self.h) / (self.heading_gr * 360)
+        """Send position command to a heading gear, taking the shortest way around to the heading h."""
+        with self.heading_lock:
+            target = self.plan_heading(self.h)
+            bandwidth = self.heading_bandwidth_scheduler.command(perf_counter(), target - self.heading_unwrapped)
+            if bandwidth is not None:
+                self.drv1_arbiter.write(COMMAND, self.ow3.controller.config, 'input_filter_bandwidth', bandwidth)
+            if target != self.heading_unwrapped:
+                self.heading_direction = 1 if target > self.heading_unwrapped else -1
+            self.heading_unwrapped = target
+            self.heading_command = target
+            command = self.compensate_heading(self.heading_unwrapped, self.heading_direction)
+            self.drv1_arbiter.write(COMMAND, self.ow3.controller, 'input_pos', self.heading_to_turns(command))
 
     def update_roboscope(self):
-        self.ow2.controller.input_pos = (self.z / self.roboscope_cmperturn) + self.initial_robopos
+        self.z_command = self.z
+        self.drv2_arbiter.write(COMMAND, self.ow2.controller, 'input_pos', self.z_to_turns(self.z))
+
+    def coordinated_move(self, heading=None, z=None, f=None, duration=None):
+        """Move the heading and roboscope (and optionally ramp the magnet frequency) so they arrive together.
 
-    def pass_data_up(self, incomingData):
-        """ Decompose odrive axis readings from subthread DataRetriever into heading degree, roboscope distance, and spinner hz.
+        Args:
+            heading (float): target heading [deg], None to hold
+            z (float): target roboscope distance [cm], None to hold
+            f (float): target magnet frequency [Hz], None to hold
+            duration (float): move time [s], None for the shortest time the axis limits allow
+
+        Returns:
+            the running CoordinatedMove thread, which emits moveFinished with the arrival skew report. None while the
+            roboscope is being homed or another move is running, when no move is made.
+        """
+        if self.homing_in_progress:
+            print("Coordinated move refused, the roboscope is being homed.")
+            return None
+        if self.move_in_progress:
+            print("Coordinated move refused, the previous move is still running.")
+            return None
+        self.move = CoordinatedMove(self, heading, z, f, duration)
+        self.move_in_progress = True  # set before the thread starts so the GUI stops sending single-axis updates
+        self.move.finished.connect(self.on_move_finished)
+        self.move.start()
+        return self.move
+
+    def on_move_finished(self):
+        """Send the setpoints changed while the move ran, which the move has been overriding with its targets."""
+        move = self.sender()  # the move that finished
+        self.move_in_progress = False
+        if self.h != move.h_end % 360:
+            self.update_heading()
+        if self.z != move.z_end:
+            self.update_roboscope()
+        if self.f != move.f_end:
+            self.update_magnet_rotation_rate()
+
+    def home_roboscope(self):
+        """Find the roboscope end stop and set the origin of Z from it, see threads/Homing.py.
+
+        Returns:
+            the running RoboscopeHoming thread, which emits homingFinished with the report. None while homing or a
+            coordinated move is already running, when the roboscope isn't homed.
+        """
+        if self.homing_in_progress:
+            print("Roboscope homing refused, it is already running.")
+            return None
+        if self.move_in_progress:
+            print("Roboscope homing refused, a coordinated move is running.")
+            return None
+        self.homing = RoboscopeHoming(self)
+        self.homing_in_progress = True  # set before the thread starts so the GUI stops sending roboscope updates
+        self.homing.homingFinished.connect(self.on_homing_finished, QtCore.Qt.DirectConnection)
+        self.homing.start()
+        return self.homing
+
+    def on_homing_finished(self, report):
+        self.homing_in_progress = False
+        self.homed.emit(report)
+
+    def convert(self, incomingData):
+        """ Convert raw odrive axis readings [heading pos, roboscope pos, spinner vel] into heading degree, roboscope
+        distance, and spinner hz.
         """
         # Heading
         # 0 is 138.5
-        #self.newheadingpos.emit(360 - (360-self.initial_heading + incomingData[0] * self.heading_gr * 360))
-        self.newheadingpos.emit(self.initial_heading - incomingData[0] * self.heading_gr * 360)
+        heading = (self.initial_heading - incomingData[0] * self.heading_gr * 360) % 360
+        if self.heading_compensation is not None:  # where the magnet is, past the belt
+            heading = (heading + self.heading_compensation.error(heading, self.heading_direction)) % 360
 
         # Roboscope
-        self.newrobopos.emit((incomingData[1] - self.initial_robopos) * self.roboscope_cmperturn)
-        #print((incomingData[1] - self.initial_robopos) * self.roboscope_cmperturn)
+        robopos = (incomingData[1] - self.initial_robopos) * self.roboscope_cmperturn
 
         # Magnet (spinner)
-        self.newspinnervel.emit(incomingData[2] * self.magnet_gr)
+        spinnervel = incomingData[2] * self.magnet_gr
+        return heading, robopos, spinnervel
+
+    def convert_frame(self, frame):
+        """ Convert a TelemetryFrame of raw readings in place, the same conversion as `convert` on the whole batch.
+        The spinner position stays in motor turns.
+        """
+        heading = frame.heading
+        heading *= -self.heading_gr * 360
+        heading += self.initial_heading
+        np.remainder(heading, 360, out=heading)
+        if self.heading_compensation is not None:
+            heading += self.heading_compensation.error(heading, self.heading_direction)
+            np.remainder(heading, 360, out=heading)
+
+        robopos = frame.z
+        robopos -= self.initial_robopos
+        robopos *= self.roboscope_cmperturn
+
+        spinnervel = frame.spinner
+        spinnervel *= self.magnet_gr
+        return frame
+
+    def pass_data_up(self, frame):
+        """ Decompose a frame of odrive axis readings from subthread DataRetriever into heading degree, roboscope
+        distance, and spinner hz, and send it on with one signal.
+        """
+        self.newTelemetry.emit(self.convert_frame(frame))
 
@@ -0,0 +1,78 @@
+import threading
+import time
+from pyqtgraph.Qt import QtCore
+from misc_functions import PeriodicLoop
+
+
+class MagnetPhaseEstimator:
+    """Estimates the rotation angle of the magnet at any moment from the spinner encoder readings.
+
+    DataRetriever hands in timestamped spinner position and velocity samples. Between samples the phase is
+    extrapolated at constant velocity, so the field orientation can be looked up for any time (e.g. a camera frame
+    timestamp) without reading the ODrive again. All timestamps are time.perf_counter() seconds.
+
+    Attributes:
+        magnet_gr (float): magnet turns per spinner motor turn
+        phase_offset (float): magnet angle when the spinner encoder reads 0 [deg]. Calibrate against the camera.
+        vel_tolerance (float): when the velocity over the last sample interval and the encoder's instantaneous
+            velocity agree within this fraction, the interval average is used since it is far less noisy
+    """
+
+    def __init__(self, magnet_gr, phase_offset=0.0, vel_tolerance=0.05):
+        self.magnet_gr = magnet_gr
+        self.phase_offset = phase_offset
+        self.vel_tolerance = vel_tolerance
+
+        self.lock = threading.Lock()
+        self.t = None  # time of the latest sample
+        self.pos = 0.0  # spinner position at t [turns]
+        self.vel = 0.0  # spinner velocity used for extrapolation [turns/s]
+
+    def update(self, t, pos, vel):
+        """Add a spinner reading taken at time `t`: position [turns] and velocity [turns/s]."""
+        with self.lock:
+            if self.t is not None and t > self.t:
+                interval_vel = (pos - self.pos) / (t - self.t)
+                if abs(interval_vel - vel) <= self.vel_tolerance * max(abs(vel), 1e-3):
+                    vel = interval_vel  # steady spinning, the long baseline gives a cleaner velocity
+            self.t, self.pos, self.vel = t, pos, vel
+
+    def phase_at(self, t):
+        """Magnet angle in degrees [0, 360) at time `t`, or None before the first reading."""
+        with self.lock:
+            if self.t is None:
+                return None
+            pos = self.pos + self.vel * (t - self.t)
+        return (pos * self.magnet_gr * 360 + self.phase_offset) % 360
+
+    def frequency(self):
+        """Current magnet rotation frequency [Hz]."""
+        with self.lock:
+            return self.vel * self.magnet_gr
+
+
+class PhaseStreamer(QtCore.QThread):
+    """Publishes the estimated magnet phase at a fixed rate for tagging camera frames.
+
+    Emits newPhase with [timestamp, phase in degrees, frequency in Hz]. Timestamps are time.perf_counter() seconds.
+    """
+    newPhase = QtCore.pyqtSignal(object)
+
+    def __init__(self, estimator, rate=100):
+        super().__init__()
+        self.estimator = estimator
+        self.rate = rate  # [Hz]
+        self.running = False
+        self.loop = PeriodicLoop(1 / rate, name='Phase stream')
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        self.loop.period = 1 / self.rate
+        self.loop.reset()
+        while self.running:
+            now = time.perf_counter()
+            phase = self.estimator.phase_at(now)
+            if phase is not None:
+                self.newPhase.emit([now, phase, self.estimator.frequency()])
+            self.loop.wait()
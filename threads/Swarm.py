@@ -0,0 +1,138 @@
+import numpy as np
+from pyqtgraph.Qt import QtCore
+from misc_functions import PeriodicLoop
+
+
+class SwarmThread(QtCore.QThread):
+    """Runs a swarm pattern off the GUI thread on a drift-free schedule.
+
+    A pattern is a function taking this thread. It sets parameters with `set`, which writes them to the rig's
+    ControlState (and from there to the controller, straight from this thread), and waits between steps with `wait`,
+    whose deadlines are absolute so the pattern keeps its rhythm however busy the GUI is.
+
+    Attributes:
+        pattern: one of the pattern functions below
+        state (ControlState): the rig's control values
+        loop (PeriodicLoop): the pattern's schedule, its stats show how well the timing was kept
+        running (bool): used to control the state of the run loop from outside this thread. Set by `start`, so a
+            pattern that was just started counts as running before its thread gets to run().
+    """
+    def __init__(self, pattern, state):
+        super().__init__()
+        self.pattern = pattern
+        self.state = state
+        self.loop = PeriodicLoop(0.2, name=f"Swarm {pattern.__name__}")
+        self.running = False
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.loop.reset()
+        self.pattern(self)
+        self.running = False
+
+    def start(self, priority=QtCore.QThread.InheritPriority):
+        self.running = True
+        super().start(priority)
+
+    def set(self, child, value, branch='Rolling'):
+        self.state.set((branch, child), value)
+
+    def get(self, child, branch='Rolling'):
+        return self.state.get((branch, child))
+
+    def wait(self, interval):
+        self.loop.wait(interval)
+
+
+def explode(swarm, time=0.2):
+    """Explode the wheel by applying an orthogonal camber angle briefly."""
+    camber = swarm.get("Camber")
+    heading = swarm.get('Heading')
+    ortho = camber - 90
+
+    # Tilt
+    swarm.set('Camber', ortho)
+    if np.abs(ortho) > 91:
+        swarm.set('Heading', (heading - 180) % 360)
+
+    swarm.wait(time)
+
+    # Reset
+    swarm.set('Camber', camber)
+    if np.abs(ortho) > 91:
+        swarm.set('Heading', heading)
+
+
+def flipping(swarm, time_between_explodes=0.5, explode_time=0.2):
+    """Explode the wheel repeatedly."""
+    while swarm.running:
+        explode(swarm, explode_time)
+        swarm.wait(time_between_explodes)
+
+
+def switchback(swarm, time_between_turn=0.2, wiggle_angle=35):
+    """Switchback swarm, turn left and right of the driving heading in turn.
+
+    Args:
+        time_between_turn (float): time constant between each turn
+        wiggle_angle (int): deviation from centerline, determines angle of switchbacks
+    """
+    driving_heading = swarm.get('Heading')  # uphill direction, overall movement direction
+    while swarm.running:
+        # turn left
+        swarm.set('Heading', (driving_heading - wiggle_angle) % 360)
+        swarm.wait(time_between_turn)
+
+        # turn right
+        swarm.set('Heading', (driving_heading + wiggle_angle) % 360)
+        swarm.wait(time_between_turn)
+
+        # After running climb at least once, the wheel is currently in `right` formation. If there has been a change
+        # to the Heading from the user, update the driving heading.
+        if driving_heading != (swarm.get('Heading') - wiggle_angle) % 360:
+            driving_heading = swarm.get('Heading')
+
+    # reset back to original heading
+    swarm.set('Heading', driving_heading)
+
+
+def corkscrew(swarm, time_between_corkscrews=0.01, camber_max=70, total_steps=10, total_time=1.0, alpha=0.4):
+    """My version of the corkscrew motion, described in signal_sandbox notebook.
+
+    Args:
+        camber_max (float): camber at the middle of each corkscrew
+        total_steps (int): setpoints per corkscrew, must be an even number
+        total_time (float): duration of one corkscrew [s]
+        alpha (float): time of the slow first part of the turn [s], the rest turns twice as fast
+    """
+    while swarm.running:
+        z_start = swarm.get('Heading')
+        camber = swarm.get('Camber')
+        camber_half_steps = (camber_max - camber) / (total_steps // 2)
+
+        step_time = total_time / total_steps
+        beta = total_time - alpha
+        a = 360 / (2 * beta + alpha)
+
+        for seconds in np.linspace(0, total_time, num=total_steps):
+            # Calculate z_phase given current time
+            if seconds <= alpha:
+                z_phase = a * seconds + z_start
+            else:
+                z_phase = 2 * a * seconds - a * alpha + z_start
+
+            # Calculate camber angle
+            if seconds <= total_time / 2:  # first half of time steps, bow down camber
+                camber += camber_half_steps
+            else:  # second half, rise up
+                camber -= camber_half_steps
+
+            swarm.set('Heading', z_phase % 360)  # set Heading
+            swarm.set('Camber', camber)  # set camber
+            swarm.wait(step_time)
+
+        swarm.wait(time_between_corkscrews)
+
+
+# Patterns by their name in the Swarm Mode parameter
+PATTERNS = {'Corkscrew': corkscrew, 'Flipping': flipping, 'Switchback': switchback}
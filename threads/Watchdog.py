@@ -0,0 +1,161 @@
+import threading
+import time
+from pyqtgraph.Qt import QtCore
+from misc_functions import shortest_angle_delta
+
+
+class Watchdog(QtCore.QThread):
+    """Safety thread that idles the motors when the telemetry goes out of bounds or stops arriving.
+
+    Telemetry is pushed in with `feed` straight from the DataRetriever thread, so a trip never waits on the GUI event
+    loop. The run loop wakes on every new sample and at least every `period` seconds to check the staleness deadline,
+    which bounds the reaction time to roughly one period plus the USB writes of `idle()`.
+
+    Attributes:
+        controller: the ODriveController whose axes are protected. Used to convert raw readings, read the setpoints
+            and to command idle().
+        armed (bool): only an armed watchdog trips. Arming follows the "Engage Motors" state.
+        trips (list): a record of every trip, see `trip`
+        max_spinner_hz (float): trip when the magnet spins faster than this [Hz]
+        stall_error (float): a heading error larger than this [deg] with the axis not moving counts as a stall
+        stall_time (float): how long a stall is tolerated [s]
+        zlims (tuple): allowed roboscope travel [cm], widened by z_margin
+        check_z (bool): cleared while the roboscope is homed, since the end stop lies outside zlims
+        stale_timeout (float): trip when no telemetry has arrived for this long [s]
+    """
+    tripped = QtCore.pyqtSignal(object)
+
+    def __init__(self, controller, period=0.005, max_spinner_hz=35.0, stall_error=10.0, stall_time=1.0,
+                 zlims=(0.0, 27.0), z_margin=0.5, stale_timeout=0.5):
+        super().__init__()
+        self.controller = controller
+        self.period = period
+        self.max_spinner_hz = max_spinner_hz
+        self.stall_error = stall_error
+        self.stall_time = stall_time
+        self.zlims = zlims
+        self.z_margin = z_margin
+        self.stale_timeout = stale_timeout
+
+        self.running = False
+        self.armed = False
+        self.check_z = True
+        self.trips = []
+
+        self.new_sample = threading.Event()
+        self.lock = threading.Lock()
+        self.sample = None  # (timestamp, heading, z, spinner hz) of the latest reading
+        self.last_sample_time = None
+        self.last_heading = None
+        self.stall_start = None
+
+    def arm(self):
+        """Start protecting the axes. The staleness deadline starts counting from now."""
+        with self.lock:
+            self.last_sample_time = time.perf_counter()
+            self.stall_start = None
+            self.armed = True
+
+    def disarm(self):
+        self.armed = False
+
+    def feed(self, t, incomingData):
+        """Hand the watchdog a raw DataRetriever reading taken at time `t` (time.perf_counter)."""
+        heading, z, spinner = self.controller.convert(incomingData)
+        with self.lock:
+            self.sample = (t, heading, z, spinner)
+            self.last_sample_time = t
+        self.new_sample.set()
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        while self.running:
+            self.new_sample.wait(self.period)
+            self.new_sample.clear()
+            if self.armed:
+                self.check()
+
+    def check(self):
+        """Evaluate every limit against the latest sample and trip on the first violation."""
+        now = time.perf_counter()
+        with self.lock:
+            sample, self.sample = self.sample, None
+            last_sample_time = self.last_sample_time
+
+        if now - last_sample_time > self.stale_timeout:
+            self.trip(f"telemetry stale for {now - last_sample_time:.3f} s", last_sample_time + self.stale_timeout)
+            return
+        if sample is None:
+            return
+
+        t, heading, z, spinner = sample
+        if abs(spinner) > self.max_spinner_hz:
+            self.trip(f"spinner overspeed, {spinner:.1f} Hz > {self.max_spinner_hz} Hz", t)
+        elif self.check_z and not self.zlims[0] - self.z_margin <= z <= self.zlims[1] + self.z_margin:
+            self.trip(f"roboscope out of bounds, Z = {z:.2f} cm", t)
+        elif self.is_stalled(t, heading):
+            self.trip(f"heading stalled at {heading:.1f}°, setpoint {self.controller.heading_command % 360:.1f}°", t)
+
+    def is_stalled(self, t, heading):
+        """A stall is a large heading error while the heading isn't moving, lasting longer than stall_time.
+
+        The error is taken from the setpoint last sent to the board, not from h, which can be ahead of it.
+        """
+        error = abs(shortest_angle_delta(heading, self.controller.heading_command))
+        moving = self.last_heading is not None and abs(heading - self.last_heading) > 0.5
+        self.last_heading = heading
+
+        if error < self.stall_error or moving:
+            self.stall_start = None
+            return False
+        if self.stall_start is None:
+            self.stall_start = t
+        return t - self.stall_start > self.stall_time
+
+    def trip(self, reason, t_fault):
+        """Idle the axes and record how long it took from the fault to the idle command completing.
+
+        Args:
+            reason (str): human readable description of the fault
+            t_fault (float): time.perf_counter() timestamp at which the fault became detectable
+        """
+        self.disarm()
+        idled = self.controller.idle()
+        latency = time.perf_counter() - t_fault
+        record = {'time': time.time(), 'reason': reason, 'latency': latency, 'idled': idled}
+        self.trips.append(record)
+        if idled:
+            print(f"WATCHDOG TRIP: {reason}. Motors idled {latency * 1000:.1f} ms after the fault.")
+        else:
+            print(f"WATCHDOG TRIP: {reason}. Idling the motors FAILED {latency * 1000:.1f} ms after the fault.")
+        self.tripped.emit(record)
+
+
+if __name__ == '__main__':
+    # Verify against the simulated ODrives: force an overspeed, then a telemetry dropout.
+    # Run from the top folder with `python -m threads.Watchdog`
+    import sys
+    from pyqtgraph.Qt import QtWidgets
+    from threads.ODriveController import ODriveController
+    from misc_functions import qtsleep
+
+    app = QtWidgets.QApplication([])
+    ctrl = ODriveController(simulate=True)
+    ctrl.run()
+    ctrl.closed_loop()
+
+    ctrl.f = 2 * ctrl.watchdog.max_spinner_hz
+    ctrl.update_magnet_rotation_rate()
+    qtsleep(2)
+
+    ctrl.f = 0
+    ctrl.update_magnet_rotation_rate()
+    ctrl.closed_loop()
+    ctrl.dataretriever.running = False
+    qtsleep(2)
+
+    ctrl.watchdog.running = False
+    for trip in ctrl.watchdog.trips:
+        print(f"{trip['reason']}: {trip['latency'] * 1000:.1f} ms")
+    sys.exit(0 if len(ctrl.watchdog.trips) == 2 else 1)
@@ -0,0 +1,182 @@
+"""Step-response characterization of the heading and roboscope position filters.
+
+Commands a grid of steps on an axis across a range of `input_filter_bandwidth` and `vel_limit` values, records the
+encoder response at a high rate, and reports settle time and overshoot for every setting. Run this file directly to
+sweep the simulated axes, or with --hardware to sweep the real rig (the motors WILL move).
+"""
+import argparse
+import time
+import numpy as np
+from odrive.enums import *
+
+
+def step_metrics(t, y, start, target, settle_band=0.02):
+    """Compute settle time and overshoot of a recorded step response.
+
+    Args:
+        t (np.ndarray): sample times in s, relative to the moment the step was commanded
+        y (np.ndarray): recorded positions, same units as start and target
+        start (float): position before the step
+        target (float): commanded position
+        settle_band (float): settled means staying within this fraction of the step size from the target
+
+    Returns:
+        settle_time: time in s after which the response stays inside the band, or np.inf if it never settles
+        overshoot: percent of the step size the response travels past the target
+    """
+    step = target - start
+    error = (y - target) * np.sign(step)  # positive = past the target
+    overshoot = max(0.0, error.max()) / abs(step) * 100
+
+    outside = np.nonzero(np.abs(error) > settle_band * abs(step))[0]
+    if outside.size == 0:
+        settle_time = 0.0
+    elif outside[-1] == y.size - 1:
+        settle_time = np.inf  # still outside the band at the end of the recording
+    else:
+        settle_time = t[outside[-1] + 1]
+    return settle_time, overshoot
+
+
+class StepSweep:
+    """Sweeps step responses of one position controlled axis.
+
+    The axis must already be in closed loop position control. Positions are given in user units (degrees of heading,
+    cm of roboscope travel) and converted with `units_per_turn`.
+
+    Attributes:
+        axis: an odrive axis, or a sim_odrive.SimAxis
+        units_per_turn (float): user units per motor turn, negative if the axis runs backwards
+        sample_rate (float): encoder polling rate during the recording [Hz]
+        record_time (float): how long each step response is recorded [s]
+        clock, sleep: time source and wait function. Hardware uses the wall clock, a non-realtime sim passes its own
+            `clock` and `advance` so the sweep runs faster than real time.
+        results (list): one dict per (vel_limit, bandwidth, step) combination
+    """
+
+    def __init__(self, axis, units_per_turn, sample_rate=1000, record_time=3.0, settle_band=0.02,
+                 clock=time.perf_counter, sleep=time.sleep):
+        self.axis = axis
+        self.units_per_turn = units_per_turn
+        self.sample_rate = sample_rate
+        self.record_time = record_time
+        self.settle_band = settle_band
+        self.clock = clock
+        self.sleep = sleep
+        self.results = []
+
+        # Preallocated recording buffers, reused for every step
+        n = int(record_time * sample_rate)
+        self.t = np.zeros(n)
+        self.y = np.zeros(n)
+
+    def record(self, target):
+        """Command `target` (user units) and record the response. Returns the position before the step."""
+        start = self.axis.encoder.pos_estimate * self.units_per_turn
+        period = 1 / self.sample_rate
+        t0 = self.clock()
+        self.axis.controller.input_pos = target / self.units_per_turn
+        for i in range(self.t.size):
+            # Absolute deadlines so USB latency doesn't stretch the sample period
+            wait = t0 + i * period - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            self.t[i] = self.clock() - t0
+            self.y[i] = self.axis.encoder.pos_estimate * self.units_per_turn
+        return start
+
+    def run(self, base, step_sizes, bandwidths, vel_limits):
+        """Run the full grid. Every step is commanded up from `base` and then back down to it.
+
+        Args:
+            base (float): position the steps start from, user units
+            step_sizes (iterable): step sizes in user units
+            bandwidths (iterable): input filter bandwidths to try
+            vel_limits (iterable): velocity limits to try [turns/s]
+
+        Returns:
+            results: list of dicts with keys vel_limit, bandwidth, step, direction, settle_time, overshoot
+        """
+        config = self.axis.controller.config
+        config.input_mode = INPUT_MODE_POS_FILTER
+        for vel_limit in vel_limits:
+            config.vel_limit = vel_limit
+            for bandwidth in bandwidths:
+                config.input_filter_bandwidth = bandwidth
+                for step in step_sizes:
+                    for direction, target in (('up', base + step), ('down', base)):
+                        start = self.record(target)
+                        settle_time, overshoot = step_metrics(self.t, self.y, start, target, self.settle_band)
+                        self.results.append({'vel_limit': vel_limit, 'bandwidth': bandwidth, 'step': step,
+                                             'direction': direction, 'settle_time': settle_time,
+                                             'overshoot': overshoot})
+        return self.results
+
+    def recommend(self, max_overshoot=2.0):
+        """Pick the fastest setting whose worst case overshoot across all steps stays within `max_overshoot` percent.
+
+        Returns:
+            (bandwidth, vel_limit, worst settle time) or None if no setting qualifies
+        """
+        best = None
+        for setting in sorted({(r['bandwidth'], r['vel_limit']) for r in self.results}):
+            runs = [r for r in self.results if (r['bandwidth'], r['vel_limit']) == setting]
+            worst_overshoot = max(r['overshoot'] for r in runs)
+            worst_settle = max(r['settle_time'] for r in runs)
+            if worst_overshoot <= max_overshoot and np.isfinite(worst_settle):
+                if best is None or worst_settle < best[2]:
+                    best = (setting[0], setting[1], worst_settle)
+        return best
+
+    def report(self, name, max_overshoot=2.0):
+        """Print the results table and the recommendation."""
+        print(f"\n{name} step response")
+        print(f"{'vel_limit':>10}{'bandwidth':>10}{'step':>8}{'dir':>6}{'settle [s]':>12}{'overshoot [%]':>15}")
+        for r in self.results:
+            print(f"{r['vel_limit']:>10.1f}{r['bandwidth']:>10.1f}{r['step']:>8.1f}{r['direction']:>6}"
+                  f"{r['settle_time']:>12.3f}{r['overshoot']:>15.2f}")
+        best = self.recommend(max_overshoot)
+        if best is None:
+            print(f"No setting stays under {max_overshoot}% overshoot.")
+        else:
+            print(f"Recommended: bandwidth {best[0]}, vel_limit {best[1]} (settles in {best[2]:.3f} s)")
+        return best
+
+
+if __name__ == '__main__':
+    from threads.ODriveController import ODriveController
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hardware', action='store_true', help='sweep the real rig instead of the simulation')
+    parser.add_argument('--max-overshoot', type=float, default=2.0, help='allowed overshoot in percent')
+    args = parser.parse_args()
+
+    ctrl = ODriveController(simulate=not args.hardware)
+    if args.hardware:
+        import odrive
+        drv1 = odrive.find_any(serial_number=ctrl.drv1_serial)
+        drv2 = odrive.find_any(serial_number=ctrl.drv2_serial)
+    else:
+        import sim_odrive
+        drv1 = sim_odrive.find_any(serial_number=ctrl.drv1_serial, realtime=False)
+        drv2 = sim_odrive.find_any(serial_number=ctrl.drv2_serial, realtime=False)
+
+    heading_axis, roboscope_axis = drv1.axis0, drv2.axis0
+    bandwidths = [2.0, 4.0, 6.0, 8.0, 12.0, 16.0, 24.0]
+    axes = [
+        ('Heading', heading_axis, -ctrl.heading_gr * 360, [10.0, 45.0, 90.0], [10.0, 15.0, 20.0]),
+        ('Roboscope', roboscope_axis, ctrl.roboscope_cmperturn, [0.5, 2.0, 8.0], [2.0, 4.0]),
+    ]
+
+    for name, axis, units_per_turn, steps, vel_limits in axes:
+        axis.controller.config.control_mode = CONTROL_MODE_POSITION_CONTROL
+        base = axis.encoder.pos_estimate * units_per_turn
+        axis.controller.input_pos = base / units_per_turn
+        axis.requested_state = AXIS_STATE_CLOSED_LOOP_CONTROL
+        if args.hardware:
+            sweep = StepSweep(axis, units_per_turn)
+        else:
+            sweep = StepSweep(axis, units_per_turn, clock=axis.clock, sleep=axis.advance)
+        sweep.run(base, steps, bandwidths, vel_limits)
+        sweep.report(name, args.max_overshoot)
+        axis.requested_state = AXIS_STATE_IDLE
@@ -0,0 +1,341 @@
+import multiprocessing as mp
+import queue
+import numpy as np
+from pyqtgraph.Qt import QtCore
+from telemetry import TelemetryFrame, SampleTiming, CHANNELS
+from threads.PhaseStreamer import MagnetPhaseEstimator
+
+
+def _forwarded(name):
+    """Property that keeps a local copy of a controller attribute and also sets it in the worker process."""
+    def get(self):
+        return self.values[name]
+
+    def set(self, value):
+        self.values[name] = value
+        self.send('set', name, value)
+    return property(get, set)
+
+
+class _WatchdogProxy(QtCore.QObject):
+    """Stands in for the worker's Watchdog: forwards its settings and re-emits its trips."""
+    tripped = QtCore.pyqtSignal(object)
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self._zlims = None
+        self.trips = []
+
+    @property
+    def zlims(self):
+        return self._zlims
+
+    @zlims.setter
+    def zlims(self, value):
+        self._zlims = value
+        self.client.send('watchdog', 'zlims', value)
+
+
+class ControllerProcess(QtCore.QObject):
+    """GUI side of an ODriveController that runs in a worker process, so that ODrive I/O doesn't share the GIL with
+    the plots and the Parameter Tree.
+
+    Offers the parts of the ODriveController interface that RigPanel and ShutdownSequence use. Attribute changes and
+    method calls are sent to the worker over a queue and run in order in its main thread. The worker writes every
+    telemetry frame to a ring of slots in shared memory; a timer here picks up the new frames and emits them with
+    newTelemetry. Connection, watchdog trips, the end of coordinated moves and homing, and failed idles come back over
+    an event queue.
+
+    The telemetry timestamps are taken in the worker, so `timing` measures the jitter of the sampling itself.
+
+    Attributes:
+        process (mp.Process): the worker process, running `run_worker`
+        watchdog: forwards `zlims` to the worker's watchdog and emits its `tripped` signal
+        phase_estimator (MagnetPhaseEstimator): fed from the telemetry, for the orientation view
+        move_in_progress (bool): a coordinated move is running in the worker
+        homing_in_progress (bool): the roboscope is being homed in the worker
+        timing (SampleTiming): interval statistics of the received telemetry samples
+        dropped (int): frames overwritten in the ring before or while they were picked up
+    """
+    newTelemetry = QtCore.pyqtSignal(object)
+    connected = QtCore.pyqtSignal()
+    homed = QtCore.pyqtSignal(object)
+    ioError = QtCore.pyqtSignal(str)
+
+    mode = _forwarded('mode')
+    f = _forwarded('f')
+    h = _forwarded('h')
+    z = _forwarded('z')
+
+    def __init__(self, simulate=False, drv1_serial="208739A04D4D", drv2_serial="207539694D4D", attributes=None,
+                 slots=64, poll_interval=5):
+        super().__init__()
+        attributes = dict(attributes or {})
+        self.batch = attributes.get('telemetry_batch', 1)
+        self.slots = slots
+        self.poll_interval = poll_interval  # [ms]
+
+        self.commands = mp.Queue()
+        self.events = mp.Queue()
+        self.buffer = mp.RawArray('d', slots * len(CHANNELS) * self.batch)
+        self.counter = mp.Value('q', 0)  # frames written so far
+        self.stamps = mp.RawArray('q', slots)  # number of the frame in each slot, -1 while it is being written
+        self.ring = np.frombuffer(self.buffer).reshape(slots, len(CHANNELS), self.batch)
+        self.process = mp.Process(target=run_worker, daemon=True, name=f"ODrive {drv1_serial}",
+                                  args=(dict(simulate=simulate, drv1_serial=drv1_serial, drv2_serial=drv2_serial),
+                                        attributes, self.commands, self.events, self.buffer, self.counter,
+                                        self.stamps))
+
+        self.values = {'mode': "Rolling", 'f': 0.0, 'h': 138.5, 'z': 0.0}
+        self.watchdog = _WatchdogProxy(self)
+        self.phase_estimator = MagnetPhaseEstimator(3 / 10)  # the worker sends the real gear ratio on connecting
+        self.move_in_progress = False
+        self.homing_in_progress = bool(attributes.get('home_on_connect'))
+        self.running = False
+
+        self.frame = TelemetryFrame(self.batch)
+        self.read = 0
+        self.dropped = 0
+        self.telemetry_period = attributes.get('telemetry_period', 0.1)
+        self.timing = SampleTiming(self.telemetry_period)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.poll)
+
+    def send(self, kind, *args):
+        self.commands.put((kind,) + args)
+
+    def start(self):
+        self.running = True
+        self.process.start()
+        self.timer.start(self.poll_interval)
+
+    def poll(self):
+        """Handle the worker's events and emit the telemetry frames written since the last poll."""
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_event(event)
+
+        written = self.counter.value
+        if written - self.read >= self.slots:  # the oldest slot is the one the worker writes next, skip it as well
+            self.dropped += written - self.read - self.slots + 1
+            self.read = written - self.slots + 1
+        while self.read < written:
+            slot = self.read % self.slots
+            self.read += 1
+            if self.stamps[slot] != self.read - 1:  # overwritten before it was copied
+                self.dropped += 1
+                continue
+            self.frame.data[:] = self.ring[slot]
+            if self.stamps[slot] != self.read - 1:  # overwritten while it was copied
+                self.dropped += 1
+                continue
+            self.frame.n = self.batch
+            self.timing.update(self.frame.t)
+            self.phase_estimator.update(self.frame.t[-1], self.frame.spinner_pos[-1],
+                                        self.frame.spinner[-1] / self.phase_estimator.magnet_gr)
+            self.newTelemetry.emit(self.frame)
+
+    def handle_event(self, event):
+        kind = event[0]
+        if kind == 'connected':
+            self.phase_estimator.magnet_gr = event[1]['magnet_gr']
+            self.connected.emit()
+        elif kind == 'tripped':
+            self.watchdog.trips.append(event[1])
+            self.watchdog.tripped.emit(event[1])
+        elif kind == 'move_finished':
+            self.move_in_progress = False
+        elif kind == 'homed':
+            self.homing_in_progress = False
+            self.homed.emit(event[1])
+        elif kind == 'io_error':
+            self.ioError.emit(event[1])
+
+    # ODriveController methods, run in the worker
+    def closed_loop(self):
+        self.send('call', 'closed_loop')
+
+    def idle(self):
+        self.send('call', 'idle')
+
+    def update_heading(self):
+        self.send('call', 'update_heading')
+
+    def update_roboscope(self):
+        self.send('call', 'update_roboscope')
+
+    def update_magnet_rotation_rate(self):
+        self.send('call', 'update_magnet_rotation_rate')
+
+    def set_heading_filter_bandwidth(self, b):
+        self.send('call', 'set_heading_filter_bandwidth', b)
+
+    def set_adaptive_heading_bandwidth(self, enabled):
+        self.send('call', 'set_adaptive_heading_bandwidth', enabled)
+
+    def coordinated_move(self, **targets):
+        if self.homing_in_progress:
+            print("Coordinated move refused, the roboscope is being homed.")
+            return
+        if self.move_in_progress:
+            print("Coordinated move refused, the previous move is still running.")
+            return
+        self.move_in_progress = True  # set right away so the GUI stops sending single-axis updates
+        self.send('call', 'coordinated_move', targets)
+
+    def home_roboscope(self):
+        if self.homing_in_progress or self.move_in_progress:
+            print("Roboscope homing refused, homing or a coordinated move is already running.")
+            return
+        self.homing_in_progress = True
+        self.send('call', 'home_roboscope')
+
+    def stop(self, timeout=3.0):
+        """Stop the controller in the worker (which idles the motors) and wait for the process to end."""
+        self.send('stop')
+        self.process.join(timeout)
+        if self.process.is_alive():
+            print(f"{self.process.name} worker did not stop, terminating it.")
+            self.process.terminate()
+        self.timer.stop()
+        self.running = False
+        print(f"{self.process.name} telemetry timing: {self.timing.report()}, {self.dropped} frames dropped")
+
+
+class _CommandListener(QtCore.QThread):
+    """Waits on the command queue in the worker and hands each command to its main thread."""
+    received = QtCore.pyqtSignal(object)
+
+    def __init__(self, commands):
+        super().__init__()
+        self.commands = commands
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        while True:
+            command = self.commands.get()
+            self.received.emit(command)
+            if command[0] == 'stop':
+                break
+
+
+class _ControllerServer(QtCore.QObject):
+    """Worker side: runs the commands from the GUI process on the controller and publishes its telemetry and events."""
+
+    def __init__(self, controller, commands, events, buffer, counter, stamps):
+        super().__init__()
+        self.controller = controller
+        self.events = events
+        self.counter = counter
+        self.stamps = stamps
+        slots = len(buffer) // (len(CHANNELS) * controller.telemetry_batch)
+        self.ring = np.frombuffer(buffer).reshape(slots, len(CHANNELS), controller.telemetry_batch)
+
+        controller.newTelemetry.connect(self.write)
+        controller.connected.connect(lambda: events.put(('connected', {'magnet_gr': controller.magnet_gr})))
+        controller.watchdog.tripped.connect(lambda trip: events.put(('tripped', trip)))
+        controller.homed.connect(lambda report: events.put(('homed', report)))
+        controller.ioError.connect(lambda message: events.put(('io_error', message)))
+
+        self.listener = _CommandListener(commands)
+        self.listener.received.connect(self.handle)
+        self.listener.start()
+
+    def write(self, frame):
+        """Copy a frame into the next ring slot, then publish it by stamping the slot and advancing the counter.
+
+        The slot's stamp is cleared while it is written, so the reader can tell a frame it copied was torn.
+        """
+        written = self.counter.value
+        slot = written % len(self.ring)
+        self.stamps[slot] = -1
+        self.ring[slot, :, :frame.n] = frame.data[:, :frame.n]
+        self.stamps[slot] = written
+        self.counter.value = written + 1
+
+    def handle(self, command):
+        kind, args = command[0], command[1:]
+        try:
+            if kind == 'set':
+                setattr(self.controller, *args)
+            elif kind == 'watchdog':
+                setattr(self.controller.watchdog, *args)
+            elif kind == 'call' and args[0] == 'coordinated_move':
+                move = self.controller.coordinated_move(**args[1])
+                if move is None:  # refused, nothing to wait for
+                    self.events.put(('move_finished', None))
+                else:
+                    move.moveFinished.connect(lambda report: self.events.put(('move_finished', report)))
+            elif kind == 'call' and args[0] == 'home_roboscope':
+                if self.controller.home_roboscope() is None:  # refused, report it so the GUI stops waiting
+                    self.events.put(('homed', {'success': False, 'reason': 'refused, homing or a move was running'}))
+            elif kind == 'call':
+                getattr(self.controller, args[0])(*args[1:])
+            elif kind == 'stop':
+                self.controller.stop()
+                self.controller.wait(1000)
+                QtCore.QCoreApplication.quit()
+        except Exception as e:  # keep serving, the GUI process only sees the worker's prints
+            print(f"Worker command {command} failed: {e!r}")
+
+
+def run_worker(kwargs, attributes, commands, events, buffer, counter, stamps):
+    """Entry point of the worker process: an ODriveController with its own Qt event loop and no GUI.
+
+    Args:
+        kwargs (dict): ODriveController arguments
+        attributes (dict): ODriveController attributes to set before it starts, e.g. telemetry_period
+    """
+    from threads.ODriveController import ODriveController
+
+    app = QtCore.QCoreApplication([])
+    controller = ODriveController(**kwargs)
+    for name, value in attributes.items():
+        setattr(controller, name, value)
+    server = _ControllerServer(controller, commands, events, buffer, counter, stamps)
+    controller.start()
+    app.exec_()
+
+
+if __name__ == '__main__':
+    # Telemetry jitter against the simulated ODrives with the GUI thread kept busy, controller in this process versus
+    # in a worker process. Run from the top folder with `python worker.py`
+    import time
+    from pyqtgraph.Qt import QtWidgets
+    from threads.ODriveController import ODriveController
+
+    period, duration, load = 0.005, 5.0, 0.015  # telemetry period, measuring time, GUI busy time per 20 ms [s]
+    app = QtWidgets.QApplication([])
+
+    def gui_load():
+        """Busy pure Python work in the GUI thread, holding the GIL like a heavy repaint."""
+        end = time.perf_counter() + load
+        while time.perf_counter() < end:
+            sum(i * i for i in range(100))
+
+    busy = QtCore.QTimer()
+    busy.timeout.connect(gui_load)
+    busy.start(20)
+
+    def measure(controller, timing):
+        controller.newTelemetry.connect(lambda frame: timing.update(frame.t.copy()))
+        controller.start()
+        QtCore.QTimer.singleShot(int(duration * 1000), app.quit)
+        app.exec_()
+        controller.stop()
+
+    local = ODriveController(simulate=True)
+    local.telemetry_period = period
+    local_timing = SampleTiming(period)
+    measure(local, local_timing)
+
+    remote = ControllerProcess(simulate=True, attributes={'telemetry_period': period})
+    measure(remote, SampleTiming(period))  # the client measures its own timing
+
+    print(f"In process:     {local_timing.report()}")
+    print(f"Worker process: {remote.timing.report()}")